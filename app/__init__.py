@@ -5,7 +5,7 @@ from logging.handlers import RotatingFileHandler
 from flask import Flask, request, Blueprint, send_from_directory, current_app
 from flask_migrate import Migrate
 
-from app.extensions import db, login_manager, socketio, limiter, talisman, redis_client
+from app.extensions import db, login_manager, socketio, limiter, talisman
 from app.websocket import register_socketio_handlers
 
 
@@ -14,6 +14,10 @@ def create_app(config_class='config.Config'):
     app.static_folder = os.path.abspath('app/static')
     app.config.from_object(config_class)
 
+    # JSON для jsonify и Socket.IO (orjson при наличии, см. JSON_BACKEND)
+    from app import json_provider
+    json_codec = json_provider.init_app(app)
+
     # Инициализация расширений
     db.init_app(app)
     login_manager.init_app(app)
@@ -45,35 +49,60 @@ def create_app(config_class='config.Config'):
     app.register_blueprint(chat_bp)
     
     # Регистрация API контроллеров
-    from app.controllers import MessageController, RoomController, UserController
+    from app.controllers import MessageController, RoomController, UserController, MetricsController
     message_controller = MessageController()
     room_controller = RoomController()
     user_controller = UserController()
+    metrics_controller = MetricsController()
     app.register_blueprint(message_controller.bp)
     app.register_blueprint(room_controller.bp)
     app.register_blueprint(user_controller.bp)
-
-    # Инициализация Redis клиента (если доступен)
+    app.register_blueprint(metrics_controller.bp)
+
+    # Инициализация Redis клиента (если доступен) поверх пула соединений
+    from app import extensions as _ext
+    from app.circuit_breaker import redis_breaker
+    redis_breaker.configure(
+        failure_threshold=app.config.get('REDIS_BREAKER_FAILURE_THRESHOLD', 5),
+        recovery_timeout=app.config.get('REDIS_BREAKER_RECOVERY_SECONDS', 10),
+    )
     redis_url = app.config.get('REDIS_URL')
     if redis_url:
         try:
-            import redis as _redis
-            # decode_responses=True -> строки, а не bytes
-            client = _redis.from_url(redis_url, decode_responses=True)
+            from app.redis_pool import create_redis_client
+            client = create_redis_client(app.config)
             # тест соединения
             client.ping()
             # присваиваем в расширение
-            from app import extensions as _ext
             _ext.redis_client = client
-            app.logger.info(f"Redis подключен: {redis_url}")
+            app.logger.info(f"Redis подключен: {redis_url} (max_connections={client.connection_pool.max_connections})")
         except Exception as e:
             app.logger.warning(f"Не удалось подключиться к Redis по {redis_url}: {e}")
 
     # Инициализация Socket IO ПОСЛЕ регистрации Blueprints
-    message_queue = None
-    if redis_client is not None:
+    import socketio as _socketio
+    manager_kwargs = {'url': redis_url, 'channel': app.config.get('SOCKETIO_CHANNEL', 'flask-socketio')}
+    if _ext.redis_client is None:
+        manager_class, manager_kwargs = _socketio.BaseManager, {}
+    elif app.config.get('SOCKETIO_SHARDED_ROOMS', True):
+        # Канал на комнату: воркер получает только emit'ы комнат со своими сокетами
+        from app.room_pubsub import ShardedRedisManager
+        manager_class = ShardedRedisManager
+    else:
         # Используем Redis как бэкенд для межпроцессной коммуникации
-        message_queue = app.config.get('REDIS_URL')
+        manager_class = _socketio.RedisManager
+    if app.config.get('SOCKET_BACKPRESSURE_ENABLED', True):
+        # Лимиты исходящей очереди каждого сокета и отключение медленных клиентов
+        from app.backpressure import with_backpressure
+        manager_class = with_backpressure(manager_class)
+    client_manager = manager_class(**manager_kwargs)
+    if hasattr(client_manager, 'configure_backpressure'):
+        client_manager.configure_backpressure(
+            soft_limit=app.config.get('SOCKET_OUTBOUND_SOFT_LIMIT', 200),
+            hard_limit=app.config.get('SOCKET_OUTBOUND_HARD_LIMIT', 1000),
+            grace_seconds=app.config.get('SOCKET_SLOW_CONSUMER_GRACE_SECONDS', 30),
+            sweep_seconds=app.config.get('SOCKET_BACKPRESSURE_SWEEP_SECONDS', 1.0),
+        )
 
     socketio.init_app(app,
                       cors_allowed_origins=["http://localhost:5000", "http://127.0.0.1:5000"],
@@ -81,9 +110,20 @@ def create_app(config_class='config.Config'):
                       engineio_logger=False,
                       ping_timeout=30,
                       ping_interval=10,
-                      message_queue=message_queue
+                      client_manager=client_manager,
+                      json=json_codec
                       )
-    register_socketio_handlers(socketio)
+    register_socketio_handlers(socketio, app)
+
+    # Отложенная пакетная запись сообщений (MESSAGE_WRITE_BEHIND)
+    from app.services.message_writer import message_writer
+    message_writer.init_app(app)
+
+    from app.services.message_serializer import message_serializer
+    message_serializer.init_app(app)
+
+    from app.commands import register_commands
+    register_commands(app)
 
     # Импорт sockets больше не нужен - используется websocket модуль
     from app.error_handlers import register_error_handlers
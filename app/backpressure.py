@@ -0,0 +1,182 @@
+"""
+Ограничение исходящей очереди сокетов: медленным клиентам сначала перестают уходить
+второстепенные события, а клиент, который долго не разгружает очередь, отключается
+"""
+import threading
+import time
+from functools import partial
+from typing import Any, Dict, Optional, Tuple
+import socketio
+from app.metrics import metrics
+
+
+class BackpressureMixin:
+    """Примесь к менеджеру клиентов python-socketio: лимиты очереди engine.io на каждый сокет"""
+
+    # Можно потерять: клиент восстановит состояние сам (версии дельт, повторный запрос) или это уведомление
+    DROPPABLE_EVENTS = frozenset({'room_list_delta', 'members_delta', 'user_joined', 'user_left'})
+    # Последнее значение заменяет предыдущие; уходят, когда очередь сокета разгрузится
+    COALESCED_EVENTS = frozenset({'presence_delta', 'room_list'})
+    # Кадр emit_batcher ({'events': [{'event', 'data'}, ...]}): правила применяются к каждому вложенному событию
+    BATCH_EVENT = 'batch'
+
+    def configure_backpressure(self, soft_limit: int = 200, hard_limit: int = 1000,
+                               grace_seconds: float = 30.0, sweep_seconds: float = 1.0) -> None:
+        """Выше soft_limit пакетов в очереди — отбрасываются второстепенные события,
+        выше hard_limit — все; дольше grace_seconds выше soft_limit — отключение"""
+        self._soft_limit = int(soft_limit)
+        self._hard_limit = max(int(hard_limit), self._soft_limit)
+        self._grace_seconds = float(grace_seconds)
+        self._sweep_seconds = float(sweep_seconds)
+        self._backpressure_lock = threading.Lock()
+        # eio_sid -> (с какого момента выше soft_limit, sid, namespace)
+        self._over_since: Dict[str, Tuple[float, str, str]] = {}
+        # eio_sid -> {event: (namespace, data)} — отложенные слитые события
+        self._deferred: Dict[str, Dict[str, Tuple[str, Any]]] = {}
+        metrics.register_collector('socket_backpressure', self.backpressure_stats)
+
+    def backpressure_stats(self) -> Dict[str, Any]:
+        """Медленные сокеты и отложенные события для /api/metrics"""
+        with self._backpressure_lock:
+            return {
+                'slow_sockets': len(self._over_since),
+                'deferred_events': sum(len(events) for events in self._deferred.values()),
+                'soft_limit': self._soft_limit,
+                'hard_limit': self._hard_limit,
+            }
+
+    def initialize(self):
+        super().initialize()
+        self.server.start_background_task(self._backpressure_loop)
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, **kwargs):
+        if isinstance(self, socketio.PubSubManager) and not kwargs.get('ignore_queue'):
+            # Публикация в очередь; локальная доставка — в _handle_emit
+            return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid,
+                                callback=callback, **kwargs)
+        return self._emit_local(event, data, namespace or '/', room, skip_sid, callback)
+
+    def _handle_emit(self, message):
+        remote_callback = message.get('callback')
+        if remote_callback is not None and len(remote_callback) == 3:
+            callback = partial(self._return_callback, message.get('host_id'), *remote_callback)
+        else:
+            callback = None
+        self._emit_local(message['event'], message['data'], message.get('namespace') or '/',
+                         message.get('room'), message.get('skip_sid'), callback)
+
+    def _emit_local(self, event, data, namespace, room=None, skip_sid=None, callback=None) -> None:
+        """Доставка локальным участникам с проверкой очереди каждого из них"""
+        if namespace not in self.rooms:
+            return
+        if not isinstance(skip_sid, list):
+            skip_sid = [skip_sid]
+        for sid, eio_sid in self.get_participants(namespace, room):
+            if sid in skip_sid:
+                continue
+            admitted, payload = self._admit(sid, eio_sid, namespace, event, data)
+            if not admitted:
+                continue
+            id = self._generate_ack_id(sid, callback) if callback is not None else None
+            self.server._emit_internal(eio_sid, event, payload, namespace, id)
+
+    def _queue_depth(self, eio_sid: str) -> Optional[int]:
+        eio_socket = self.server.eio.sockets.get(eio_sid)
+        if eio_socket is None or eio_socket.closed:
+            return None
+        return eio_socket.queue.qsize()
+
+    def _admit(self, sid: str, eio_sid: str, namespace: str, event: str, data: Any) -> Tuple[bool, Any]:
+        """(можно ли поставить событие в очередь сокета сейчас, данные для отправки)"""
+        depth = self._queue_depth(eio_sid)
+        if depth is None or depth < self._soft_limit:
+            if eio_sid in self._over_since or eio_sid in self._deferred:
+                self._recover(eio_sid)
+            return True, data
+
+        with self._backpressure_lock:
+            self._over_since.setdefault(eio_sid, (time.monotonic(), sid, namespace))
+        if event != self.BATCH_EVENT or not isinstance(data, dict):
+            return self._admit_over_limit(eio_sid, namespace, event, data, depth), data
+        # Кадр общий для всех адресатов: отфильтрованный список собирается заново
+        events = [item for item in data.get('events', [])
+                  if self._admit_over_limit(eio_sid, namespace, item.get('event'), item.get('data'), depth)]
+        if not events:
+            return False, data
+        return True, {**data, 'events': events}
+
+    def _admit_over_limit(self, eio_sid: str, namespace: str, event: str, data: Any, depth: int) -> bool:
+        """Очередь выше soft_limit: событие откладывается, отбрасывается или все же отправляется"""
+        if event in self.COALESCED_EVENTS:
+            with self._backpressure_lock:
+                self._defer(eio_sid, namespace, event, data)
+            metrics.incr('backpressure.coalesced')
+            return False
+        if event in self.DROPPABLE_EVENTS or depth >= self._hard_limit:
+            metrics.incr('backpressure.dropped')
+            metrics.incr(f'backpressure.dropped.{event}')
+            return False
+        return True
+
+    def _defer(self, eio_sid: str, namespace: str, event: str, data: Any) -> None:
+        deferred = self._deferred.setdefault(eio_sid, {})
+        previous = deferred.get(event)
+        if event == 'presence_delta' and previous is not None:
+            # Изменения статуса сливаются по пользователю: последнее побеждает
+            changes = {change['user_id']: change for change in previous[1].get('changes', [])}
+            changes.update((change['user_id'], change) for change in data.get('changes', []))
+            data = {'changes': list(changes.values())}
+        deferred[event] = (namespace, data)
+
+    def _recover(self, eio_sid: str) -> None:
+        """Очередь разгрузилась: снимаем отметку и отправляем отложенные события"""
+        with self._backpressure_lock:
+            self._over_since.pop(eio_sid, None)
+            deferred = self._deferred.pop(eio_sid, {})
+        for event, (namespace, data) in deferred.items():
+            self.server._emit_internal(eio_sid, event, data, namespace, None)
+        if deferred:
+            metrics.incr('backpressure.deferred_sent', len(deferred))
+
+    def sweep_backpressure(self) -> int:
+        """Отправляет отложенное разгрузившимся сокетам и отключает медленные; возвращает число отключенных"""
+        now = time.monotonic()
+        with self._backpressure_lock:
+            watched = list(self._over_since.items())
+        evicted = 0
+        for eio_sid, (since, sid, namespace) in watched:
+            depth = self._queue_depth(eio_sid)
+            if depth is None:
+                with self._backpressure_lock:
+                    self._over_since.pop(eio_sid, None)
+                    self._deferred.pop(eio_sid, None)
+            elif depth < self._soft_limit:
+                self._recover(eio_sid)
+            elif now - since >= self._grace_seconds:
+                self._evict(eio_sid, sid, depth)
+                evicted += 1
+        return evicted
+
+    def _evict(self, eio_sid: str, sid: str, depth: int) -> None:
+        with self._backpressure_lock:
+            self._over_since.pop(eio_sid, None)
+            self._deferred.pop(eio_sid, None)
+        self._get_logger().warning(f"Медленный клиент {sid}: {depth} пакетов в очереди, отключаем")
+        metrics.incr('backpressure.evicted')
+        eio_socket = self.server.eio.sockets.get(eio_sid)
+        if eio_socket is not None:
+            # abort: очередь не разгружается, поэтому не ждем отправки CLOSE; обработчики disconnect сработают
+            eio_socket.close(wait=False, abort=True)
+
+    def _backpressure_loop(self) -> None:
+        while True:
+            self.server.sleep(self._sweep_seconds)
+            try:
+                self.sweep_backpressure()
+            except Exception as e:
+                self._get_logger().error(f"Ошибка проверки медленных клиентов: {e}")
+
+
+def with_backpressure(manager_class):
+    """Класс менеджера клиентов с BackpressureMixin поверх manager_class"""
+    return type(f"Backpressure{manager_class.__name__}", (BackpressureMixin, manager_class), {})
@@ -0,0 +1,119 @@
+"""
+Circuit breaker для Redis: пока Redis недоступен, менеджеры состояния сразу идут в память
+"""
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+from app.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Разомкнутый после серии ошибок выключатель с пробой в полуоткрытом состоянии"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._client: Any = None
+        self._recovery_listeners: List[Callable[[Any], None]] = []
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def configure(self, failure_threshold: Optional[int] = None,
+                  recovery_timeout: Optional[float] = None) -> None:
+        """Применяет настройки из конфига"""
+        if failure_threshold is not None:
+            self.failure_threshold = max(1, int(failure_threshold))
+        if recovery_timeout is not None:
+            self.recovery_timeout = max(0.0, float(recovery_timeout))
+
+    def bind(self, client: Any) -> None:
+        """Привязывает клиент; смена клиента сбрасывает состояние"""
+        if client is not self._client:
+            with self._lock:
+                self._client = client
+                self._state = self.CLOSED
+                self._failures = 0
+
+    def reset(self) -> None:
+        """Замыкает выключатель (для тестов)"""
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def add_recovery_listener(self, listener: Callable[[Any], None]) -> None:
+        """Регистрирует функцию, вызываемую с клиентом при восстановлении (до замыкания)"""
+        self._recovery_listeners.append(listener)
+
+    def allow_request(self) -> bool:
+        """Можно ли сейчас обращаться к Redis; при истекшем таймауте проводит пробу"""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            # Пока идет проба или не истек таймаут — сразу в память, без ожидания соединения
+            if self._state == self.HALF_OPEN or time.monotonic() - self._opened_at < self.recovery_timeout:
+                metrics.incr(f'{self.name}_breaker.short_circuited')
+                return False
+            self._state = self.HALF_OPEN
+            client = self._client
+        return self._probe(client)
+
+    def _probe(self, client: Any) -> bool:
+        """Единственная проба: PING и сверка накопленного в памяти состояния"""
+        try:
+            client.ping()
+            for listener in self._recovery_listeners:
+                listener(client)
+        except Exception as e:
+            logger.warning(f"{self.name}: проба не удалась, выключатель остается разомкнутым: {e}")
+            with self._lock:
+                self._open()
+            return False
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+        metrics.incr(f'{self.name}_breaker.recovered')
+        logger.info(f"{self.name}: соединение восстановлено, состояние сверено")
+        return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._state == self.CLOSED:
+                self._failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            if self._state != self.CLOSED:
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._open()
+                logger.warning(f"{self.name}: {self._failures} ошибок подряд, выключатель разомкнут")
+
+    def _open(self) -> None:
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._failures = 0
+        metrics.incr(f'{self.name}_breaker.opened')
+
+    def stats(self) -> Dict[str, Any]:
+        """Текущее состояние для /api/metrics"""
+        return {'state': self._state, 'failures': self._failures}
+
+
+# Общий выключатель для всех менеджеров состояния
+redis_breaker = CircuitBreaker('redis')
+metrics.register_collector('redis_breaker', redis_breaker.stats)
@@ -0,0 +1,15 @@
+"""
+CLI-команды приложения (flask <команда>)
+"""
+import click
+
+
+def register_commands(app):
+    """Регистрирует CLI-команды обслуживания"""
+
+    @app.cli.command('rebuild-conversations')
+    def rebuild_conversations():
+        """Пересобирает сводки личных диалогов из таблицы message"""
+        from app.services.conversation_service import ConversationService
+        count = ConversationService.rebuild()
+        click.echo(f"Сводок диалогов: {count}")
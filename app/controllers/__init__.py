@@ -4,9 +4,11 @@ HTTP контроллеры для API endpoints
 from .message_controller import MessageController
 from .room_controller import RoomController
 from .user_controller import UserController
+from .metrics_controller import MetricsController
 
 __all__ = [
     'MessageController',
     'RoomController',
-    'UserController'
+    'UserController',
+    'MetricsController'
 ]
@@ -5,6 +5,7 @@ from typing import Dict, Any
 from flask import Blueprint, request, jsonify, current_app
 from flask_login import login_required, current_user
 from app.services import MessageService, RoomService, UserService
+from app.services.message_serializer import message_serializer
 
 
 class MessageController:
@@ -27,9 +28,11 @@ class MessageController:
                 if not room:
                     return jsonify({'error': 'Комната не найдена'}), 404
                 
-                # Получаем параметры пагинации
+                # Получаем параметры пагинации: курсор before_id/before_ts (offset — устаревший)
                 limit = request.args.get('limit', 20, type=int)
                 offset = request.args.get('offset', 0, type=int)
+                before_id = request.args.get('before_id', type=int)
+                before_ts = request.args.get('before_ts')
                 
                 # Валидация параметров
                 if limit > 100:
@@ -38,14 +41,18 @@ class MessageController:
                     offset = 0
                 
                 # Получаем сообщения
-                messages = MessageService.get_room_messages(room_id, limit, offset)
-                
-                return jsonify({
-                    'messages': messages,
-                    'room_id': room_id,
-                    'limit': limit,
-                    'offset': offset
-                })
+                messages = MessageService.get_room_messages(room_id, limit, offset,
+                                                            before_id=before_id, before_ts=before_ts)
+                
+                # Сообщения вставляются в ответ готовыми JSON-байтами из кэша сериализатора
+                return message_serializer.json_response(
+                    messages,
+                    room_id=room_id,
+                    limit=limit,
+                    offset=offset,
+                    next_cursor=MessageService.history_cursor(messages),
+                    has_more=len(messages) == limit
+                )
                 
             except Exception as e:
                 current_app.logger.error(f"Error getting room messages: {e}")
@@ -65,20 +72,26 @@ class MessageController:
                 limit = request.args.get('limit', 50, type=int)
                 if limit > 100:
                     limit = 100
+                before_id = request.args.get('before_id', type=int)
+                before_ts = request.args.get('before_ts')
                 
                 # Получаем сообщения
                 messages = MessageService.get_dm_messages(
                     current_user.id, 
                     recipient_id, 
-                    limit
+                    limit,
+                    before_id=before_id,
+                    before_ts=before_ts
                 )
                 
-                return jsonify({
-                    'messages': messages,
-                    'recipient_id': recipient_id,
-                    'recipient_username': recipient.username,
-                    'limit': limit
-                })
+                return message_serializer.json_response(
+                    messages,
+                    recipient_id=recipient_id,
+                    recipient_username=recipient.username,
+                    limit=limit,
+                    next_cursor=MessageService.history_cursor(messages),
+                    has_more=len(messages) == limit
+                )
                 
             except Exception as e:
                 current_app.logger.error(f"Error getting DM messages: {e}")
@@ -0,0 +1,28 @@
+"""
+HTTP контроллер для метрик приложения
+"""
+from flask import Blueprint, jsonify, current_app
+from flask_login import login_required
+from app.metrics import metrics
+
+
+class MetricsController:
+    """HTTP контроллер для метрик"""
+    
+    def __init__(self):
+        self.bp = Blueprint('metrics', __name__, url_prefix='/api/metrics')
+        self._register_routes()
+    
+    def _register_routes(self):
+        """Регистрирует маршруты"""
+        
+        @self.bp.route('/', methods=['GET'])
+        @login_required
+        def get_metrics():
+            """Возвращает снимок счетчиков и gauge (утилизация пула Redis и т.д.)"""
+            try:
+                return jsonify(metrics.snapshot())
+                
+            except Exception as e:
+                current_app.logger.error(f"Error getting metrics: {e}")
+                return jsonify({'error': 'Внутренняя ошибка сервера'}), 500
@@ -20,10 +20,21 @@ class RoomController:
         @self.bp.route('/', methods=['GET'])
         @login_required
         def get_all_rooms():
-            """Получает список всех комнат"""
+            """Получает список комнат постранично: ?limit=&after=<имя последней комнаты>&prefix="""
             try:
-                rooms = RoomService.get_all_rooms()
-                return jsonify({'rooms': rooms})
+                limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+                after = request.args.get('after') or None
+                prefix = request.args.get('prefix') or None
+                
+                # Берем на одну запись больше, чтобы узнать, есть ли следующая страница
+                rooms = RoomService.get_all_rooms(limit=limit + 1, after=after, prefix=prefix)
+                has_more = len(rooms) > limit
+                rooms = rooms[:limit]
+                return jsonify({
+                    'rooms': rooms,
+                    'next_cursor': rooms[-1]['name'] if has_more else None,
+                    'has_more': has_more
+                })
                 
             except Exception as e:
                 current_app.logger.error(f"Error getting all rooms: {e}")
@@ -34,18 +45,11 @@ class RoomController:
         def get_room(room_id: int):
             """Получает информацию о комнате"""
             try:
-                room = RoomService.get_room_by_id(room_id)
+                room = RoomService.get_room_summary(room_id=room_id)
                 if not room:
                     return jsonify({'error': 'Комната не найдена'}), 404
                 
-                return jsonify({
-                    'id': room.id,
-                    'name': room.name,
-                    'created_by': room.created_by,  # ИСПРАВЛЕНО: используем created_by
-                    'creator_username': room.creator_obj.username if room.creator_obj else 'Unknown',  # ИСПРАВЛЕНО: используем creator_obj
-                    'is_private': room.is_private,
-                    'created_at': room.created_at.isoformat() if room.created_at else None
-                })
+                return jsonify(room)
                 
             except Exception as e:
                 current_app.logger.error(f"Error getting room: {e}")
@@ -56,18 +60,11 @@ class RoomController:
         def get_room_by_name(room_name: str):
             """Получает информацию о комнате по имени"""
             try:
-                room = RoomService.get_room_by_name(room_name)
+                room = RoomService.get_room_summary(name=room_name)
                 if not room:
                     return jsonify({'error': 'Комната не найдена'}), 404
                 
-                return jsonify({
-                    'id': room.id,
-                    'name': room.name,
-                    'created_by': room.created_by,  # ИСПРАВЛЕНО: используем created_by
-                    'creator_username': room.creator_obj.username if room.creator_obj else 'Unknown',  # ИСПРАВЛЕНО: используем creator_obj
-                    'is_private': room.is_private,
-                    'created_at': room.created_at.isoformat() if room.created_at else None
-                })
+                return jsonify(room)
                 
             except Exception as e:
                 current_app.logger.error(f"Error getting room by name: {e}")
@@ -102,7 +99,7 @@ class RoomController:
                         'name': room.name,
                         'created_by': room.created_by,  # ИСПРАВЛЕНО: используем created_by
                         'is_private': room.is_private,
-                        'created_at': room.created_at.isoformat() if room.created_at else None
+                        'created_at': room.created_at
                     }), 201
                 else:
                     return jsonify({'error': 'Не удалось создать комнату'}), 400
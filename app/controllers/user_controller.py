@@ -43,8 +43,7 @@ class UserController:
                 return jsonify({
                     'id': user.id,
                     'username': user.username,
-                    'online': user.online,
-                    'last_seen': user.last_seen.isoformat() if user.last_seen else None
+                    **UserService.get_presence(user)
                 })
                 
             except Exception as e:
@@ -63,8 +62,7 @@ class UserController:
                 return jsonify({
                     'id': user.id,
                     'username': user.username,
-                    'online': user.online,
-                    'last_seen': user.last_seen.isoformat() if user.last_seen else None
+                    **UserService.get_presence(user)
                 })
                 
             except Exception as e:
@@ -91,8 +89,25 @@ class UserController:
         def get_dm_conversations():
             """Получает список диалогов пользователя"""
             try:
-                conversations = UserService.get_dm_conversations(current_user.id)
-                return jsonify({'conversations': conversations})
+                # Пагинация курсором по последнему сообщению диалога
+                limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+                before_id = request.args.get('before_id', type=int)
+                before_ts = request.args.get('before_ts')
+                
+                conversations = UserService.get_dm_conversations(
+                    current_user.id, limit, before_id=before_id, before_ts=before_ts
+                )
+                next_cursor = {'before_id': None, 'before_ts': None}
+                if conversations:
+                    next_cursor = {
+                        'before_id': conversations[-1]['last_message_id'],
+                        'before_ts': conversations[-1]['last_message_time']
+                    }
+                return jsonify({
+                    'conversations': conversations,
+                    'next_cursor': next_cursor,
+                    'has_more': len(conversations) == limit
+                })
                 
             except Exception as e:
                 current_app.logger.error(f"Error getting DM conversations: {e}")
@@ -0,0 +1,99 @@
+"""
+JSON для Flask и Socket.IO: orjson, если установлен, иначе стандартный json
+"""
+import dataclasses
+import decimal
+import json
+import uuid
+from datetime import date, datetime, time
+from typing import Any
+from flask.json.provider import JSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - зависит от окружения
+    orjson = None
+
+BACKENDS = ('orjson', 'stdlib')
+
+
+def _default(obj: Any) -> Any:
+    """Типы, которые не кодируются напрямую (даты — в ISO 8601, как у orjson)"""
+    if isinstance(obj, (datetime, date, time)):
+        return obj.isoformat()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    if hasattr(obj, '__html__'):
+        return str(obj.__html__())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JSONCodec:
+    """dumps/loads с интерфейсом модуля json (python-socketio принимает такой объект в json=)"""
+
+    def __init__(self, backend: str = 'orjson'):
+        if backend not in BACKENDS:
+            raise ValueError(f"Неизвестный JSON backend: {backend}")
+        # Без установленного orjson тихо откатываемся на stdlib
+        self.backend = backend if backend != 'orjson' or orjson is not None else 'stdlib'
+
+    def dumps_bytes(self, obj: Any, sort_keys: bool = False) -> bytes:
+        if self.backend == 'orjson':
+            option = orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=_default, option=option)
+        return json.dumps(obj, default=_default, ensure_ascii=False, sort_keys=sort_keys,
+                          separators=(',', ':')).encode('utf-8')
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        # separators/indent и прочие параметры stdlib игнорируются: вывод всегда компактный
+        return self.dumps_bytes(obj, sort_keys=bool(kwargs.get('sort_keys'))).decode('utf-8')
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        if self.backend == 'orjson':
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+
+class FastJSONProvider(JSONProvider):
+    """JSON-провайдер Flask (app.json) поверх JSONCodec"""
+
+    sort_keys = False
+    mimetype = 'application/json'
+
+    def __init__(self, app, backend: str = 'orjson'):
+        super().__init__(app)
+        self.codec = JSONCodec(backend)
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        kwargs.setdefault('sort_keys', self.sort_keys)
+        return self.codec.dumps(obj, **kwargs)
+
+    def loads(self, s: Any, **kwargs: Any) -> Any:
+        return self.codec.loads(s, **kwargs)
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        # Байты отдаются в ответ без промежуточной строки
+        return self._app.response_class(self.codec.dumps_bytes(obj, sort_keys=self.sort_keys),
+                                        mimetype=self.mimetype)
+
+
+# Кодек по умолчанию до create_app (сериализатор сообщений и т.п.)
+codec = JSONCodec()
+
+
+def init_app(app) -> JSONCodec:
+    """Настраивает app.json по JSON_BACKEND и возвращает кодек для Socket.IO"""
+    global codec
+    provider = FastJSONProvider(app, app.config.get('JSON_BACKEND', 'orjson'))
+    provider.sort_keys = bool(app.config.get('JSON_SORT_KEYS', False))
+    app.json = provider
+    codec = provider.codec
+    app.logger.info(f"JSON backend: {codec.backend}")
+    return codec
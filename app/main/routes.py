@@ -6,6 +6,8 @@ from app.main.forms import ProfileUserForm
 from app.models import User, Message
 from app.schemas import GeoWeatherResponse
 from app.extensions import db, socketio
+from app.services.identity_cache import identity_cache
+from app.services.message_service import MessageService
 from config import WEATHER_API_KEY
 
 main_bp = Blueprint('main', __name__)
@@ -45,24 +47,33 @@ def profile(username):
     """
         Представление отображающее профиль пользователя
     """
-    form = ProfileUserForm(obj=current_user)  # Автозаполнение формы
+    # current_user — снимок из кэша личности; для редактирования нужна ORM-строка
+    user = db.session.get(User, current_user.id)
+    if user is None:
+        abort(404)
+    form = ProfileUserForm(obj=user)  # Автозаполнение формы
     if form.validate_on_submit():
         changes = False
-        if current_user.username != form.username.data:
-            current_user.username = form.username.data
+        renamed = user.username != form.username.data
+        if renamed:
+            user.username = form.username.data
             changes = True
-        if current_user.email != form.email.data:
-            current_user.email = form.email.data
+        if user.email != form.email.data:
+            user.email = form.email.data
             changes = True
         if changes:
             db.session.commit()  # Один запрос для всех изменений
+            identity_cache.invalidate(user.id)
+            if renamed:
+                # Имя отправителя зашито в кэшированные сообщения и буферы последних сообщений комнат
+                MessageService.forget_sender(user.id)
             flash('Ваш профиль обновлен!', 'success')
-            return redirect(url_for('main.profile', username=current_user.username))
+            return redirect(url_for('main.profile', username=user.username))
     data = {
-        'username': current_user.username,
-        'id': current_user.id,
-        'email': current_user.email,
-        'password_hash': current_user.password_hash,
+        'username': user.username,
+        'id': user.id,
+        'email': user.email,
+        'password_hash': user.password_hash,
     }
     return render_template('profile.html', data=data, form=form, )
 
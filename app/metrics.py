@@ -0,0 +1,52 @@
+"""
+Простой in-process реестр метрик (счетчики и вычисляемые gauge)
+"""
+import threading
+from typing import Any, Callable, Dict
+
+
+class MetricsRegistry:
+    """Потокобезопасный реестр счетчиков и коллекторов"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._collectors: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def incr(self, name: str, value: float = 1) -> None:
+        """Увеличивает счетчик"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe_max(self, name: str, value: float) -> None:
+        """Запоминает максимальное наблюдавшееся значение"""
+        with self._lock:
+            if value > self._counters.get(name, 0):
+                self._counters[name] = value
+
+    def register_collector(self, name: str, collector: Callable[[], Dict[str, Any]]) -> None:
+        """Регистрирует функцию, вычисляющую группу gauge в момент снятия снимка"""
+        with self._lock:
+            self._collectors[name] = collector
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Возвращает текущие значения всех метрик"""
+        with self._lock:
+            counters = dict(self._counters)
+            collectors = dict(self._collectors)
+        gauges = {}
+        for name, collector in collectors.items():
+            try:
+                gauges[name] = collector()
+            except Exception as e:
+                gauges[name] = {'error': str(e)}
+        return {'counters': counters, 'gauges': gauges}
+
+    def reset(self) -> None:
+        """Сбрасывает счетчики (для тестов)"""
+        with self._lock:
+            self._counters.clear()
+
+
+# Глобальный реестр
+metrics = MetricsRegistry()
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from app.extensions import db, login_manager
 from flask_login import UserMixin, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -56,16 +56,6 @@ class User(UserMixin, db.Model):
         self.last_seen = datetime.utcnow()
         db.session.commit()
 
-    @classmethod
-    def get_online_users(cls, room: Optional[str] = None) -> Dict[int, str]:
-        """Возвращает словарь {id: username} активных пользователей"""
-        # Оптимизированный запрос - выбираем только нужные поля
-        query = cls.query.with_entities(cls.id, cls.username).filter_by(online=True)
-        if room:
-            # Если нужна фильтрация по комнате (для будущего расширения)
-            pass
-        return dict(query.all())
-
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -111,16 +101,11 @@ class Message(db.Model):
 
     def to_dict(self) -> Dict[str, any]:
         """Преобразует сообщение в словарь для отправки через Socket.IO"""
+        from app.services.message_serializer import message_serializer
+        # Неизменяемая часть берется из канонического (кэшируемого) словаря
         return {
-            'id': self.id,
-            'content': self.content,
-            'timestamp': self.timestamp.isoformat(),
-            'sender_id': self.sender_id,
-            'sender_username': self.sender.username if self.sender else 'Unknown',
-            'recipient_id': self.recipient_id,
-            'room_id': self.room_id,
+            **message_serializer.payload(self),
             'room_name': self.room.name if self.room else None,  # Используем имя комнаты из модели
-            'is_dm': self.is_dm,
             'is_read': self.is_read,
         }
 
@@ -137,6 +122,34 @@ class UnreadMessage(db.Model):
     message = db.relationship('Message', back_populates='read_statuses')
 
 
+class Conversation(db.Model):
+    """Сводка личного диалога пары пользователей (user_a_id < user_b_id), обновляется при записи"""
+    __tablename__ = 'conversation'
+
+    user_a_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    user_b_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    last_message_id = db.Column(db.Integer, nullable=True)
+    last_message_preview = db.Column(db.String(200), nullable=True)
+    last_message_at = db.Column(db.DateTime, nullable=True)
+    # Непрочитанные входящие для каждой стороны
+    unread_a = db.Column(db.Integer, default=0, nullable=False)
+    unread_b = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        # Список диалогов пользователя по времени последнего сообщения — с любой стороны пары
+        db.Index('ix_conversation_a_last', 'user_a_id', 'last_message_at'),
+        db.Index('ix_conversation_b_last', 'user_b_id', 'last_message_at'),
+    )
+
+    @staticmethod
+    def pair(user_id: int, other_id: int) -> Tuple[int, int]:
+        """Упорядоченный ключ пары"""
+        return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+    def __repr__(self) -> str:
+        return f'<Conversation {self.user_a_id}-{self.user_b_id}>'
+
+
 class Room(db.Model):
     __tablename__ = 'room'
 
@@ -170,10 +183,11 @@ class Room(db.Model):
 
 @login_manager.user_loader
 def load_user(user_id: str) -> Optional[User]:
-    """Загрузка пользователя для Flask-Login"""
+    """Загрузка пользователя для Flask-Login: снимок из кэша личности, БД — только при промахе"""
     if not user_id or not user_id.isdigit():
         return None
+    from app.services.identity_cache import identity_cache
     try:
-        return User.query.get(int(user_id))
+        return identity_cache.get(int(user_id))
     except (TypeError, ValueError):
         return None
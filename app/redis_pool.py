@@ -0,0 +1,76 @@
+"""
+Создание Redis клиента поверх настраиваемого BlockingConnectionPool
+"""
+import time
+from typing import Any, Dict, Optional
+from app.metrics import metrics
+
+try:
+    import redis as _redis
+except Exception:  # redis may not be installed in some envs
+    _redis = None  # type: ignore
+
+
+if _redis is not None:
+    class InstrumentedBlockingConnectionPool(_redis.BlockingConnectionPool):
+        """BlockingConnectionPool, считающий ожидания и исчерпания пула"""
+
+        def get_connection(self, command_name, *keys, **options):
+            started = time.monotonic()
+            try:
+                return super().get_connection(command_name, *keys, **options)
+            except _redis.exceptions.ConnectionError as e:
+                if 'No connection available' in str(e):
+                    metrics.incr('redis_pool.exhausted')
+                raise
+            finally:
+                waited = time.monotonic() - started
+                metrics.incr('redis_pool.checkouts')
+                metrics.incr('redis_pool.wait_seconds_total', waited)
+                metrics.observe_max('redis_pool.wait_seconds_max', waited)
+
+        def stats(self) -> Dict[str, Any]:
+            """Текущая утилизация пула"""
+            created = len(self._connections)
+            idle = sum(1 for conn in list(self.pool.queue) if conn is not None)
+            in_use = created - idle
+            return {
+                'max_connections': self.max_connections,
+                'created': created,
+                'idle': idle,
+                'in_use': in_use,
+                'utilisation': round(in_use / self.max_connections, 3) if self.max_connections else 0.0,
+            }
+
+
+def create_redis_client(config: Dict[str, Any]) -> Optional["_redis.Redis"]:
+    """Создает Redis клиент с пулом соединений по настройкам REDIS_* из конфига"""
+    redis_url = config.get('REDIS_URL')
+    if not redis_url or _redis is None:
+        return None
+
+    pool = InstrumentedBlockingConnectionPool.from_url(
+        redis_url,
+        # decode_responses=True -> строки, а не bytes
+        decode_responses=True,
+        max_connections=int(config.get('REDIS_MAX_CONNECTIONS', 50)),
+        # Сколько ждать свободное соединение, прежде чем считать пул исчерпанным
+        timeout=float(config.get('REDIS_POOL_TIMEOUT', 5)),
+        socket_timeout=float(config.get('REDIS_SOCKET_TIMEOUT', 5)),
+        socket_connect_timeout=float(config.get('REDIS_SOCKET_CONNECT_TIMEOUT', 2)),
+        socket_keepalive=bool(config.get('REDIS_SOCKET_KEEPALIVE', True)),
+        health_check_interval=int(config.get('REDIS_HEALTH_CHECK_INTERVAL', 30)),
+    )
+    metrics.register_collector('redis_pool', pool.stats)
+    return _redis.Redis(connection_pool=pool)
+
+
+def get_pool_stats(client: Optional["_redis.Redis"] = None) -> Dict[str, Any]:
+    """Возвращает утилизацию пула текущего (или переданного) клиента"""
+    if client is None:
+        from app import extensions
+        client = extensions.redis_client
+    pool = getattr(client, 'connection_pool', None)
+    if pool is None or not hasattr(pool, 'stats'):
+        return {}
+    return pool.stats()
@@ -0,0 +1,169 @@
+"""
+Межпроцессная рассылка Socket.IO по каналам комнат: воркер подписан только на комнаты,
+в которых есть его локальные сокеты, и не получает emit'ы чужих комнат
+"""
+import logging
+import pickle
+import re
+import threading
+import time
+from typing import List, Optional, Set, Tuple
+import socketio
+from app.metrics import metrics
+
+try:
+    import redis as _redis
+except Exception:  # redis may not be installed in some envs
+    _redis = None  # type: ignore
+
+logger = logging.getLogger('socketio')
+
+
+class ShardedRedisManager(socketio.RedisManager):
+    """RedisManager с каналом на комнату; общий канал — для broadcast, disconnect и callback"""
+
+    name = 'sharded-redis'
+    # Комната сокета (sid) — 20 символов base64 от engine.io; такие комнаты идут через общий канал
+    _SID_ROOM = re.compile(r'^[A-Za-z0-9_-]{20}$')
+    # Как часто слушатель применяет изменения подписок, если сообщений нет
+    _POLL_SECONDS = 0.1
+
+    def __init__(self, url: str = 'redis://localhost:6379/0', channel: str = 'flask-socketio',
+                 write_only: bool = False, logger=None, redis_options=None):
+        # Реестр локальных подписок: каналы комнат, в которых есть сокеты этого воркера
+        self._room_channels: Set[str] = set()
+        # SUBSCRIBE/UNSUBSCRIBE, ожидающие слушателя: соединение pubsub используется только из него
+        self._subscription_ops: List[Tuple[str, str]] = []
+        self._subscribe_lock = threading.Lock()
+        super().__init__(url, channel=channel, write_only=write_only, logger=logger,
+                         redis_options=redis_options)
+
+    def room_channel(self, namespace: Optional[str], room: str) -> str:
+        return f"{self.channel}:room:{namespace or '/'}:{room}"
+
+    def _is_sid_room(self, room) -> bool:
+        """Комната одного сокета: канал на каждое соединение не заводим.
+        Комната чата с похожим именем тоже пойдет через общий канал — это лишь дороже, но не ошибка"""
+        return not isinstance(room, str) or bool(self._SID_ROOM.match(room))
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, **kwargs):
+        """Emit в одну комнату публикуется в ее канал; sid, broadcast и остальное — в общий"""
+        if kwargs.get('ignore_queue') or room is None or self._is_sid_room(room):
+            return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid,
+                                callback=callback, **kwargs)
+        namespace = namespace or '/'
+        if callback is not None:
+            if self.server is None:
+                raise RuntimeError('Callbacks can only be issued from the context of a server.')
+            callback = (room, namespace, self._generate_ack_id(room, callback))
+        self._publish({'method': 'emit', 'event': event, 'data': data,
+                       'namespace': namespace, 'room': room,
+                       'skip_sid': skip_sid, 'callback': callback,
+                       'host_id': self.host_id}, channel=self.room_channel(namespace, room))
+        metrics.incr('pubsub.room_published')
+
+    def enter_room(self, sid, namespace, room, eio_sid=None):
+        first = room is not None and room not in self.rooms.get(namespace, {})
+        super().enter_room(sid, namespace, room, eio_sid=eio_sid)
+        if first and not self._is_sid_room(room):
+            self._subscribe(self.room_channel(namespace, room))
+
+    def leave_room(self, sid, namespace, room):
+        super().leave_room(sid, namespace, room)
+        if room is not None and not self._is_sid_room(room) and room not in self.rooms.get(namespace, {}):
+            self._unsubscribe(self.room_channel(namespace, room))
+
+    def _subscribe(self, channel: str) -> None:
+        if self.write_only:
+            return
+        with self._subscribe_lock:
+            if channel in self._room_channels:
+                return
+            self._room_channels.add(channel)
+            self._subscription_ops.append(('subscribe', channel))
+        metrics.incr('pubsub.room_subscribed')
+
+    def _unsubscribe(self, channel: str) -> None:
+        if self.write_only:
+            return
+        with self._subscribe_lock:
+            if channel not in self._room_channels:
+                return
+            self._room_channels.discard(channel)
+            self._subscription_ops.append(('unsubscribe', channel))
+        metrics.incr('pubsub.room_unsubscribed')
+
+    def _apply_subscriptions(self) -> None:
+        """Отправляет накопленные изменения подписок; вызывается только из слушателя"""
+        with self._subscribe_lock:
+            ops, self._subscription_ops = self._subscription_ops, []
+        for op, channel in ops:
+            if op == 'subscribe':
+                self.pubsub.subscribe(channel)
+            else:
+                self.pubsub.unsubscribe(channel)
+
+    def subscribed_rooms(self) -> Set[str]:
+        """Каналы комнат, на которые подписан воркер"""
+        with self._subscribe_lock:
+            return set(self._room_channels)
+
+    def _publish(self, data, channel: Optional[str] = None):
+        channel = channel or self.channel
+        retry = True
+        while True:
+            try:
+                if not retry:
+                    self._redis_connect()
+                return self.redis.publish(channel, pickle.dumps(data))
+            except _redis.exceptions.RedisError:
+                if retry:
+                    logger.error('Cannot publish to redis... retrying')
+                    retry = False
+                else:
+                    logger.error('Cannot publish to redis... giving up')
+                    break
+
+    def _subscribe_all(self) -> None:
+        # Реестр полон: накопленные изменения уже в нем учтены
+        with self._subscribe_lock:
+            channels = set(self._room_channels)
+            self._subscription_ops = []
+        self.pubsub.subscribe(self.channel, *channels)
+
+    def _redis_listen_with_retries(self):
+        retry_sleep = 1
+        connect = False
+        while True:
+            try:
+                if connect:
+                    # Новое соединение: восстанавливаем общий канал и все локальные комнаты
+                    self._redis_connect()
+                    self._subscribe_all()
+                    retry_sleep = 1
+                    connect = False
+                # Чтение с таймаутом вместо listen(): между чтениями применяем подписки,
+                # чтобы соединение pubsub не использовалось из обработчиков параллельно с чтением
+                while True:
+                    self._apply_subscriptions()
+                    message = self.pubsub.get_message(timeout=self._POLL_SECONDS)
+                    if message is not None:
+                        yield message
+            except _redis.exceptions.RedisError:
+                logger.error(f'Cannot receive from redis... retrying in {retry_sleep} secs')
+                connect = True
+                time.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+
+    def _listen(self):
+        base = self.channel.encode('utf-8')
+        prefix = f"{self.channel}:room:".encode('utf-8')
+        self._subscribe_all()
+        for message in self._redis_listen_with_retries():
+            channel = message['channel']
+            if isinstance(channel, str):
+                channel = channel.encode('utf-8')
+            if message['type'] == 'message' and 'data' in message and \
+                    (channel == base or channel.startswith(prefix)):
+                yield message['data']
+        self.pubsub.unsubscribe()
@@ -1,12 +1,14 @@
 """
 Слой сервисов для бизнес-логики приложения
 """
+from .conversation_service import ConversationService
 from .message_service import MessageService
 from .room_service import RoomService
 from .user_service import UserService
 from .websocket_service import WebSocketService
 
 __all__ = [
+    'ConversationService',
     'MessageService',
     'RoomService', 
     'UserService',
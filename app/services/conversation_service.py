@@ -0,0 +1,236 @@
+"""
+Сервис сводок личных диалогов (таблица conversation)
+"""
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from flask import current_app
+from sqlalchemy import and_, case, delete, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from app.extensions import db
+from app.models import Conversation, Message, User
+
+# Длина превью последнего сообщения в списке диалогов
+PREVIEW_LENGTH = 200
+
+
+class ConversationService:
+    """Инкрементальное обслуживание сводок диалогов при записи сообщений"""
+
+    @staticmethod
+    def record_messages(executor, rows: Iterable[Dict[str, Any]]) -> None:
+        """Учитывает новые личные сообщения в той же транзакции (executor — Session или Connection)"""
+        summaries: Dict[Tuple[int, int], Dict[str, Any]] = {}
+        for row in rows:
+            if not row.get('is_dm') or row.get('recipient_id') is None:
+                continue
+            user_a, user_b = Conversation.pair(row['sender_id'], row['recipient_id'])
+            summary = summaries.setdefault((user_a, user_b), {'last': None, 'unread_a': 0, 'unread_b': 0})
+            # Непрочитанное появляется только у получателя (и только если он не успел прочитать до записи)
+            if row.get('is_read'):
+                pass
+            elif row['recipient_id'] == user_a:
+                summary['unread_a'] += 1
+            else:
+                summary['unread_b'] += 1
+            last = summary['last']
+            if last is None or (row['timestamp'], row['id'] or 0) >= (last['timestamp'], last['id'] or 0):
+                summary['last'] = row
+
+        for (user_a, user_b), summary in summaries.items():
+            ConversationService._upsert(executor, user_a, user_b, summary)
+
+    @staticmethod
+    def _upsert(executor, user_a: int, user_b: int, summary: Dict[str, Any]) -> None:
+        table = Conversation.__table__
+        last = summary['last']
+        preview = (last['content'] or '')[:PREVIEW_LENGTH]
+        # Последнее сообщение меняем, только если новое не старше записанного (пачки могут прийти не по порядку)
+        is_newer = or_(table.c.last_message_at.is_(None), table.c.last_message_at <= last['timestamp'])
+        stmt = update(table).where(
+            table.c.user_a_id == user_a, table.c.user_b_id == user_b
+        ).values(
+            unread_a=table.c.unread_a + summary['unread_a'],
+            unread_b=table.c.unread_b + summary['unread_b'],
+            last_message_id=case((is_newer, last['id']), else_=table.c.last_message_id),
+            last_message_preview=case((is_newer, preview), else_=table.c.last_message_preview),
+            last_message_at=case((is_newer, last['timestamp']), else_=table.c.last_message_at),
+        )
+        if executor.execute(stmt).rowcount:
+            return
+        try:
+            with executor.begin_nested():
+                executor.execute(insert(table).values(
+                    user_a_id=user_a,
+                    user_b_id=user_b,
+                    last_message_id=last['id'],
+                    last_message_preview=preview,
+                    last_message_at=last['timestamp'],
+                    unread_a=summary['unread_a'],
+                    unread_b=summary['unread_b'],
+                ))
+        except IntegrityError:
+            # Строку успел создать другой воркер — повторяем инкремент
+            executor.execute(stmt)
+
+    @staticmethod
+    def mark_read(executor, user_id: int, partner_id: int) -> None:
+        """Обнуляет счетчик непрочитанных пользователя в диалоге"""
+        table = Conversation.__table__
+        user_a, user_b = Conversation.pair(user_id, partner_id)
+        column = 'unread_a' if user_id == user_a else 'unread_b'
+        executor.execute(update(table).where(
+            table.c.user_a_id == user_a, table.c.user_b_id == user_b
+        ).values({column: 0}))
+
+    @staticmethod
+    def get_unread_count(user_id: int, partner_id: int) -> int:
+        """Непрочитанные входящие от partner_id (чтение одной строки по первичному ключу)"""
+        user_a, user_b = Conversation.pair(user_id, partner_id)
+        column = Conversation.unread_a if user_id == user_a else Conversation.unread_b
+        value = db.session.query(column).filter(
+            Conversation.user_a_id == user_a, Conversation.user_b_id == user_b
+        ).scalar()
+        return int(value or 0)
+
+    @staticmethod
+    def unread_by_partner(user_id: int) -> Dict[int, int]:
+        """Непрочитанные входящие пользователя по всем собеседникам"""
+        partner_id = case((Conversation.user_a_id == user_id, Conversation.user_b_id),
+                          else_=Conversation.user_a_id)
+        unread = case((Conversation.user_a_id == user_id, Conversation.unread_a),
+                      else_=Conversation.unread_b)
+        rows = db.session.query(partner_id, unread).filter(
+            or_(Conversation.user_a_id == user_id, Conversation.user_b_id == user_id)
+        ).all()
+        return {int(partner): int(count or 0) for partner, count in rows}
+
+    @staticmethod
+    def partners_of(user_ids: Iterable[int]) -> Dict[int, Set[int]]:
+        """Собеседники по личным диалогам для набора пользователей (один запрос)"""
+        user_ids = list(set(user_ids))
+        if not user_ids:
+            return {}
+        rows = db.session.query(Conversation.user_a_id, Conversation.user_b_id).filter(
+            or_(Conversation.user_a_id.in_(user_ids), Conversation.user_b_id.in_(user_ids))
+        ).all()
+        wanted = set(user_ids)
+        partners: Dict[int, Set[int]] = {user_id: set() for user_id in user_ids}
+        for user_a, user_b in rows:
+            if user_a in wanted:
+                partners[user_a].add(user_b)
+            if user_b in wanted:
+                partners[user_b].add(user_a)
+        return partners
+
+    @staticmethod
+    def list_for_user(user_id: int, limit: Optional[int] = 100,
+                      cursor: Optional[Tuple[Any, int]] = None) -> List[Dict[str, Any]]:
+        """Диалоги пользователя по убыванию времени последнего сообщения (даты кодирует JSON-провайдер)"""
+        partner_id = case((Conversation.user_a_id == user_id, Conversation.user_b_id),
+                          else_=Conversation.user_a_id)
+        unread = case((Conversation.user_a_id == user_id, Conversation.unread_a),
+                      else_=Conversation.unread_b)
+        query = db.session.query(
+            partner_id.label('partner_id'),
+            User.username,
+            Conversation.last_message_id,
+            Conversation.last_message_preview,
+            Conversation.last_message_at,
+            unread.label('unread_count'),
+        ).join(User, User.id == partner_id).filter(
+            or_(Conversation.user_a_id == user_id, Conversation.user_b_id == user_id)
+        )
+        if cursor is not None:
+            cursor_ts, cursor_id = cursor
+            query = query.filter(or_(
+                Conversation.last_message_at < cursor_ts,
+                and_(Conversation.last_message_at == cursor_ts, Conversation.last_message_id < cursor_id)
+            ))
+        query = query.order_by(Conversation.last_message_at.desc(), Conversation.last_message_id.desc())
+        if limit:
+            query = query.limit(limit)
+        return [
+            {
+                'user_id': row.partner_id,
+                'username': row.username,
+                'last_message_id': row.last_message_id,
+                'last_message': row.last_message_preview,
+                'last_message_time': row.last_message_at,
+                'unread_count': int(row.unread_count or 0)
+            }
+            for row in query.all()
+        ]
+
+    @staticmethod
+    def apply_pending(user_id: int, conversations: List[Dict[str, Any]], rows: Iterable[Dict[str, Any]],
+                      first_page: bool = True, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Накладывает недописанные личные сообщения процесса (write-behind) на страницу диалогов"""
+        by_partner = {item['user_id']: item for item in conversations}
+        moved: Set[int] = set()
+        for row in sorted(rows, key=lambda row: (row['timestamp'], row['id'] or 0)):
+            partner = row['recipient_id'] if row['sender_id'] == user_id else row['sender_id']
+            item = by_partner.get(partner)
+            if item is None:
+                if not first_page:
+                    # Диалог со свежим сообщением поднимется на первую страницу
+                    continue
+                partner_user = db.session.get(User, partner)
+                if partner_user is None:
+                    continue
+                item = {'user_id': partner, 'username': partner_user.username, 'last_message_id': None,
+                        'last_message': None, 'last_message_time': None, 'unread_count': 0}
+                by_partner[partner] = item
+                conversations.append(item)
+            elif item['last_message_time'] is not None and \
+                    (item['last_message_time'], item['last_message_id'] or 0) >= (row['timestamp'], row['id'] or 0):
+                # Строка уже записана и учтена в сводке
+                continue
+            item['last_message_id'] = row['id']
+            item['last_message'] = (row['content'] or '')[:PREVIEW_LENGTH]
+            item['last_message_time'] = row['timestamp']
+            if row['recipient_id'] == user_id and not row.get('is_read'):
+                item['unread_count'] += 1
+            moved.add(partner)
+        if not first_page:
+            return [item for item in conversations if item['user_id'] not in moved]
+        conversations.sort(key=lambda item: (item['last_message_time'], item['last_message_id'] or 0), reverse=True)
+        return conversations[:limit] if limit else conversations
+
+    @staticmethod
+    def rebuild() -> int:
+        """Пересобирает таблицу conversation из сообщений одним INSERT ... SELECT"""
+        user_a = case((Message.sender_id < Message.recipient_id, Message.sender_id), else_=Message.recipient_id)
+        user_b = case((Message.sender_id < Message.recipient_id, Message.recipient_id), else_=Message.sender_id)
+        pair = (user_a, user_b)
+
+        def unread_for(side):
+            return func.sum(case((and_(Message.recipient_id == side, Message.is_read == False), 1), else_=0))
+
+        ranked = select(
+            user_a.label('user_a_id'),
+            user_b.label('user_b_id'),
+            Message.id.label('last_message_id'),
+            func.substr(Message.content, 1, PREVIEW_LENGTH).label('last_message_preview'),
+            Message.timestamp.label('last_message_at'),
+            unread_for(user_a).over(partition_by=pair).label('unread_a'),
+            unread_for(user_b).over(partition_by=pair).label('unread_b'),
+            func.row_number().over(
+                partition_by=pair,
+                order_by=(Message.timestamp.desc(), Message.id.desc())
+            ).label('rn'),
+        ).where(
+            Message.is_dm == True,
+            Message.recipient_id.isnot(None),
+            Message.sender_id != Message.recipient_id
+        ).subquery()
+
+        columns = ['user_a_id', 'user_b_id', 'last_message_id', 'last_message_preview',
+                   'last_message_at', 'unread_a', 'unread_b']
+        table = Conversation.__table__
+        with db.engine.begin() as conn:
+            conn.execute(delete(table))
+            conn.execute(insert(table).from_select(
+                columns, select(*[ranked.c[name] for name in columns]).where(ranked.c.rn == 1)
+            ))
+            count = conn.execute(select(func.count()).select_from(table)).scalar()
+        current_app.logger.info(f"Сводки диалогов пересобраны: {count}")
+        return int(count or 0)
@@ -0,0 +1,99 @@
+"""
+Пакетная отправка Socket.IO событий: emit'ы одному адресату за время обработчика
+уходят одним кадром 'batch' (одна публикация в message queue вместо нескольких)
+"""
+import functools
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+from flask import current_app, g, has_request_context, request
+import flask_socketio
+from app.metrics import metrics
+
+
+class EmitBatcher:
+    """Копит emit'ы в рамках обработчика события и отправляет их при выходе из него"""
+
+    # Кадр с несколькими событиями: {'events': [{'event': имя, 'data': данные}, ...]}
+    BATCH_EVENT = 'batch'
+
+    @staticmethod
+    def _segments() -> Optional[List[Tuple[str, Optional[str], List[Tuple[str, Any]]]]]:
+        if not has_request_context():
+            return None
+        return g.get('_emit_batch')
+
+    @contextmanager
+    def batch(self):
+        """Область пакетирования; вложенные области отправляют события при выходе из внешней"""
+        if not has_request_context() or not current_app.config.get('EMIT_BATCHING_ENABLED', True) \
+                or g.get('_emit_batch') is not None:
+            yield
+            return
+        g._emit_batch = []
+        try:
+            yield
+        finally:
+            self.flush()
+            g._emit_batch = None
+
+    def batched(self, handler):
+        """Декоратор обработчика Socket.IO: все его emit'ы пакетируются"""
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            with self.batch():
+                return handler(*args, **kwargs)
+        return wrapper
+
+    def emit(self, event: str, *args, to: Optional[str] = None, room: Optional[str] = None,
+             include_self: bool = True, broadcast: bool = False, **kwargs) -> None:
+        """emit с сигнатурой flask_socketio.emit; вне области пакетирования отправляет сразу"""
+        segments = self._segments()
+        if segments is None or broadcast or kwargs or len(args) != 1:
+            flask_socketio.emit(event, *args, to=to, room=room, include_self=include_self,
+                                broadcast=broadcast, **kwargs)
+            return
+        target = to or room or request.sid
+        skip_sid = None if include_self else request.sid
+        # Порядок событий одному адресату сохраняется: новый сегмент, если адресат сменил skip_sid
+        for segment_target, segment_skip, events in reversed(segments):
+            if segment_target == target:
+                if segment_skip == skip_sid:
+                    events.append((event, args[0]))
+                    return
+                break
+        segments.append((target, skip_sid, [(event, args[0])]))
+
+    def flush(self) -> None:
+        """Отправляет накопленные события: одно — как есть, несколько — одним кадром"""
+        segments = self._segments()
+        if not segments:
+            return
+        g._emit_batch = []
+        for target, skip_sid, events in segments:
+            if len(events) == 1:
+                event, data = events[0]
+                flask_socketio.emit(event, data, to=target, skip_sid=skip_sid)
+                continue
+            flask_socketio.emit(self.BATCH_EVENT, {
+                'events': [{'event': event, 'data': data} for event, data in events]
+            }, to=target, skip_sid=skip_sid)
+            metrics.incr('emit_batch.frames')
+            metrics.incr('emit_batch.events_coalesced', len(events))
+
+    def join_room(self, room: str, **kwargs) -> None:
+        # Состав комнаты меняется — сначала отправляем то, что было адресовано старому составу
+        self.flush()
+        flask_socketio.join_room(room, **kwargs)
+
+    def leave_room(self, room: str, **kwargs) -> None:
+        self.flush()
+        flask_socketio.leave_room(room, **kwargs)
+
+
+# Глобальный экземпляр
+emit_batcher = EmitBatcher()
+
+# Замена flask_socketio.emit/join_room/leave_room для обработчиков событий
+emit = emit_batcher.emit
+join_room = emit_batcher.join_room
+leave_room = emit_batcher.leave_room
@@ -0,0 +1,136 @@
+"""
+Кэш личности пользователя для Flask-Login: локальный LRU с коротким TTL поверх Redis
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+from flask import current_app
+from flask_login import UserMixin
+from app import extensions
+from app.extensions import db
+from app.circuit_breaker import redis_breaker
+from app.metrics import metrics
+
+
+class CachedUser(UserMixin):
+    """Снимок пользователя для current_user: только поля, нужные шаблонам и обработчикам"""
+
+    def __init__(self, id: int, username: str, email: str):
+        self.id = id
+        self.username = username
+        self.email = email
+
+    def __repr__(self):
+        return f'<CachedUser {self.username}>'
+
+
+class IdentityCache:
+    """Снимки пользователей по id; сбрасываются при изменении профиля"""
+
+    _KEY = "user:identity:{user_id}"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local: "OrderedDict[int, Tuple[float, CachedUser]]" = OrderedDict()
+
+    @staticmethod
+    def _client():
+        client = extensions.redis_client
+        if client is None:
+            return None
+        redis_breaker.bind(client)
+        return client if redis_breaker.allow_request() else None
+
+    @staticmethod
+    def _key(user_id: int) -> str:
+        return IdentityCache._KEY.format(user_id=user_id)
+
+    def get(self, user_id: int) -> Optional[CachedUser]:
+        """Снимок из кэша (локального, затем Redis), при промахе — из БД; None — пользователя нет"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._local.move_to_end(user_id)
+                metrics.incr('identity_cache.local_hit')
+                return entry[1]
+
+        identity = self._read_redis(user_id)
+        if identity is not None:
+            metrics.incr('identity_cache.redis_hit')
+        else:
+            identity = self._load(user_id)
+            if identity is None:
+                return None
+        self._remember(identity, now)
+        return identity
+
+    def invalidate(self, user_id: int) -> None:
+        """Сбрасывает снимок пользователя (локально и в Redis)"""
+        with self._lock:
+            self._local.pop(user_id, None)
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.delete(self._key(user_id))
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis identity invalidate failed: {e}")
+
+    def _load(self, user_id: int) -> Optional[CachedUser]:
+        from app.models import User
+        row = db.session.query(
+            User.id, User.username, User.email
+        ).filter(User.id == user_id).first()
+        metrics.incr('identity_cache.miss')
+        if row is None:
+            return None
+        identity = CachedUser(row.id, row.username, row.email)
+        self._store_redis(identity)
+        return identity
+
+    def _read_redis(self, user_id: int) -> Optional[CachedUser]:
+        client = self._client()
+        if client is None:
+            return None
+        try:
+            raw = client.get(self._key(user_id))
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis identity get failed: {e}")
+            return None
+        if raw is None:
+            return None
+        username, email = json.loads(raw)
+        return CachedUser(user_id, username, email)
+
+    def _store_redis(self, identity: CachedUser) -> None:
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.set(self._key(identity.id), json.dumps([identity.username, identity.email]),
+                       ex=int(current_app.config.get('IDENTITY_CACHE_TTL_SECONDS', 60)))
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis identity set failed: {e}")
+
+    def _remember(self, identity: CachedUser, now: float) -> None:
+        # Другие воркеры увидят изменение профиля не позже чем через локальный TTL
+        ttl = float(current_app.config.get('IDENTITY_CACHE_LOCAL_TTL_SECONDS', 5))
+        max_users = int(current_app.config.get('IDENTITY_CACHE_LOCAL_MAX_USERS', 10000))
+        with self._lock:
+            self._local[identity.id] = (now + ttl, identity)
+            self._local.move_to_end(identity.id)
+            while len(self._local) > max_users:
+                self._local.popitem(last=False)
+
+
+# Глобальный экземпляр
+identity_cache = IdentityCache()
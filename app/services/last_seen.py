@@ -0,0 +1,160 @@
+"""
+Отложенная запись last_seen: отметки копятся в Redis-хеше и пишутся в БД одной пачкой
+"""
+import threading
+import time
+from datetime import datetime
+from typing import Dict, Optional
+from flask import current_app
+from sqlalchemy import bindparam, update
+from app import extensions
+from app.extensions import db
+from app.circuit_breaker import redis_breaker
+from app.metrics import metrics
+from app.models import User
+
+
+class LastSeenTracker:
+    """Буфер user_id -> время последней активности (unix time), общий для воркеров"""
+
+    _HASH_KEY = "presence:last_seen"
+    # Забирает накопленные отметки атомарно: при нескольких воркерах каждую пишет ровно один
+    _TAKE_SCRIPT = """
+    local entries = redis.call('HGETALL', KEYS[1])
+    redis.call('DEL', KEYS[1])
+    return entries
+    """
+    # Возврат невыписанных отметок: более свежая отметка, пришедшая после take, не затирается
+    _RESTORE_SCRIPT = """
+    for i = 1, #ARGV, 2 do
+        local current = redis.call('HGET', KEYS[1], ARGV[i])
+        if not current or tonumber(current) < tonumber(ARGV[i + 1]) then
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+    end
+    return 1
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[int, float] = {}
+        self._started = False
+
+    @staticmethod
+    def _client():
+        client = extensions.redis_client
+        if client is None:
+            return None
+        redis_breaker.bind(client)
+        return client if redis_breaker.allow_request() else None
+
+    def touch(self, user_id: int, when: Optional[float] = None) -> None:
+        """Отмечает активность пользователя; в БД попадет при следующем flush"""
+        when = time.time() if when is None else when
+        client = self._client()
+        if client is not None:
+            try:
+                client.hset(self._HASH_KEY, str(user_id), repr(when))
+                redis_breaker.record_success()
+                return
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis last_seen touch failed, fallback to memory: {e}")
+        with self._lock:
+            self._pending[user_id] = max(when, self._pending.get(user_id, 0.0))
+
+    def get(self, user_id: int) -> Optional[datetime]:
+        """Еще не записанная в БД отметка пользователя (None — берется из БД)"""
+        when = None
+        client = self._client()
+        if client is not None:
+            try:
+                raw = client.hget(self._HASH_KEY, str(user_id))
+                redis_breaker.record_success()
+                when = float(raw) if raw is not None else None
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis last_seen get failed: {e}")
+        with self._lock:
+            local = self._pending.get(user_id)
+        if local is not None and (when is None or local > when):
+            when = local
+        return datetime.utcfromtimestamp(when) if when is not None else None
+
+    def start(self, socketio, app) -> None:
+        """Запускает фоновую запись с периодом LAST_SEEN_FLUSH_INTERVAL_SECONDS"""
+        if self._started:
+            return
+        self._started = True
+        socketio.start_background_task(self._run, socketio, app)
+
+    def _run(self, socketio, app) -> None:
+        interval = float(app.config.get('LAST_SEEN_FLUSH_INTERVAL_SECONDS', 30))
+        while True:
+            socketio.sleep(interval)
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    app.logger.error(f"Ошибка записи last_seen: {e}")
+
+    def flush(self) -> int:
+        """Пишет накопленные отметки одним executemany UPDATE; возвращает число пользователей"""
+        entries = self._take()
+        if not entries:
+            return 0
+        users = User.__table__
+        statement = update(users).where(users.c.id == bindparam('user_id')).values(last_seen=bindparam('seen_at'))
+        try:
+            db.session.execute(statement, [
+                {'user_id': user_id, 'seen_at': datetime.utcfromtimestamp(when)}
+                for user_id, when in entries.items()
+            ])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Failed to flush last_seen: {e}")
+            self._restore(entries)
+            return 0
+        metrics.incr('last_seen.flushed', len(entries))
+        return len(entries)
+
+    def _take(self) -> Dict[int, float]:
+        with self._lock:
+            entries, self._pending = self._pending, {}
+        client = self._client()
+        if client is None:
+            return entries
+        try:
+            take = client.register_script(self._TAKE_SCRIPT)
+            raw = take(keys=[self._HASH_KEY]) or []
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis last_seen take failed: {e}")
+            return entries
+        for user_id, when in zip(raw[::2], raw[1::2]):
+            if str(user_id).isdigit():
+                user_id, when = int(user_id), float(when)
+                entries[user_id] = max(when, entries.get(user_id, 0.0))
+        return entries
+
+    def _restore(self, entries: Dict[int, float]) -> None:
+        client = self._client()
+        if client is not None:
+            try:
+                restore = client.register_script(self._RESTORE_SCRIPT)
+                args = [part for user_id, when in entries.items() for part in (str(user_id), repr(when))]
+                restore(keys=[self._HASH_KEY], args=args)
+                redis_breaker.record_success()
+                return
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis last_seen restore failed, fallback to memory: {e}")
+        with self._lock:
+            for user_id, when in entries.items():
+                self._pending[user_id] = max(when, self._pending.get(user_id, 0.0))
+
+
+# Глобальный экземпляр
+last_seen_tracker = LastSeenTracker()
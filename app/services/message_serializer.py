@@ -0,0 +1,140 @@
+"""
+Каноническая сериализация сообщений с кэшем готового JSON по id
+"""
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Optional, Tuple
+from flask import current_app
+from app import json_provider
+from app.metrics import metrics
+
+
+class MessageSerializer:
+    """Словарь и JSON-байты сообщения строятся один раз и переиспользуются всеми потребителями"""
+
+    def __init__(self, max_size: int = 5000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # id -> (словарь, JSON-байты); словарь общий — потребители его не изменяют
+        self._cache: "OrderedDict[int, Tuple[Dict[str, Any], bytes]]" = OrderedDict()
+
+    def init_app(self, app) -> None:
+        """Читает размер кэша из MESSAGE_PAYLOAD_CACHE_SIZE"""
+        self.max_size = int(app.config.get('MESSAGE_PAYLOAD_CACHE_SIZE', self.max_size))
+        metrics.register_collector('message_payload_cache', self.stats)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'size': len(self._cache), 'max_size': self.max_size}
+
+    @staticmethod
+    def encode(data: Any) -> bytes:
+        return json_provider.codec.dumps_bytes(data)
+
+    def payload(self, message, sender_username: Optional[str] = None) -> Dict[str, Any]:
+        """Канонический словарь сообщения (Message из ORM)"""
+        return self._entry(message, sender_username)[0]
+
+    def encoded(self, message, sender_username: Optional[str] = None) -> bytes:
+        """JSON-байты канонического словаря сообщения"""
+        return self._entry(message, sender_username)[1]
+
+    def remember(self, data: Dict[str, Any], raw: bytes) -> Dict[str, Any]:
+        """Кладет в кэш уже закодированное сообщение (например, прочитанное из Redis)"""
+        if data.get('id') is None:
+            return data
+        with self._lock:
+            entry = self._cache.get(data['id'])
+            # Другие байты — буфер перестроен после смены имени отправителя: берем его версию
+            if entry is not None and entry[1] == raw:
+                self._cache.move_to_end(data['id'])
+                return entry[0]
+        self._put(data['id'], data, raw)
+        return data
+
+    def bytes_for(self, data: Dict[str, Any]) -> bytes:
+        """JSON-байты канонического словаря: из кэша или закодированные заново"""
+        raw = self._cached_bytes(data.get('id'))
+        if raw is None:
+            metrics.incr('message_payload_cache.miss')
+            raw = self.encode(data)
+        return raw
+
+    def encode_list(self, messages: Iterable[Dict[str, Any]]) -> bytes:
+        """JSON-массив сообщений, собранный из кэшированных байтов"""
+        return b'[' + b','.join(self.bytes_for(data) for data in messages) + b']'
+
+    def json_response(self, messages: Iterable[Dict[str, Any]], **fields):
+        """HTTP-ответ {"messages": [...], **fields} без повторного кодирования сообщений"""
+        body = b'{"messages":' + self.encode_list(messages)
+        if fields:
+            body += b',' + self.encode(fields)[1:]
+        else:
+            body += b'}'
+        return current_app.response_class(body, mimetype='application/json')
+
+    def forget(self, message_id: int) -> None:
+        """Убирает сообщение из кэша (id сообщения сменился при записи в БД)"""
+        with self._lock:
+            self._cache.pop(message_id, None)
+
+    def forget_sender(self, sender_id: int) -> int:
+        """Убирает из кэша сообщения отправителя (после смены его имени)"""
+        with self._lock:
+            stale = [message_id for message_id, (data, _) in self._cache.items() if data['sender_id'] == sender_id]
+            for message_id in stale:
+                del self._cache[message_id]
+        return len(stale)
+
+    def clear(self) -> None:
+        """Сбрасывает кэш (после удаления сообщений их id могут быть выданы повторно)"""
+        with self._lock:
+            self._cache.clear()
+
+    def _cached_bytes(self, message_id: Optional[int]) -> Optional[bytes]:
+        if message_id is None:
+            return None
+        with self._lock:
+            entry = self._cache.get(message_id)
+            return entry[1] if entry is not None else None
+
+    def _entry(self, message, sender_username: Optional[str]) -> Tuple[Dict[str, Any], bytes]:
+        if sender_username is None and 'sender' in vars(message):
+            # Отправитель уже загружен (joinedload): актуальное имя известно без запроса
+            sender_username = message.sender.username if message.sender else 'Unknown'
+        if message.id is not None:
+            with self._lock:
+                entry = self._cache.get(message.id)
+                # Запись с прежним именем (отправитель переименовался, в т.ч. через другой воркер) пересобираем
+                if entry is not None and sender_username in (None, entry[0]['sender_username']):
+                    self._cache.move_to_end(message.id)
+                    metrics.incr('message_payload_cache.hit')
+                    return entry
+            if entry is not None:
+                metrics.incr('message_payload_cache.stale_sender')
+        if sender_username is None:
+            sender_username = message.sender.username if message.sender else 'Unknown'
+        data = {
+            'id': message.id,
+            'sender_id': message.sender_id,
+            'sender_username': sender_username,
+            'recipient_id': message.recipient_id,
+            'room_id': message.room_id,
+            'content': message.content,
+            'timestamp': message.timestamp.isoformat(),
+            'is_dm': bool(message.is_dm),
+        }
+        raw = self.encode(data)
+        if message.id is not None:
+            self._put(message.id, data, raw)
+        return data, raw
+
+    def _put(self, message_id: int, data: Dict[str, Any], raw: bytes) -> None:
+        with self._lock:
+            self._cache[message_id] = (data, raw)
+            self._cache.move_to_end(message_id)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+
+
+# Глобальный экземпляр
+message_serializer = MessageSerializer()
@@ -1,13 +1,19 @@
 """
 Сервис для работы с сообщениями
 """
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
 from datetime import datetime
 from flask import current_app
 from sqlalchemy.orm import joinedload
 from app.extensions import db
 from app.models import Message, User, Room
 from app.validators import WebSocketValidator
+from .message_writer import message_writer, MessageWriteBehind
+from .conversation_service import ConversationService
+from .unread_counters import unread_counters
+from .identity_cache import identity_cache
+from .recent_messages import recent_messages
+from .message_serializer import message_serializer
 
 
 class MessageService:
@@ -42,11 +48,22 @@ class MessageService:
             timestamp=datetime.utcnow()
         )
         
+        # Write-behind: id и время назначены сразу, запись в БД — фоновой пачкой
+        if message_writer.submit(message):
+            current_app.logger.info(f"✅ [MESSAGE DEBUG] Message queued: ID={message.id}, sender={sender_id}")
+            MessageService._after_create(message)
+            return message
+        
         current_app.logger.info(f"🔵 [MESSAGE DEBUG] Объект сообщения создан, сохраняем в БД...")
         
         try:
             db.session.add(message)
+            if is_dm and recipient_id is not None:
+                # Сводка диалога обновляется в той же транзакции; для нее нужен id сообщения
+                db.session.flush()
+                ConversationService.record_messages(db.session, [MessageWriteBehind.to_row(message)])
             db.session.commit()
+            MessageService._after_create(message)
             current_app.logger.info(f"✅ [MESSAGE DEBUG] Message created: ID={message.id}, sender={sender_id}")
             current_app.logger.info(f"🔵 [MESSAGE DEBUG] Timestamp: {message.timestamp}")
             return message
@@ -57,68 +74,184 @@ class MessageService:
             return None
     
     @staticmethod
-    def get_room_messages(room_id: int, limit: int = 20, offset: int = 0) -> List[Dict[str, Any]]:
-        """Получает сообщения комнаты с пагинацией"""
+    def _after_create(message: Message) -> None:
+        """Обновляет кэши, которые следят за новыми сообщениями"""
+        if message.is_dm:
+            if message.recipient_id is not None:
+                unread_counters.incr(message.recipient_id, message.sender_id)
+        elif message.room_id is not None:
+            # Отправитель — текущий пользователь, его снимок уже в кэше личности
+            sender_name = MessageService._sender_name(message.sender_id)
+            if sender_name is None:
+                # Заглушку не кэшируем: буфер прогреется из БД с настоящим именем
+                recent_messages.invalidate(message.room_id)
+                return
+            recent_messages.push(message.room_id, message_serializer.payload(message, sender_name))
+    
+    @staticmethod
+    def forget_sender(sender_id: int) -> None:
+        """Сбрасывает кэши сообщений с прежним именем отправителя (после смены имени)"""
+        message_serializer.forget_sender(sender_id)
+        rooms = {room_id for (room_id,) in db.session.query(Message.room_id).filter(
+            Message.sender_id == sender_id, Message.is_dm.is_(False), Message.room_id.isnot(None)
+        ).distinct()}
+        rooms.update(row['room_id'] for row in message_writer.pending_rows(
+            lambda row: row['sender_id'] == sender_id and not row['is_dm'] and row['room_id'] is not None
+        ))
+        for room_id in rooms:
+            recent_messages.invalidate(room_id)
+    
+    @staticmethod
+    def _sender_name(sender_id: int) -> Optional[str]:
+        """Имя отправителя из кэша личности, при промахе — из БД; None — пользователя нет"""
+        sender = identity_cache.get(sender_id)
+        if sender is not None:
+            return sender.username
+        user = db.session.get(User, sender_id)
+        return user.username if user else None
+    
+    @staticmethod
+    def _pending_payloads(predicate, cursor: Optional[Tuple[datetime, int]] = None) -> List[Dict[str, Any]]:
+        """Недописанные сообщения этого процесса (write-behind) до курсора, от новых к старым"""
+        rows = message_writer.pending_rows(
+            lambda row: predicate(row) and (cursor is None or (row['timestamp'], row['id']) < cursor)
+        )
+        rows.sort(key=lambda row: (row['timestamp'], row['id']), reverse=True)
+        return [message_serializer.payload(Message(**row), MessageService._sender_name(row['sender_id']))
+                for row in rows]
+    
+    @staticmethod
+    def _merge_pending(stored: List[Dict[str, Any]], pending: List[Dict[str, Any]],
+                       limit: int, skip: int = 0) -> List[Dict[str, Any]]:
+        """Сливает страницу из БД и недописанные сообщения (оба списка от новых к старым)"""
+        seen = set()
+        merged = []
+        for message in pending + stored:
+            if message['id'] not in seen:
+                seen.add(message['id'])
+                merged.append(message)
+        merged.sort(key=lambda message: (message['timestamp'], message['id']), reverse=True)
+        return merged[skip:skip + limit]
+    
+    @staticmethod
+    def parse_cursor(before_id: Any = None, before_ts: Any = None) -> Optional[Tuple[datetime, int]]:
+        """Разбирает курсор (before_ts, before_id); без before_ts время берется из сообщения before_id"""
+        if before_id in (None, ''):
+            return None
         try:
-            messages = Message.query.options(
-                joinedload(Message.sender)
-            ).filter_by(
-                room_id=room_id,
-                is_dm=False
-            ).order_by(
-                Message.timestamp.desc()
-            ).offset(offset).limit(limit).all()
-            
-            # Преобразуем в правильный порядок (от старых к новым)
-            messages.reverse()
-            
-            return [
-                {
-                    'id': msg.id,
-                    'sender_id': msg.sender_id,
-                    'sender_username': msg.sender.username if msg.sender else 'Unknown',
-                    'content': msg.content,
-                    'timestamp': msg.timestamp.isoformat(),
-                    'is_dm': False,
-                    'room_id': room_id
-                }
-                for msg in messages
-            ]
+            before_id = int(before_id)
+        except (TypeError, ValueError):
+            return None
+        if isinstance(before_ts, str) and before_ts:
+            try:
+                before_ts = datetime.fromisoformat(before_ts.replace('Z', ''))
+            except ValueError:
+                before_ts = None
+        if not isinstance(before_ts, datetime):
+            before_ts = db.session.query(Message.timestamp).filter(Message.id == before_id).scalar()
+            if before_ts is None:
+                return None
+        return before_ts, before_id
+    
+    @staticmethod
+    def history_cursor(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Курсор для следующей (более старой) страницы: самое старое сообщение выдачи"""
+        if not messages:
+            return {'before_id': None, 'before_ts': None}
+        return {'before_id': messages[0].get('id'), 'before_ts': messages[0].get('timestamp')}
+    
+    @staticmethod
+    def _apply_cursor(query, cursor: Optional[Tuple[datetime, int]]):
+        """Keyset-условие (timestamp, id) < курсора и порядок от новых к старым"""
+        if cursor is not None:
+            before_ts, before_id = cursor
+            query = query.filter(
+                (Message.timestamp < before_ts) |
+                ((Message.timestamp == before_ts) & (Message.id < before_id))
+            )
+        # id — тай-брейкер для сообщений с одинаковым временем
+        return query.order_by(Message.timestamp.desc(), Message.id.desc())
+    
+    @staticmethod
+    def get_room_messages(room_id: int, limit: int = 20, offset: int = 0,
+                          before_id: Optional[int] = None,
+                          before_ts: Optional[Any] = None) -> List[Dict[str, Any]]:
+        """Получает сообщения комнаты: по курсору before_id/before_ts (keyset) или по offset"""
+        try:
+            # Страницы, помещающиеся в буфер последних сообщений, отдаются без SQL
+            cached = recent_messages.get(
+                room_id, limit, offset=offset, before_id=before_id,
+                loader=lambda size: MessageService._query_room_messages(room_id, size)
+            )
+            if cached is not None:
+                return cached
+            cursor = MessageService.parse_cursor(before_id, before_ts)
+            return MessageService._query_room_messages(room_id, limit, offset, cursor)
         except Exception as e:
             current_app.logger.error(f"Failed to get room messages: {e}")
             return []
     
     @staticmethod
-    def get_dm_messages(user_id: int, recipient_id: int, limit: int = 50) -> List[Dict[str, Any]]:
-        """Получает сообщения личной переписки"""
+    def _query_room_messages(room_id: int, limit: int, offset: int = 0,
+                             cursor: Optional[Tuple[datetime, int]] = None) -> List[Dict[str, Any]]:
+        """Страница истории комнаты из БД (от старых к новым)"""
+        # Недописанные сообщения этого процесса накладываются на выдачу без сброса очереди;
+        # сообщения, еще не записанные другими воркерами, видны после их фоновой записи
+        pending = MessageService._pending_payloads(
+            lambda row: row['room_id'] == room_id and not row['is_dm'], cursor
+        )
+        # Недописанные сообщения новее записанных: в режиме offset они занимают начало выдачи
+        db_offset = max(0, offset - len(pending))
+        query = Message.query.options(
+            joinedload(Message.sender)
+        ).filter_by(
+            room_id=room_id,
+            is_dm=False
+        )
+        # Keyset по индексу ix_message_room_timestamp: глубина прокрутки не влияет на стоимость
+        query = MessageService._apply_cursor(query, cursor)
+        if cursor is None and db_offset:
+            # Устаревший режим offset оставлен для обратной совместимости
+            query = query.offset(db_offset)
+        messages = [message_serializer.payload(msg) for msg in query.limit(limit).all()]
+        if pending:
+            skip = offset - db_offset if cursor is None else 0
+            messages = MessageService._merge_pending(messages, pending, limit, skip)
+        
+        # Преобразуем в правильный порядок (от старых к новым)
+        messages.reverse()
+        return messages
+    
+    @staticmethod
+    def get_dm_messages(user_id: int, recipient_id: int, limit: int = 50,
+                        before_id: Optional[int] = None,
+                        before_ts: Optional[Any] = None) -> List[Dict[str, Any]]:
+        """Получает сообщения личной переписки (страница до курсора before_id/before_ts)"""
         try:
             current_app.logger.info(f"🔵 [DM DEBUG] get_dm_messages: user_id={user_id}, recipient_id={recipient_id}, limit={limit}")
+            cursor = MessageService.parse_cursor(before_id, before_ts)
+            pair = {(user_id, recipient_id), (recipient_id, user_id)}
+            pending = MessageService._pending_payloads(
+                lambda row: row['is_dm'] and (row['sender_id'], row['recipient_id']) in pair, cursor
+            )
             
-            messages = Message.query.options(
+            query = Message.query.options(
                 joinedload(Message.sender)
             ).filter(
                 ((Message.sender_id == user_id) & (Message.recipient_id == recipient_id)) |
                 ((Message.sender_id == recipient_id) & (Message.recipient_id == user_id))
-            ).filter_by(is_dm=True).order_by(
-                Message.timestamp.desc()
-            ).limit(limit).all()
+            ).filter_by(is_dm=True)
+            query = MessageService._apply_cursor(query, cursor)
+            messages = query.limit(limit).all()
             
             current_app.logger.info(f"🔵 [DM DEBUG] Найдено сообщений в БД: {len(messages)}")
             
-            # Преобразуем в правильный порядок
-            messages.reverse()
+            result = [message_serializer.payload(msg) for msg in messages]
+            if pending:
+                result = MessageService._merge_pending(result, pending, limit)
             
-            result = [
-                {
-                    'sender_id': msg.sender_id,
-                    'sender_username': msg.sender.username if msg.sender else 'Unknown',
-                    'recipient_id': msg.recipient_id,
-                    'content': msg.content,
-                    'timestamp': msg.timestamp.isoformat(),
-                    'is_dm': True
-                }
-                for msg in messages
-            ]
+            # Преобразуем в правильный порядок
+            result.reverse()
             
             current_app.logger.info(f"🔵 [DM DEBUG] Возвращаем {len(result)} сообщений")
             return result
@@ -132,14 +265,8 @@ class MessageService:
         current_app.logger.info(f"🔵 [MESSAGE DEBUG] mark_messages_as_read вызван: user_id={user_id}, sender_id={sender_id}")
         
         try:
-            # Сначала считаем количество непрочитанных сообщений
-            unread_count_before = Message.query.filter(
-                (Message.sender_id == sender_id) &
-                (Message.recipient_id == user_id) &
-                (Message.is_read == False)
-            ).count()
-            
-            current_app.logger.info(f"🔵 [MESSAGE DEBUG] Непрочитанных сообщений до пометки: {unread_count_before}")
+            # Недописанные сообщения лягут в БД уже прочитанными
+            message_writer.mark_read(user_id, sender_id)
             
             # Помечаем сообщения как прочитанные
             updated_count = Message.query.filter_by(
@@ -150,16 +277,10 @@ class MessageService:
             
             current_app.logger.info(f"🔵 [MESSAGE DEBUG] Обновлено сообщений: {updated_count}")
             
+            ConversationService.mark_read(db.session, user_id, sender_id)
             db.session.commit()
+            unread_counters.reset(user_id, sender_id)
             
-            # Проверяем результат
-            unread_count_after = Message.query.filter(
-                (Message.sender_id == sender_id) &
-                (Message.recipient_id == user_id) &
-                (Message.is_read == False)
-            ).count()
-            
-            current_app.logger.info(f"🔵 [MESSAGE DEBUG] Непрочитанных сообщений после пометки: {unread_count_after}")
             current_app.logger.info(f"✅ [MESSAGE DEBUG] Сообщения успешно помечены как прочитанные")
             
             return True
@@ -171,13 +292,16 @@ class MessageService:
     
     @staticmethod
     def get_unread_count(user_id: int, sender_id: int) -> int:
-        """Получает количество непрочитанных сообщений"""
+        """Получает количество непрочитанных сообщений (Redis-счетчик, иначе сводка диалога)"""
         try:
-            return Message.query.filter(
-                (Message.sender_id == sender_id) &
-                (Message.recipient_id == user_id) &
-                (Message.is_read == False)
-            ).count()
+            cached = unread_counters.get(user_id, sender_id)
+            if cached is not None:
+                return cached
+            pending = message_writer.pending_rows(
+                lambda row: row['is_dm'] and row['sender_id'] == sender_id
+                and row['recipient_id'] == user_id and not row['is_read']
+            )
+            return ConversationService.get_unread_count(user_id, sender_id) + len(pending)
         except Exception as e:
             current_app.logger.error(f"Failed to get unread count: {e}")
             return 0
@@ -186,8 +310,12 @@ class MessageService:
     def delete_room_messages(room_id: int) -> bool:
         """Удаляет все сообщения комнаты"""
         try:
+            # Иначе фоновая запись вставит их уже после удаления
+            message_writer.discard_room(room_id)
             Message.query.filter_by(room_id=room_id).delete()
             db.session.commit()
+            recent_messages.invalidate(room_id)
+            message_serializer.clear()
             return True
         except Exception as e:
             db.session.rollback()
@@ -0,0 +1,315 @@
+"""
+Отложенная (write-behind) запись сообщений в БД пачками
+"""
+import atexit
+import queue
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+from flask import current_app
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import IntegrityError
+from app import extensions
+from app.circuit_breaker import redis_breaker
+from app.extensions import db
+from app.metrics import metrics
+from app.models import Message
+from .conversation_service import ConversationService
+from .message_serializer import message_serializer
+from .recent_messages import recent_messages
+
+
+class MessageWriteBehind:
+    """Очередь сообщений, уже разосланных клиентам, но еще не записанных в БД"""
+
+    # Общий для всех воркеров счетчик идентификаторов сообщений
+    _ID_SEQ_KEY = "messages:id_seq"
+    # Lua: поднимает счетчик не ниже MAX(id) из БД и резервирует блок идентификаторов
+    _RESERVE_SCRIPT = """
+    local cur = tonumber(redis.call('GET', KEYS[1]) or '0')
+    local floor = tonumber(ARGV[1])
+    if cur < floor then cur = floor end
+    cur = cur + tonumber(ARGV[2])
+    redis.call('SET', KEYS[1], cur)
+    return cur
+    """
+    # PostgreSQL: блок берется из последовательности столбца id — ее же использует синхронная запись,
+    # поэтому id из блока и id, назначенные БД, не пересекаются
+    _PG_RESERVE_SQL = "SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"
+
+    def __init__(self):
+        self.enabled = False
+        self._app = None
+        self._queue: Optional[queue.Queue] = None
+        self._batch_size = 500
+        self._flush_interval = 0.05
+        self._id_block_size = 100
+        # Зарезервированные, но еще не выданные id и наибольший из зарезервированных
+        self._id_pool: Deque[int] = deque()
+        self._block_end = 0
+        self._id_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # Пачка, взятая из очереди и записываемая прямо сейчас
+        self._inflight: List[Dict[str, Any]] = []
+        self._worker_started = False
+        self._stopping = False
+
+    def init_app(self, app, start_worker: bool = True) -> None:
+        """Читает настройки MESSAGE_WRITE_BEHIND_* и запускает фоновую запись"""
+        self.enabled = bool(app.config.get('MESSAGE_WRITE_BEHIND', False))
+        if not self.enabled:
+            return
+        self._app = app
+        self._queue = queue.Queue(maxsize=int(app.config.get('MESSAGE_WRITE_BEHIND_MAX_QUEUE', 10000)))
+        self._batch_size = int(app.config.get('MESSAGE_WRITE_BEHIND_BATCH_SIZE', 500))
+        self._flush_interval = float(app.config.get('MESSAGE_WRITE_BEHIND_FLUSH_INTERVAL', 0.05))
+        self._id_block_size = int(app.config.get('MESSAGE_WRITE_BEHIND_ID_BLOCK', 100))
+        metrics.register_collector('message_write_behind', self.stats)
+        # Сброс очереди при штатном завершении процесса
+        atexit.register(self.shutdown)
+        if start_worker and not self._worker_started:
+            self._worker_started = True
+            extensions.socketio.start_background_task(self._run)
+
+    def pending(self) -> int:
+        """Количество сообщений, ожидающих записи"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def pending_rows(self, predicate: Optional[Callable[[Dict[str, Any]], bool]] = None) -> List[Dict[str, Any]]:
+        """Снимок недописанных строк (в очереди и в записываемой пачке); видны только этому процессу"""
+        if self._queue is None:
+            return []
+        with self._queue.mutex:
+            rows = self._inflight + list(self._queue.queue)
+        return [row for row in rows if predicate is None or predicate(row)]
+
+    def mark_read(self, recipient_id: int, sender_id: int) -> int:
+        """Помечает недописанные личные сообщения прочитанными, чтобы они легли в БД уже прочитанными"""
+        if self._queue is None:
+            return 0
+        marked = 0
+        # Ждем записываемую пачку: после нее UPDATE в БД увидит все уже вынутые из очереди строки
+        with self._flush_lock, self._queue.mutex:
+            for row in self._queue.queue:
+                if row['is_dm'] and row['sender_id'] == sender_id and row['recipient_id'] == recipient_id:
+                    row['is_read'] = True
+                    marked += 1
+        return marked
+
+    def discard_room(self, room_id: int) -> int:
+        """Выбрасывает недописанные сообщения комнаты (перед удалением ее сообщений из БД)"""
+        if self._queue is None:
+            return 0
+        with self._flush_lock, self._queue.mutex:
+            kept = [row for row in self._queue.queue if row['is_dm'] or row['room_id'] != room_id]
+            discarded = len(self._queue.queue) - len(kept)
+            if discarded:
+                self._queue.queue.clear()
+                self._queue.queue.extend(kept)
+                self._queue.not_full.notify(discarded)
+        return discarded
+
+    def stats(self) -> Dict[str, Any]:
+        """Текущая глубина очереди для /api/metrics"""
+        return {
+            'queue_depth': self.pending(),
+            'max_queue': self._queue.maxsize if self._queue is not None else 0,
+        }
+
+    def submit(self, message: Message) -> bool:
+        """Назначает сообщению id и ставит его в очередь; False — записывать синхронно"""
+        if not self.enabled:
+            return False
+        try:
+            message.id = self._allocate_id()
+        except Exception as e:
+            current_app.logger.warning(f"Не удалось выделить id сообщения, пишем синхронно: {e}")
+            metrics.incr('message_write_behind.id_allocation_failed')
+            return False
+
+        row = self.to_row(message)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            # Backpressure: производитель сам записывает пачку, прежде чем добавить свое сообщение
+            metrics.incr('message_write_behind.backpressure')
+            self.flush(max_batches=1)
+            try:
+                self._queue.put_nowait(row)
+            except queue.Full:
+                self._insert_rows([row])
+                return True
+        metrics.incr('message_write_behind.enqueued')
+        return True
+
+    def flush(self, max_batches: Optional[int] = None) -> int:
+        """Записывает накопленные сообщения пачками executemany, возвращает их число"""
+        if self._queue is None:
+            return 0
+        written = 0
+        batches = 0
+        with self._flush_lock:
+            while max_batches is None or batches < max_batches:
+                rows: List[Dict[str, Any]] = []
+                while len(rows) < self._batch_size:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not rows:
+                    break
+                with self._queue.mutex:
+                    self._inflight = rows
+                try:
+                    self._insert_rows(rows)
+                finally:
+                    with self._queue.mutex:
+                        self._inflight = []
+                written += len(rows)
+                batches += 1
+        return written
+
+    def shutdown(self) -> None:
+        """Останавливает фоновую запись и сбрасывает остаток очереди в БД"""
+        self._stopping = True
+        if not self.pending() or self._app is None:
+            return
+        with self._app.app_context():
+            written = self.flush()
+            self._app.logger.info(f"Write-behind: при остановке записано сообщений: {written}")
+
+    def _run(self) -> None:
+        """Цикл фоновой записи"""
+        while not self._stopping:
+            extensions.socketio.sleep(self._flush_interval)
+            if not self.pending():
+                continue
+            with self._app.app_context():
+                try:
+                    self.flush()
+                except Exception as e:
+                    self._app.logger.error(f"Ошибка фоновой записи сообщений: {e}")
+
+    def _allocate_id(self) -> int:
+        with self._id_lock:
+            if not self._id_pool:
+                self._reserve_block()
+            return self._id_pool.popleft()
+
+    def _reserve_block(self) -> None:
+        """Резервирует блок id: из последовательности БД, через Redis (общий для воркеров) или локально"""
+        with db.engine.connect() as conn:
+            if conn.dialect.name == 'postgresql':
+                ids = conn.execute(text(self._PG_RESERVE_SQL),
+                                   {'table': Message.__table__.name, 'count': self._id_block_size}).scalars().all()
+                self._id_pool.extend(sorted(ids))
+                self._block_end = max(ids)
+                return
+            db_max = conn.execute(select(func.max(Message.id))).scalar() or 0
+
+        # Нижняя граница учитывает и собственные, еще не записанные блоки этого воркера
+        floor = max(self._block_end, db_max)
+        block_end = self._reserve_redis_block(floor)
+        if block_end is None:
+            # Без Redis (один процесс или Redis недоступен): продолжаем локальный счетчик
+            block_end = floor + self._id_block_size
+        self._id_pool.extend(range(block_end - self._id_block_size + 1, block_end + 1))
+        self._block_end = block_end
+
+    def _reserve_redis_block(self, floor: int) -> Optional[int]:
+        """Конец блока из общего счетчика в Redis; None — Redis не настроен или недоступен"""
+        client = extensions.redis_client
+        if client is None:
+            return None
+        redis_breaker.bind(client)
+        if not redis_breaker.allow_request():
+            metrics.incr('message_write_behind.local_id_block')
+            return None
+        try:
+            reserve = client.register_script(self._RESERVE_SCRIPT)
+            block_end = int(reserve(keys=[self._ID_SEQ_KEY], args=[floor, self._id_block_size]))
+            redis_breaker.record_success()
+            return block_end
+        except Exception as e:
+            redis_breaker.record_failure()
+            metrics.incr('message_write_behind.local_id_block')
+            current_app.logger.warning(f"Redis недоступен, блок id сообщений резервируется локально: {e}")
+            return None
+
+    @staticmethod
+    def to_row(message: Message) -> Dict[str, Any]:
+        """Строка таблицы message для executemany"""
+        return {
+            'id': message.id,
+            'content': message.content,
+            'timestamp': message.timestamp,
+            'sender_id': message.sender_id,
+            'recipient_id': message.recipient_id,
+            'room_id': message.room_id,
+            'is_read': bool(message.is_read),
+            'is_dm': bool(message.is_dm),
+        }
+
+    def _insert_rows(self, rows: List[Dict[str, Any]]) -> None:
+        """Одна транзакция executemany (+ сводки диалогов); при конфликте id — построчно"""
+        try:
+            # Отдельное соединение: не коммитим чужие изменения в db.session запроса
+            with db.engine.begin() as conn:
+                conn.execute(Message.__table__.insert(), rows)
+                ConversationService.record_messages(conn, rows)
+            metrics.incr('message_write_behind.flushed', len(rows))
+        except IntegrityError as e:
+            current_app.logger.warning(f"Конфликт при пакетной записи сообщений, пишем по одному: {e}")
+            for row in rows:
+                try:
+                    self._insert_row_with_fallback_id(row)
+                except IntegrityError as row_error:
+                    # Строка нарушает ограничения и без своего id (например, удален отправитель): повтор не поможет
+                    metrics.incr('message_write_behind.lost')
+                    current_app.logger.error(f"Сообщение {row['id']} не записано и отброшено: {row_error}")
+                except Exception as row_error:
+                    self._requeue([row], row_error)
+        except Exception as e:
+            self._requeue(rows, e)
+
+    def _requeue(self, rows: List[Dict[str, Any]], error: Exception) -> None:
+        """БД недоступна: возвращает строки в очередь, следующая попытка — на следующем тике"""
+        requeued = 0
+        for row in rows:
+            try:
+                self._queue.put_nowait(row)
+                requeued += 1
+            except queue.Full:
+                break
+        metrics.incr('message_write_behind.lost', len(rows) - requeued)
+        current_app.logger.error(
+            f"Ошибка записи сообщений ({len(rows)} шт., возвращено в очередь {requeued}): {error}"
+        )
+
+    def _insert_row_with_fallback_id(self, row: Dict[str, Any]) -> None:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(Message.__table__.insert(), [row])
+                ConversationService.record_messages(conn, [row])
+            metrics.incr('message_write_behind.flushed')
+        except IntegrityError:
+            # id уже занят строкой, записанной синхронно: сохраняем с id, назначенным БД
+            fresh_row = {key: value for key, value in row.items() if key != 'id'}
+            with db.engine.begin() as conn:
+                result = conn.execute(Message.__table__.insert().values(**fresh_row))
+                fresh_row['id'] = result.inserted_primary_key[0]
+                ConversationService.record_messages(conn, [fresh_row])
+            metrics.incr('message_write_behind.flushed')
+            metrics.incr('message_write_behind.id_conflicts')
+            # Старый id принадлежит другой строке: кэши по нему больше не должны отдавать это сообщение
+            message_serializer.forget(row['id'])
+            if not row['is_dm'] and row['room_id'] is not None:
+                recent_messages.invalidate(row['room_id'])
+            current_app.logger.error(
+                f"Сообщение {row['id']} записано под новым id {fresh_row['id']} из-за конфликта; "
+                f"клиенты, получившие его по сокету, видят старый id"
+            )
+
+
+# Глобальный экземпляр
+message_writer = MessageWriteBehind()
@@ -0,0 +1,89 @@
+"""
+Адресная рассылка статуса онлайн: изменения за окно уходят кадрами presence_delta
+только в комнаты пользователя и его собеседникам по личным диалогам
+"""
+import threading
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Set, Tuple
+from flask import current_app
+from app import extensions
+from app.metrics import metrics
+from app.state import conn_mgr
+from .conversation_service import ConversationService
+
+
+class PresenceBroadcaster:
+    """Копит изменения статуса и рассылает их подписчикам (комнаты и личные комнаты собеседников)"""
+
+    # Личная комната сокета: в нее адресуются события конкретному пользователю на любом воркере
+    _PERSONAL_ROOM = "user:{user_id}"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # user_id -> (online, комнаты, участникам которых нужно сообщить)
+        self._pending: Dict[int, Tuple[bool, Set[str]]] = {}
+        self._started = False
+
+    @staticmethod
+    def personal_room(user_id: int) -> str:
+        return PresenceBroadcaster._PERSONAL_ROOM.format(user_id=user_id)
+
+    def record(self, user_id: int, online: bool, rooms: Iterable[str] = ()) -> None:
+        """Отмечает смену статуса; последнее значение за окно побеждает, комнаты объединяются"""
+        with self._lock:
+            previous = self._pending.get(user_id)
+            audience = set(rooms) | (previous[1] if previous else set())
+            self._pending[user_id] = (online, audience)
+        metrics.incr('presence.recorded')
+
+    def start(self, socketio, app) -> None:
+        """Запускает фоновую рассылку с периодом PRESENCE_FLUSH_INTERVAL_SECONDS"""
+        if self._started:
+            return
+        self._started = True
+        socketio.start_background_task(self._run, socketio, app)
+
+    def _run(self, socketio, app) -> None:
+        interval = float(app.config.get('PRESENCE_FLUSH_INTERVAL_SECONDS', 1.0))
+        while True:
+            socketio.sleep(interval)
+            with app.app_context():
+                try:
+                    self.flush(socketio)
+                except Exception as e:
+                    app.logger.error(f"Ошибка рассылки статусов: {e}")
+
+    def flush(self, socketio=None) -> Dict[str, List[Dict[str, Any]]]:
+        """Рассылает накопленные изменения: один кадр на адресата; возвращает кадры по адресатам"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return {}
+
+        try:
+            partners = ConversationService.partners_of(pending)
+        except Exception as e:
+            current_app.logger.warning(f"Presence partners lookup failed: {e}")
+            partners = {}
+        # Личные комнаты только тех собеседников, кто сейчас подключен
+        candidates = set().union(*partners.values()) if partners else set()
+        online_partners = conn_mgr.connected_users(candidates) if candidates else set()
+
+        frames: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for user_id, (online, rooms) in pending.items():
+            change = {'user_id': user_id, 'online': online}
+            for room_name in rooms:
+                frames[room_name].append(change)
+            for partner_id in partners.get(user_id, ()):
+                if partner_id in online_partners:
+                    frames[self.personal_room(partner_id)].append(change)
+
+        emitter = socketio or extensions.socketio
+        for target, changes in frames.items():
+            emitter.emit('presence_delta', {'changes': changes}, room=target)
+        metrics.incr('presence.frames_sent', len(frames))
+        return dict(frames)
+
+
+# Глобальный экземпляр
+presence_broadcaster = PresenceBroadcaster()
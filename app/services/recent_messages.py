@@ -0,0 +1,214 @@
+"""
+Кольцевой буфер последних сообщений комнаты: Redis list + короткий локальный LRU
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from flask import current_app
+from redis.exceptions import WatchError
+from app import extensions
+from app.circuit_breaker import redis_breaker
+from app.metrics import metrics
+from .message_serializer import message_serializer
+
+
+class RecentMessageBuffer:
+    """Последние N сериализованных сообщений комнаты; история, которая в них помещается, не идет в SQL"""
+
+    # Список от новых к старым и маркер «буфер прогрет из БД»
+    _LIST_KEY_TPL = "room:{room_id}:recent"
+    _LOADED_KEY_TPL = "room:{room_id}:recent:loaded"
+    # В непрогретый список сообщение тоже добавляется: читатели его не видят без маркера,
+    # а прогрев сливает его со снимком из БД (в том числе недописанные сообщения других воркеров)
+    _PUSH_SCRIPT = """
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+    redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[2]) - 1)
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+    if redis.call('EXISTS', KEYS[2]) == 1 then
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+    end
+    return 1
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # room_id -> (истекает, сообщения от новых к старым)
+        self._local: "OrderedDict[int, Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+
+    @staticmethod
+    def _config(name: str, default):
+        return type(default)(current_app.config.get(name, default))
+
+    @property
+    def size(self) -> int:
+        return self._config('RECENT_MESSAGES_SIZE', 50)
+
+    @staticmethod
+    def _client():
+        client = extensions.redis_client
+        if client is None:
+            return None
+        redis_breaker.bind(client)
+        return client if redis_breaker.allow_request() else None
+
+    def get(self, room_id: int, limit: int, offset: int = 0, before_id: Optional[int] = None,
+            loader: Optional[Callable[[int], List[Dict[str, Any]]]] = None) -> Optional[List[Dict[str, Any]]]:
+        """Страница истории (от старых к новым) из буфера; None — страница в буфер не помещается"""
+        if limit <= 0 or limit > self.size:
+            return None
+        newest_first = self._read(room_id, loader)
+        if newest_first is None:
+            return None
+        start = offset
+        if before_id is not None:
+            ids = [message.get('id') for message in newest_first]
+            try:
+                start = ids.index(int(before_id)) + 1
+            except (TypeError, ValueError):
+                return None
+        page = newest_first[start:start + limit]
+        # Меньше limit допустимо, только если буфер содержит всю комнату
+        if len(page) < limit and len(newest_first) >= self.size:
+            return None
+        metrics.incr('recent_messages.hit')
+        return list(reversed(page))
+
+    def push(self, room_id: int, message: Dict[str, Any]) -> None:
+        """Добавляет новое сообщение комнаты (канонический словарь) в буфер"""
+        size = self.size
+        with self._lock:
+            entry = self._local.get(room_id)
+            if entry is not None:
+                self._local[room_id] = (entry[0], ([message] + entry[1])[:size])
+        client = self._client()
+        if client is None:
+            return
+        try:
+            script = client.register_script(self._PUSH_SCRIPT)
+            script(
+                keys=[self._LIST_KEY_TPL.format(room_id=room_id), self._LOADED_KEY_TPL.format(room_id=room_id)],
+                args=[message_serializer.bytes_for(message), size, self._config('RECENT_MESSAGES_TTL_SECONDS', 3600)]
+            )
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis recent_messages push failed: {e}")
+
+    def invalidate(self, room_id: int) -> None:
+        """Сбрасывает буфер комнаты (удаление сообщений или самой комнаты)"""
+        with self._lock:
+            self._local.pop(room_id, None)
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.delete(self._LIST_KEY_TPL.format(room_id=room_id), self._LOADED_KEY_TPL.format(room_id=room_id))
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis recent_messages invalidate failed: {e}")
+
+    def _read(self, room_id: int, loader) -> Optional[List[Dict[str, Any]]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(room_id)
+            if entry is not None and entry[0] > now:
+                self._local.move_to_end(room_id)
+                return entry[1]
+
+        messages = self._read_redis(room_id)
+        if messages is None:
+            if loader is None:
+                return None
+            metrics.incr('recent_messages.miss')
+            messages = self._warm(room_id, loader)
+
+        # С Redis локальный слой короткий: сообщения других воркеров попадают только в Redis.
+        # Без Redis процесс один, и локальный буфер полон сам по себе
+        if extensions.redis_client is not None:
+            expires_at = now + self._config('RECENT_MESSAGES_LOCAL_TTL_SECONDS', 1.0)
+        else:
+            expires_at = now + self._config('RECENT_MESSAGES_TTL_SECONDS', 3600)
+        with self._lock:
+            self._local[room_id] = (expires_at, messages)
+            self._local.move_to_end(room_id)
+            while len(self._local) > self._config('RECENT_MESSAGES_LOCAL_MAX_ROOMS', 256):
+                self._local.popitem(last=False)
+        return messages
+
+    def _read_redis(self, room_id: int) -> Optional[List[Dict[str, Any]]]:
+        client = self._client()
+        if client is None:
+            return None
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.exists(self._LOADED_KEY_TPL.format(room_id=room_id))
+            pipe.lrange(self._LIST_KEY_TPL.format(room_id=room_id), 0, self.size - 1)
+            loaded, items = pipe.execute()
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis recent_messages read failed: {e}")
+            return None
+        if not loaded:
+            return None
+        # Байты из Redis сразу попадают в кэш сериализатора — REST-ответы соберутся из них
+        return [
+            message_serializer.remember(json.loads(item), item.encode('utf-8') if isinstance(item, str) else item)
+            for item in items
+        ]
+
+    def _warm(self, room_id: int, loader) -> List[Dict[str, Any]]:
+        """Прогревает буфер из БД; push во время чтения БД отменяет запись снимка (WATCH списка)"""
+        size = self.size
+        client = self._client()
+        if client is None:
+            return loader(size)[::-1]
+        list_key = self._LIST_KEY_TPL.format(room_id=room_id)
+        loaded_key = self._LOADED_KEY_TPL.format(room_id=room_id)
+        ttl = self._config('RECENT_MESSAGES_TTL_SECONDS', 3600)
+        try:
+            pipe = client.pipeline(transaction=True)
+            pipe.watch(list_key)
+            pushed = [json.loads(item) for item in pipe.lrange(list_key, 0, size - 1)]
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis recent_messages warm failed: {e}")
+            return loader(size)[::-1]
+        try:
+            newest_first = self._merge(loader(size)[::-1], pushed, size)
+        except Exception:
+            pipe.reset()
+            raise
+        try:
+            pipe.multi()
+            pipe.delete(list_key)
+            if newest_first:
+                pipe.rpush(list_key, *[message_serializer.bytes_for(message) for message in newest_first])
+                pipe.expire(list_key, ttl)
+            pipe.set(loaded_key, '1', ex=ttl)
+            pipe.execute()
+            redis_breaker.record_success()
+        except WatchError:
+            # Снимок мог пропустить новое сообщение: следующее чтение прогреет заново
+            metrics.incr('recent_messages.warm_raced')
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis recent_messages warm failed: {e}")
+        finally:
+            pipe.reset()
+        return newest_first
+
+    @staticmethod
+    def _merge(loaded: List[Dict[str, Any]], pushed: List[Dict[str, Any]], size: int) -> List[Dict[str, Any]]:
+        """Снимок из БД плюс сообщения, добавленные до прогрева, без повторов (от новых к старым)"""
+        by_id = {message.get('id'): message for message in pushed}
+        by_id.update((message.get('id'), message) for message in loaded)
+        merged = sorted(by_id.values(), key=lambda message: (message['timestamp'], message['id']), reverse=True)
+        return merged[:size]
+
+
+# Глобальный экземпляр
+recent_messages = RecentMessageBuffer()
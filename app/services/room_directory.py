@@ -0,0 +1,155 @@
+"""
+Справочник комнат name → (id, is_active, is_private): локальный TTL-кэш поверх Redis-хеша
+"""
+import json
+import threading
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+from flask import current_app
+from app import extensions
+from app.circuit_breaker import redis_breaker
+from app.metrics import metrics
+
+
+class RoomRef(NamedTuple):
+    """Минимум данных о комнате для горячих путей (вход, отправка, история)"""
+    id: int
+    name: str
+    is_active: bool
+    is_private: bool
+
+
+class RoomDirectory:
+    """Кэш строк комнат; сбрасывается явно при создании и удалении комнат"""
+
+    # Запись комнаты живет ROOM_DIRECTORY_TTL_SECONDS; поколение растет при каждом сбросе
+    _KEY_TPL = "rooms:directory:{name}"
+    _GEN_KEY_TPL = "rooms:directory:{name}:gen"
+    # Поколение переживает любую запись, начатую до сброса
+    _GEN_TTL_SECONDS = 86400
+    # Запись только если с момента чтения БД комнату не сбрасывали: поздний put не вернет удаленную комнату
+    _PUT_SCRIPT = """
+    local gen = redis.call('GET', KEYS[2]) or ''
+    if gen ~= ARGV[1] then
+        return 0
+    end
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local: Dict[str, Tuple[float, RoomRef]] = {}
+        # Локальные поколения: тот же порядок «сброс после чтения БД» внутри процесса
+        self._local_gen: Dict[str, int] = {}
+
+    @staticmethod
+    def _client():
+        client = extensions.redis_client
+        if client is None:
+            return None
+        redis_breaker.bind(client)
+        return client if redis_breaker.allow_request() else None
+
+    @staticmethod
+    def _local_ttl() -> float:
+        # Другие воркеры узнают об удалении комнаты не позже чем через TTL
+        return float(current_app.config.get('ROOM_DIRECTORY_LOCAL_TTL_SECONDS', 5))
+
+    def get(self, name: str) -> Optional[RoomRef]:
+        """Запись из кэша (локального, затем Redis); None — промах.
+        Записи в Redis доверяем: поздний put после сброса отсекается поколением"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._local.get(name)
+            if entry is not None and entry[0] > now:
+                metrics.incr('room_directory.local_hit')
+                return entry[1]
+
+        client = self._client()
+        if client is None:
+            return None
+        try:
+            raw = client.get(self._KEY_TPL.format(name=name))
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis room_directory get failed: {e}")
+            return None
+        if raw is None:
+            return None
+        room_id, is_active, is_private = json.loads(raw)
+        ref = RoomRef(room_id, name, bool(is_active), bool(is_private))
+        self._remember(ref, now)
+        metrics.incr('room_directory.redis_hit')
+        return ref
+
+    def generation(self, name: str) -> Tuple[int, Optional[str]]:
+        """Поколение записи; читается до запроса к БД и передается в put"""
+        with self._lock:
+            local_gen = self._local_gen.get(name, 0)
+        client = self._client()
+        if client is None:
+            return local_gen, None
+        try:
+            gen = client.get(self._GEN_KEY_TPL.format(name=name))
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis room_directory generation failed: {e}")
+            return local_gen, None
+        if isinstance(gen, bytes):
+            gen = gen.decode()
+        return local_gen, gen or ''
+
+    def put(self, room, generation: Tuple[int, Optional[str]]) -> RoomRef:
+        """Кладет строку комнаты из БД в кэш, если комнату не сбрасывали после чтения generation"""
+        ref = RoomRef(room.id, room.name, bool(room.is_active), bool(room.is_private))
+        local_gen, gen = generation
+        with self._lock:
+            if self._local_gen.get(ref.name, 0) == local_gen:
+                self._local[ref.name] = (time.monotonic() + self._local_ttl(), ref)
+        client = self._client()
+        if client is not None and gen is not None:
+            try:
+                script = client.register_script(self._PUT_SCRIPT)
+                script(keys=[self._KEY_TPL.format(name=ref.name), self._GEN_KEY_TPL.format(name=ref.name)],
+                       args=[gen, json.dumps([ref.id, ref.is_active, ref.is_private]),
+                             int(current_app.config.get('ROOM_DIRECTORY_TTL_SECONDS', 300))])
+                redis_breaker.record_success()
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis room_directory put failed: {e}")
+        return ref
+
+    def invalidate(self, *names: str) -> None:
+        """Сбрасывает записи комнат (создание, удаление, очистка) и поднимает их поколение"""
+        if not names:
+            return
+        with self._lock:
+            for name in names:
+                self._local.pop(name, None)
+                self._local_gen[name] = self._local_gen.get(name, 0) + 1
+        client = self._client()
+        if client is None:
+            return
+        try:
+            pipe = client.pipeline(transaction=True)
+            for name in names:
+                gen_key = self._GEN_KEY_TPL.format(name=name)
+                pipe.delete(self._KEY_TPL.format(name=name))
+                pipe.incr(gen_key)
+                pipe.expire(gen_key, self._GEN_TTL_SECONDS)
+            pipe.execute()
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis room_directory invalidate failed: {e}")
+
+    def _remember(self, ref: RoomRef, now: float) -> None:
+        with self._lock:
+            self._local[ref.name] = (now + self._local_ttl(), ref)
+
+
+# Глобальный экземпляр
+room_directory = RoomDirectory()
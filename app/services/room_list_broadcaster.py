@@ -0,0 +1,158 @@
+"""
+Отложенная рассылка изменений списка комнат: одно вычисление и один diff на окно debounce
+"""
+import json
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+from flask import current_app
+from app import extensions
+from app.circuit_breaker import redis_breaker
+from app.metrics import metrics
+from .room_service import RoomService
+
+
+class RoomListBroadcaster:
+    """Собирает изменения комнат за окно и рассылает room_list_delta {version, added, removed}"""
+
+    # Общие для воркеров флаг «список изменился», номер версии и последний разосланный список
+    _DIRTY_KEY = "room_list:dirty"
+    _VERSION_KEY = "room_list:version"
+    _SNAPSHOT_KEY = "room_list:snapshot"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._version = 0
+        self._rooms: Optional[List[str]] = None
+        self._started = False
+
+    @staticmethod
+    def _client():
+        client = extensions.redis_client
+        if client is None:
+            return None
+        redis_breaker.bind(client)
+        return client if redis_breaker.allow_request() else None
+
+    def start(self, socketio, app) -> None:
+        """Запускает фоновый цикл рассылки с периодом ROOM_LIST_DEBOUNCE_SECONDS"""
+        if self._started:
+            return
+        self._started = True
+        socketio.start_background_task(self._run, socketio, app)
+
+    def _run(self, socketio, app) -> None:
+        interval = float(app.config.get('ROOM_LIST_DEBOUNCE_SECONDS', 0.25))
+        while True:
+            socketio.sleep(interval)
+            with app.app_context():
+                try:
+                    self.flush(socketio)
+                except Exception as e:
+                    app.logger.error(f"Ошибка рассылки списка комнат: {e}")
+
+    def mark_dirty(self) -> None:
+        """Отмечает, что список комнат изменился; рассылка — в конце окна"""
+        self._dirty = True
+        metrics.incr('room_list.marked_dirty')
+        client = self._client()
+        if client is None:
+            return
+        try:
+            client.set(self._DIRTY_KEY, '1')
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis room_list mark_dirty failed: {e}")
+
+    def snapshot(self) -> Tuple[int, List[str]]:
+        """Версия и полный список комнат (для только что подключившегося клиента)"""
+        stored = self._load_snapshot()
+        if stored is not None:
+            return stored
+        rooms = self._current_rooms()
+        with self._lock:
+            if self._rooms is None:
+                self._rooms = rooms
+            return self._version, list(self._rooms)
+
+    def flush(self, socketio=None) -> Optional[Dict[str, Any]]:
+        """Если список менялся — вычисляет его один раз и рассылает diff с новой версией"""
+        if not self._take_dirty():
+            return None
+        rooms = self._current_rooms()
+        stored = self._load_snapshot()
+        previous = stored[1] if stored is not None else (self._rooms or [])
+        added = sorted(set(rooms) - set(previous))
+        removed = sorted(set(previous) - set(rooms))
+        if not added and not removed:
+            return None
+        version = self._store_snapshot(rooms)
+        payload = {'version': version, 'added': added, 'removed': removed}
+        (socketio or extensions.socketio).emit('room_list_delta', payload)
+        metrics.incr('room_list.deltas_sent')
+        return payload
+
+    @staticmethod
+    def _current_rooms() -> List[str]:
+        return RoomService.get_active_room_names()
+
+    def _take_dirty(self) -> bool:
+        dirty, self._dirty = self._dirty, False
+        client = self._client()
+        if client is None:
+            return dirty
+        try:
+            # GET + DEL атомарно: флаг, выставленный любым воркером, обрабатывает один из них
+            pipe = client.pipeline(transaction=True)
+            pipe.get(self._DIRTY_KEY)
+            pipe.delete(self._DIRTY_KEY)
+            shared, _ = pipe.execute()
+            redis_breaker.record_success()
+            return dirty or bool(shared)
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis room_list take_dirty failed: {e}")
+            return dirty
+
+    def _load_snapshot(self) -> Optional[Tuple[int, List[str]]]:
+        client = self._client()
+        if client is None:
+            return None
+        try:
+            pipe = client.pipeline(transaction=True)
+            pipe.get(self._VERSION_KEY)
+            pipe.get(self._SNAPSHOT_KEY)
+            version, snapshot = pipe.execute()
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis room_list snapshot failed: {e}")
+            return None
+        if snapshot is None:
+            return None
+        return int(version or 0), json.loads(snapshot)
+
+    def _store_snapshot(self, rooms: List[str]) -> int:
+        client = self._client()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=True)
+                pipe.incr(self._VERSION_KEY)
+                pipe.set(self._SNAPSHOT_KEY, json.dumps(rooms))
+                version, _ = pipe.execute()
+                redis_breaker.record_success()
+                with self._lock:
+                    self._version, self._rooms = int(version), rooms
+                return int(version)
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis room_list store failed, fallback to memory: {e}")
+        with self._lock:
+            self._version += 1
+            self._rooms = rooms
+            return self._version
+
+
+# Глобальный экземпляр
+room_list_broadcaster = RoomListBroadcaster()
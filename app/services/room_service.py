@@ -4,8 +4,13 @@
 from typing import Dict, List, Optional, Any
 from flask import current_app
 from app.extensions import db
+from app.metrics import metrics
 from app.models import Room, User, Message
 from app.validators import WebSocketValidator
+from .recent_messages import recent_messages
+from .room_directory import RoomRef, room_directory
+from .message_serializer import message_serializer
+from .message_writer import message_writer
 
 
 class RoomService:
@@ -37,6 +42,8 @@ class RoomService:
         try:
             db.session.add(room)
             db.session.commit()
+            # Запись справочника могла остаться от физически удаленной комнаты с тем же именем
+            room_directory.invalidate(room.name)
             current_app.logger.info(f"Room created: {room.name} by user {creator_id}")
             return room
         except Exception as e:
@@ -53,6 +60,32 @@ class RoomService:
             current_app.logger.error(f"Failed to get room by name: {e}")
             return None
     
+    @staticmethod
+    def get_room_ref(name: str, strict: bool = False) -> Optional[RoomRef]:
+        """Активная комната по имени из справочника (SQL только при промахе кэша).
+        strict — сверить запись кэша с БД (вход в комнату); списки и переименование ее не сверяют"""
+        try:
+            ref = room_directory.get(name)
+            if ref is not None and strict and not RoomService._room_exists(ref):
+                metrics.incr('room_directory.stale')
+                room_directory.invalidate(name)
+                ref = None
+            if ref is None:
+                generation = room_directory.generation(name)
+                room = Room.query.filter_by(name=name).first()
+                if not room:
+                    return None
+                ref = room_directory.put(room, generation)
+            return ref if ref.is_active else None
+        except Exception as e:
+            current_app.logger.error(f"Failed to get room ref: {e}")
+            return None
+    
+    @staticmethod
+    def _room_exists(ref: RoomRef) -> bool:
+        """Запись кэша все еще соответствует строке в БД (проверка по первичному ключу)"""
+        return db.session.query(Room.id).filter(Room.id == ref.id, Room.name == ref.name).first() is not None
+    
     @staticmethod
     def get_room_by_id(room_id: int) -> Optional[Room]:
         """Получает комнату по ID"""
@@ -63,25 +96,66 @@ class RoomService:
             return None
     
     @staticmethod
-    def get_all_rooms() -> List[Dict[str, Any]]:
-        """Получает список всех активных комнат"""
+    def _room_summary_query():
+        """Проекция комнаты с именем создателя одним запросом (без ленивой загрузки creator_obj)"""
+        return db.session.query(
+            Room.id, Room.name, Room.created_by, User.username.label('creator_username'),
+            Room.is_private, Room.created_at
+        ).outerjoin(User, User.id == Room.created_by).filter(Room.is_active == True)
+    
+    @staticmethod
+    def _room_summary(row) -> Dict[str, Any]:
+        return {
+            'id': row.id,
+            'name': row.name,
+            'created_by': row.created_by,
+            'creator_username': row.creator_username or 'Unknown',
+            'is_private': row.is_private,
+            'created_at': row.created_at
+        }
+    
+    @staticmethod
+    def get_all_rooms(limit: Optional[int] = None, after: Optional[str] = None,
+                      prefix: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Активные комнаты по имени: страница после курсора after, с фильтром по префиксу имени"""
         try:
-            rooms = Room.query.filter_by(is_active=True).all()
-            return [
-                {
-                    'id': room.id,
-                    'name': room.name,
-                    'created_by': room.created_by,  # ИСПРАВЛЕНО: используем created_by
-                    'creator_username': room.creator_obj.username if room.creator_obj else 'Unknown',  # ИСПРАВЛЕНО: используем creator_obj
-                    'is_private': room.is_private,
-                    'created_at': room.created_at.isoformat() if room.created_at else None
-                }
-                for room in rooms
-            ]
+            query = RoomService._room_summary_query()
+            if prefix:
+                # Экранируем спецсимволы LIKE: префикс — обычная строка
+                escaped = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+                query = query.filter(Room.name.like(f'{escaped}%', escape='\\'))
+            if after:
+                # Keyset по уникальному имени (индекс на room.name)
+                query = query.filter(Room.name > after)
+            query = query.order_by(Room.name)
+            if limit:
+                query = query.limit(limit)
+            return [RoomService._room_summary(row) for row in query.all()]
         except Exception as e:
             current_app.logger.error(f"Failed to get all rooms: {e}")
             return []
     
+    @staticmethod
+    def get_room_summary(room_id: Optional[int] = None, name: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Активная комната по id или имени вместе с именем создателя"""
+        try:
+            query = RoomService._room_summary_query()
+            query = query.filter(Room.id == room_id) if room_id is not None else query.filter(Room.name == name)
+            row = query.first()
+            return RoomService._room_summary(row) if row else None
+        except Exception as e:
+            current_app.logger.error(f"Failed to get room summary: {e}")
+            return None
+    
+    @staticmethod
+    def get_active_room_names() -> List[str]:
+        """Имена активных комнат (один столбец, по алфавиту)"""
+        try:
+            return [name for (name,) in db.session.query(Room.name).filter(Room.is_active == True).order_by(Room.name)]
+        except Exception as e:
+            current_app.logger.error(f"Failed to get room names: {e}")
+            return []
+    
     @staticmethod
     def delete_room(room_id: int, user_id: int) -> bool:
         """Удаляет комнату (только создатель может удалить)"""
@@ -99,6 +173,7 @@ class RoomService:
             # Удаляем комнату (мягкое удаление)
             room.is_active = False
             db.session.commit()
+            room_directory.invalidate(room.name)
             
             current_app.logger.info(f"Room deleted: {room.name}")
             return True
@@ -116,25 +191,9 @@ class RoomService:
             if not room:
                 return True
             
-            # Проверяем активных пользователей через WebSocket сервис
-            from app.services.websocket_service import WebSocketService
-            ws_service = WebSocketService()
-            
-            # Проверяем локальный кеш
-            local_users = ws_service.active_users.get(room.name, {})
-            local_user_count = len(local_users)
-            
-            # Проверяем Redis
-            redis_user_count = 0
-            try:
-                from app.state import user_state
-                redis_users = user_state.get_room_users(room.name)
-                redis_user_count = len(redis_users)
-            except Exception as e:
-                current_app.logger.warning(f"Redis get_room_users failed: {e}")
-            
-            # Комната пустая если нет пользователей в обоих местах
-            return local_user_count == 0 and redis_user_count == 0
+            # Присутствие хранится только в менеджере состояния
+            from app.state import user_state
+            return user_state.get_room_user_counts([room.name]).get(room.name, 0) == 0
         except Exception as e:
             current_app.logger.error(f"Failed to check if room is empty: {e}")
             return False
@@ -156,12 +215,17 @@ class RoomService:
             # В sockets_old.py комната удаляется если нет пользователей, а не сообщений
             
             # ФИЗИЧЕСКОЕ УДАЛЕНИЕ как в sockets_old.py
-            # Сначала удаляем все сообщения комнаты
+            # Сначала удаляем все сообщения комнаты (и недописанные, иначе их вставит фоновая запись)
+            message_writer.discard_room(room.id)
             Message.query.filter_by(room_id=room.id).delete()
             
             # Затем удаляем саму комнату
+            room_id = room.id
             db.session.delete(room)
             db.session.commit()
+            recent_messages.invalidate(room_id)
+            message_serializer.clear()
+            room_directory.invalidate(room_name)
             
             current_app.logger.info(f"Комната '{room_name}' удалена из БД")
             return True
@@ -178,11 +242,14 @@ class RoomService:
             
             # Получаем все комнаты кроме комнаты по умолчанию
             rooms = Room.query.filter(Room.name != 'general_chat').all()
+            room_ids = [room.id for room in rooms]
+            room_names = [room.name for room in rooms]
             
             for room in rooms:
                 # Удаляем все комнаты кроме general_chat (независимо от пользователей/сообщений)
                 
                 # Удаляем все сообщения комнаты
+                message_writer.discard_room(room.id)
                 Message.query.filter_by(room_id=room.id).delete()
                 
                 # Удаляем саму комнату
@@ -191,6 +258,10 @@ class RoomService:
             
             if deleted_count > 0:
                 db.session.commit()
+                for room_id in room_ids:
+                    recent_messages.invalidate(room_id)
+                message_serializer.clear()
+                room_directory.invalidate(*room_names)
                 current_app.logger.info(f"Удалено {deleted_count} пустых комнат")
             
             return deleted_count
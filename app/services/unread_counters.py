@@ -0,0 +1,154 @@
+"""
+Счетчики непрочитанных личных сообщений в Redis (hash unread:{recipient_id})
+"""
+from typing import Dict, Optional
+from flask import current_app
+from redis.exceptions import WatchError
+from app import extensions
+from app.circuit_breaker import redis_breaker
+from app.metrics import metrics
+from .conversation_service import ConversationService
+from .message_writer import message_writer
+
+
+class UnreadCounters:
+    """Кэш счетчиков непрочитанных: поле — id отправителя, источник истины — таблица conversation"""
+
+    _KEY_TPL = "unread:{user_id}"
+    # Версия счетчиков получателя: меняется при изменении, которое мог пропустить идущий прогрев
+    _VERSION_KEY_TPL = "unread:{user_id}:version"
+    # Служебное поле: хеш существует (загружен из БД), даже если непрочитанных нет
+    _LOADED_FIELD = "_loaded"
+    # Инкремент только в загруженный хеш: иначе счетчик начнется с нуля и разойдется с БД.
+    # Без хеша поднимаем версию — прогрев, читающий БД в этот момент, не сохранит свой снимок
+    _INCR_SCRIPT = """
+    if redis.call('EXISTS', KEYS[1]) == 1 then
+        return redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+    end
+    redis.call('INCR', KEYS[2])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    return false
+    """
+
+    @staticmethod
+    def _client():
+        client = extensions.redis_client
+        if client is None:
+            return None
+        redis_breaker.bind(client)
+        return client if redis_breaker.allow_request() else None
+
+    @staticmethod
+    def _ttl() -> int:
+        # По истечении TTL счетчики перечитываются из БД
+        return int(current_app.config.get('UNREAD_COUNTER_TTL_SECONDS', 300))
+
+    def _load_ttl(self) -> int:
+        """TTL хеша, прогретого из БД; при write-behind снимок предварительный — в нем нет
+        недописанных сообщений других воркеров, и он перечитывается после их сброса в БД"""
+        if message_writer.enabled:
+            return min(self._ttl(), int(current_app.config.get('UNREAD_COUNTER_PROVISIONAL_TTL_SECONDS', 2)))
+        return self._ttl()
+
+    def incr(self, recipient_id: int, sender_id: int, by: int = 1) -> None:
+        """Учитывает новое личное сообщение (no-op, если хеш получателя не загружен)"""
+        client = self._client()
+        if client is None:
+            return
+        try:
+            script = client.register_script(self._INCR_SCRIPT)
+            script(keys=[self._KEY_TPL.format(user_id=recipient_id), self._VERSION_KEY_TPL.format(user_id=recipient_id)],
+                   args=[str(sender_id), by, self._ttl()])
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis unread incr failed: {e}")
+
+    def reset(self, recipient_id: int, sender_id: int) -> None:
+        """Обнуляет счетчик после прочтения"""
+        client = self._client()
+        if client is None:
+            return
+        version_key = self._VERSION_KEY_TPL.format(user_id=recipient_id)
+        try:
+            pipe = client.pipeline(transaction=True)
+            pipe.hdel(self._KEY_TPL.format(user_id=recipient_id), str(sender_id))
+            pipe.incr(version_key)
+            pipe.expire(version_key, self._ttl())
+            pipe.execute()
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis unread reset failed: {e}")
+
+    def get(self, recipient_id: int, sender_id: int) -> Optional[int]:
+        """Счетчик из Redis; при промахе хеш загружается из БД. None — Redis недоступен"""
+        client = self._client()
+        if client is None:
+            return None
+        key = self._KEY_TPL.format(user_id=recipient_id)
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.exists(key)
+            pipe.hget(key, str(sender_id))
+            exists, value = pipe.execute()
+            redis_breaker.record_success()
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis unread get failed: {e}")
+            return None
+        if exists:
+            metrics.incr('unread_counters.hit')
+            return int(value or 0)
+        metrics.incr('unread_counters.miss')
+        counts = self._load(client, recipient_id)
+        return counts.get(sender_id, 0)
+
+    def _load(self, client, recipient_id: int) -> Dict[int, int]:
+        """Читает все счетчики получателя из conversation и кладет их в Redis с TTL.
+        Снимок не сохраняется, если за время чтения БД счетчики менялись (WATCH версии)"""
+        key = self._KEY_TPL.format(user_id=recipient_id)
+        try:
+            pipe = client.pipeline(transaction=True)
+            pipe.watch(self._VERSION_KEY_TPL.format(user_id=recipient_id))
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis unread load failed: {e}")
+            return self._read_db(recipient_id)
+        try:
+            counts = self._read_db(recipient_id)
+        except Exception:
+            pipe.reset()
+            raise
+        try:
+            mapping = {str(sender_id): count for sender_id, count in counts.items() if count}
+            mapping[self._LOADED_FIELD] = 1
+            pipe.multi()
+            pipe.delete(key)
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, self._load_ttl())
+            pipe.execute()
+            redis_breaker.record_success()
+        except WatchError:
+            # Снимок мог пропустить инкремент или сброс: следующее чтение прогреет заново
+            metrics.incr('unread_counters.load_raced')
+        except Exception as e:
+            redis_breaker.record_failure()
+            current_app.logger.warning(f"Redis unread load failed: {e}")
+        finally:
+            pipe.reset()
+        return counts
+
+    @staticmethod
+    def _read_db(recipient_id: int) -> Dict[int, int]:
+        """Счетчики из conversation плюс недописанные (write-behind) сообщения этого процесса"""
+        counts = ConversationService.unread_by_partner(recipient_id)
+        for row in message_writer.pending_rows(
+            lambda row: row['is_dm'] and row['recipient_id'] == recipient_id and not row['is_read']
+        ):
+            counts[row['sender_id']] = counts.get(row['sender_id'], 0) + 1
+        return counts
+
+
+# Глобальный экземпляр
+unread_counters = UnreadCounters()
@@ -1,10 +1,12 @@
 """
 Сервис для работы с пользователями
 """
-from typing import Dict, List, Optional, Any, Set
+from typing import Dict, List, Optional, Any
 from flask import current_app
-from app.extensions import db
 from app.models import User, Message
+from app.state import conn_mgr
+from .last_seen import last_seen_tracker
+from .message_writer import message_writer
 
 
 class UserService:
@@ -30,91 +32,49 @@ class UserService:
     
     @staticmethod
     def get_online_users(room: Optional[str] = None) -> Dict[int, str]:
-        """Получает словарь онлайн пользователей {id: username}"""
+        """Получает словарь онлайн пользователей {id: username} из индекса heartbeat (без БД)"""
         try:
-            # Оптимизированный запрос - выбираем только нужные поля
-            query = User.query.with_entities(User.id, User.username).filter_by(online=True)
-            if room:
-                # Если нужна фильтрация по комнате (для будущего расширения)
-                pass
-            return dict(query.all())
+            # Онлайн — тот, у кого жив heartbeat; колонка User.online расходится с реальностью
+            # после падения процесса и больше не используется
+            return conn_mgr.online_users()
         except Exception as e:
             current_app.logger.error(f"Failed to get online users: {e}")
             return {}
     
     @staticmethod
-    def set_user_online(user_id: int, online: bool = True) -> bool:
-        """Устанавливает статус онлайн/оффлайн пользователя"""
-        try:
-            user = User.query.get(user_id)
-            if not user:
-                return False
-            
-            user.online = online
-            db.session.commit()
-            return True
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Failed to set user online status: {e}")
-            return False
+    def get_presence(user: User) -> Dict[str, Any]:
+        """Статус онлайн и last_seen с учетом еще не записанной в БД отметки"""
+        return {
+            'online': conn_mgr.is_user_connected(user.id),
+            'last_seen': last_seen_tracker.get(user.id) or user.last_seen
+        }
+    
+    @staticmethod
+    def mark_seen(user_id: int) -> None:
+        """Отмечает активность пользователя; last_seen пишется в БД пачкой в фоне"""
+        last_seen_tracker.touch(user_id)
     
     @staticmethod
-    def get_dm_conversations(user_id: int) -> List[Dict[str, Any]]:
-        """Получает список диалогов для пользователя"""
+    def get_dm_conversations(user_id: int, limit: Optional[int] = 100,
+                             before_id: Optional[int] = None,
+                             before_ts: Optional[Any] = None) -> List[Dict[str, Any]]:
+        """Получает список диалогов одним запросом (страница до курсора последнего сообщения)"""
         try:
             current_app.logger.info(f"🔵 [DM DEBUG] get_dm_conversations вызван для пользователя {user_id}")
-            
-            conversations = []
-            
-            # Находим всех пользователей, с которыми есть переписка
-            sent_messages = Message.query.filter_by(sender_id=user_id, is_dm=True).all()
-            received_messages = Message.query.filter_by(recipient_id=user_id, is_dm=True).all()
-            
-            current_app.logger.info(f"🔵 [DM DEBUG] Найдено отправленных сообщений: {len(sent_messages)}")
-            current_app.logger.info(f"🔵 [DM DEBUG] Найдено полученных сообщений: {len(received_messages)}")
-            
-            # Собираем уникальных собеседников
-            interlocutors: Set[int] = set()
-            for msg in sent_messages:
-                if msg.recipient_id:
-                    interlocutors.add(msg.recipient_id)
-            for msg in received_messages:
-                interlocutors.add(msg.sender_id)
-            
-            current_app.logger.info(f"🔵 [DM DEBUG] Найдено собеседников: {len(interlocutors)}")
-            
-            # Для каждого собеседника получаем информацию
-            for interlocutor_id in interlocutors:
-                interlocutor = User.query.get(interlocutor_id)
-                if not interlocutor:
-                    continue
-                
-                # Находим последнее сообщение в диалоге
-                last_message = Message.query.filter(
-                    ((Message.sender_id == user_id) & (Message.recipient_id == interlocutor_id)) |
-                    ((Message.sender_id == interlocutor_id) & (Message.recipient_id == user_id))
-                ).filter_by(is_dm=True).order_by(Message.timestamp.desc()).first()
-                
-                # Считаем непрочитанные сообщения (только входящие)
-                unread_count = Message.query.filter(
-                    (Message.sender_id == interlocutor_id) &
-                    (Message.recipient_id == user_id) &
-                    (Message.is_read == False)
-                ).count()
-                
-                conversations.append({
-                    'user_id': interlocutor_id,
-                    'username': interlocutor.username,
-                    'last_message': last_message.content if last_message else None,
-                    'last_message_time': last_message.timestamp.isoformat() if last_message else None,
-                    'unread_count': unread_count
-                })
-            
-            # Сортируем по времени последнего сообщения
-            conversations.sort(
-                key=lambda x: x['last_message_time'] or '1970-01-01T00:00:00',
-                reverse=True
+            from .message_service import MessageService
+            from .conversation_service import ConversationService
+            # Чтение сводок conversation по индексу (user, last_message_at) — без сканирования сообщений
+            cursor = MessageService.parse_cursor(before_id, before_ts)
+            conversations = ConversationService.list_for_user(user_id, limit, cursor)
+            # Недописанные сообщения этого процесса накладываются поверх сводок, без сброса очереди
+            pending = message_writer.pending_rows(
+                lambda row: row['is_dm'] and row['recipient_id'] is not None
+                and user_id in (row['sender_id'], row['recipient_id'])
             )
+            if pending:
+                conversations = ConversationService.apply_pending(
+                    user_id, conversations, pending, first_page=cursor is None, limit=limit
+                )
             
             current_app.logger.info(f"🔵 [DM DEBUG] Возвращаем {len(conversations)} диалогов")
             return conversations
@@ -137,8 +97,7 @@ class UserService:
             return {
                 'user_id': user_id,
                 'username': user.username,
-                'online': user.online,
-                'last_seen': user.last_seen.isoformat() if user.last_seen else None,
+                **UserService.get_presence(user),
                 'sent_messages': sent_count,
                 'received_messages': received_count,
                 'total_messages': sent_count + received_count
@@ -2,14 +2,16 @@
 Сервис для WebSocket операций
 """
 from typing import Dict, List, Optional, Any
-from collections import defaultdict
 from flask import current_app, request
 from flask_login import current_user
-from flask_socketio import emit, join_room, leave_room
 from app.extensions import db
 from app.models import User
 from app.state import user_state, conn_mgr, room_mgr
 from .message_service import MessageService
+from .emit_batcher import emit, join_room, leave_room
+from .message_serializer import message_serializer
+from .presence_broadcaster import presence_broadcaster
+from .room_list_broadcaster import room_list_broadcaster
 from .room_service import RoomService
 from .user_service import UserService
 
@@ -21,11 +23,15 @@ class WebSocketService:
     DEFAULT_ROOM = 'general_chat'
     
     def __init__(self):
-        # Локальный in-memory кеш (fallback для dev)
-        self.active_users = defaultdict(dict)  # {room: {user_id: username}}
-        self.active_users[self.DEFAULT_ROOM] = {}
-        self.connected_users = {}  # {user_id: socket_id}
-        self.dm_rooms = defaultdict(set)
+        # Присутствие хранится только в user_state (комната -> пользователи и обратный индекс
+        # пользователь -> комнаты) и conn_mgr (user_id <-> socket_id), общих для всех воркеров
+        self._reaper_started = False
+        # Воркер выводится из работы: отключения — передача пользователя другому воркеру
+        self._draining = False
+    
+    def begin_drain(self) -> None:
+        """Переводит сервис в режим вывода воркера: отключения не меняют присутствие"""
+        self._draining = True
     
     def handle_connect(self, socketio) -> None:
         """Обрабатывает подключение пользователя"""
@@ -36,35 +42,39 @@ class WebSocketService:
         user_id = current_user.id
         current_app.logger.info(f"🔵 [CONNECT DEBUG] Подключение пользователя {user_id} ({current_user.username}) с SID {request.sid}")
         
-        # Проверяем, не подключен ли пользователь уже
-        if user_id in self.connected_users:
-            old_sid = self.connected_users[user_id]
-            current_app.logger.info(f"🔵 [CONNECT DEBUG] Пользователь {user_id} уже подключен с SID {old_sid}")
-            if old_sid != request.sid:
-                # Отключаем старое соединение
-                current_app.logger.info(f"🔵 [CONNECT DEBUG] Отключаем старое соединение {old_sid}")
-                leave_room(self.DEFAULT_ROOM, sid=old_sid)
-                socketio.server.disconnect(old_sid)
-        
-        # Регистрируем новое соединение
-        self.connected_users[user_id] = request.sid
-        current_app.logger.info(f"✅ [CONNECT DEBUG] Пользователь {user_id} зарегистрирован с SID {request.sid}")
-        current_app.logger.info(f"🔵 [CONNECT DEBUG] Все подключенные пользователи: {self.connected_users}")
+        # Проверяем, не подключен ли пользователь уже (в том числе через другой воркер)
+        try:
+            old_sid = conn_mgr.get_user_socket(user_id)
+        except Exception as e:
+            current_app.logger.warning(f"Redis get_user_socket failed: {e}")
+            old_sid = None
         
-        # Регистрируем соединение в Redis
+        # Регистрируем новое соединение до отключения старого: disconnect старого SID
+        # сверяет socket_id и не тронет присутствие нового соединения
         try:
-            conn_mgr.register_connection(user_id, request.sid)
+            conn_mgr.register_connection(user_id, request.sid, current_user.username)
         except Exception as e:
             current_app.logger.warning(f"Redis conn register failed: {e}")
+        current_app.logger.info(f"✅ [CONNECT DEBUG] Пользователь {user_id} зарегистрирован с SID {request.sid}")
+        
+        if old_sid and old_sid != request.sid:
+            # Отключаем старое соединение; менеджер с message_queue доставит это нужному воркеру
+            current_app.logger.info(f"🔵 [CONNECT DEBUG] Пользователь {user_id} уже подключен с SID {old_sid}, отключаем его")
+            socketio.server.disconnect(old_sid)
         
-        # Обновляем статус пользователя
+        # Статус онлайн следует из heartbeat соединения; в БД на подключении ничего не пишем
         join_room('app_aware_clients')
-        UserService.set_user_online(user_id, True)
-        emit('user_status', {'user_id': user_id, 'online': True}, broadcast=True)
+        join_room(presence_broadcaster.personal_room(user_id))
+        UserService.mark_seen(user_id)
         
         # Автоматически присоединяем к комнате по умолчанию
         self._join_default_room(user_id)
         
+        # Статус получат только участники комнаты и собеседники по ЛС (кадром presence_delta);
+        # переподключение (в том числе после вывода воркера) статус не меняет
+        if not old_sid:
+            presence_broadcaster.record(user_id, True, [self.DEFAULT_ROOM])
+        
         # Отправляем данные пользователю
         self._send_initial_data(user_id)
     
@@ -75,43 +85,57 @@ class WebSocketService:
         
         user_id = current_user.id
         username = current_user.username
-        user_was_in_any_room = False
         
-        # Удаляем пользователя из всех комнат
-        for room_name, users in list(self.active_users.items()):
-            if user_id in users:
-                user_was_in_any_room = True
-                del users[user_id]
-                
-                # Удаляем из Redis
-                try:
-                    user_state.remove_user_from_room(user_id, room_name)
-                except Exception as e:
-                    current_app.logger.warning(f"Redis remove_user_from_room failed: {e}")
-                
+        # Старое соединение, вытесненное новым: присутствие уже принадлежит новому SID
+        try:
+            current_sid = conn_mgr.get_user_socket(user_id)
+        except Exception as e:
+            current_app.logger.warning(f"Redis get_user_socket failed: {e}")
+            current_sid = None
+        if current_sid is not None and current_sid != request.sid:
+            current_app.logger.info(f"Отключение устаревшего SID {request.sid} пользователя {user_id}, пропускаем очистку")
+            return
+        
+        # Вывод воркера: комнаты и heartbeat остаются за пользователем до переподключения
+        # к другому воркеру; не вернется — соединение истечет по heartbeat
+        if self._draining:
+            UserService.mark_seen(user_id)
+            return
+        
+        # Комнаты пользователя из обратного индекса: O(комнат пользователя), а не O(всех комнат)
+        try:
+            left_rooms = sorted(user_state.get_user_rooms(user_id))
+        except Exception as e:
+            current_app.logger.warning(f"Redis get_user_rooms failed: {e}")
+            left_rooms = []
+        
+        if left_rooms:
+            # Удаляем из Redis одной транзакцией; версии составов нужны для members_delta
+            try:
+                versions = user_state.remove_user_from_rooms(user_id, left_rooms)
+            except Exception as e:
+                current_app.logger.warning(f"Redis remove_user_from_rooms failed: {e}")
+                versions = {}
+            
+            for room_name in left_rooms:
                 # Уведомляем остальных пользователей
                 emit('user_left', {
                     'user_id': user_id,
-                    'username': current_user.username,
+                    'username': username,
                     'room': room_name
                 }, room=room_name, include_self=False)
                 
-                # Отправляем обновленный список пользователей
-                emit('current_users', {
-                    'users': dict(users),
-                    'room': room_name
-                }, room=room_name)
-                
-                # ПРОВЕРЯЕМ И УДАЛЯЕМ ПУСТЫЕ КОМНАТЫ
-                self._check_and_cleanup_empty_room(room_name)
-        
-        # Удаляем из локального кеша
-        if user_id in self.connected_users:
-            del self.connected_users[user_id]
+                # Остальным — только изменение состава, а не весь список
+                if room_name in versions:
+                    emit('members_delta', self._members_delta(room_name, versions[room_name], removed=[user_id]),
+                         room=room_name, include_self=False)
+            
+            # ПРОВЕРЯЕМ И УДАЛЯЕМ ПУСТЫЕ КОМНАТЫ
+            self._cleanup_empty_rooms(left_rooms)
         
-        # Обновляем статус пользователя
-        UserService.set_user_online(user_id, False)
-        emit('user_status', {'user_id': user_id, 'online': False}, broadcast=True)
+        # Обновляем статус пользователя (last_seen запишется в БД пачкой)
+        UserService.mark_seen(user_id)
+        presence_broadcaster.record(user_id, False, left_rooms)
         
         # Удаляем соединение из Redis
         try:
@@ -121,77 +145,51 @@ class WebSocketService:
     
     def _check_and_cleanup_empty_room(self, room_name: str) -> None:
         """Проверяет и удаляет одну пустую комнату"""
-        try:
-            # Проверяем, что комната не является комнатой по умолчанию
-            if room_name == self.DEFAULT_ROOM:
-                return
-            
-            # Проверяем локальный кеш
-            local_users = self.active_users.get(room_name, {})
-            local_user_count = len(local_users)
-            
-            # Проверяем Redis
-            redis_user_count = 0
+        self._cleanup_empty_rooms([room_name])
+    
+    def _cleanup_empty_rooms(self, room_names: List[str],
+                             redis_counts: Optional[Dict[str, int]] = None,
+                             socketio=None) -> None:
+        """Удаляет пустые комнаты из списка; счетчики Redis читаются одним пайплайном"""
+        # Комната по умолчанию никогда не удаляется
+        room_names = [room_name for room_name in room_names if room_name != self.DEFAULT_ROOM]
+        if not room_names:
+            return
+        
+        if redis_counts is None:
             try:
-                redis_users = user_state.get_room_users(room_name)
-                redis_user_count = len(redis_users)
+                redis_counts = user_state.get_room_user_counts(room_names)
             except Exception as e:
-                current_app.logger.warning(f"Redis get_room_users failed: {e}")
-            
-            # Если комната пустая в обоих местах, удаляем её
-            if local_user_count == 0 and redis_user_count == 0:
-                # Удаляем из БД через сервис
-                success = RoomService.cleanup_empty_room(room_name)
-                
-                if success:
-                    # Удаляем из локального кеша
-                    if room_name in self.active_users:
-                        del self.active_users[room_name]
-                    
-                    # Уведомляем всех клиентов об обновлении списка комнат
-                    self._broadcast_room_list()
+                current_app.logger.warning(f"Redis get_room_user_counts failed: {e}")
+                redis_counts = {}
+        
+        rooms_removed = False
+        for room_name in room_names:
+            try:
+                # Комната пустая, если в ней нет пользователей в менеджере состояния
+                if redis_counts.get(room_name, 0) > 0:
+                    continue
                 
-        except Exception as e:
-            current_app.logger.error(f"Ошибка при проверке комнаты '{room_name}': {e}")
+                # Удаляем из БД через сервис
+                if RoomService.cleanup_empty_room(room_name):
+                    rooms_removed = True
+            except Exception as e:
+                current_app.logger.error(f"Ошибка при проверке комнаты '{room_name}': {e}")
+        
+        if rooms_removed:
+            # Уведомляем всех клиентов об обновлении списка комнат
+            try:
+                self._broadcast_room_list(socketio)
+            except Exception as e:
+                current_app.logger.error(f"Ошибка рассылки списка комнат: {e}")
     
     def _check_and_cleanup_empty_rooms(self) -> None:
         """Проверяет и удаляет пустые комнаты"""
         try:
             # Получаем все комнаты кроме комнаты по умолчанию
-            rooms = RoomService.get_all_rooms()
-            
-            for room_data in rooms:
-                room_name = room_data['name']
-                if room_name == self.DEFAULT_ROOM:
-                    continue
-                
-                # Проверяем, есть ли пользователи в комнате
-                has_users = False
-                
-                # Проверяем локальный кеш
-                if room_name in self.active_users and self.active_users[room_name]:
-                    has_users = True
-                
-                # Проверяем Redis
-                if not has_users:
-                    try:
-                        users = user_state.get_room_users(room_name)
-                        has_users = len(users) > 0
-                    except Exception as e:
-                        current_app.logger.warning(f"Redis get_room_users failed: {e}")
-                
-                # Если комната пустая, удаляем её
-                if not has_users:
-                    current_app.logger.info(f"Комната {room_name} пустая, удаляем...")
-                    RoomService.cleanup_empty_room(room_name)
-                    
-                    # Удаляем из локального кеша
-                    if room_name in self.active_users:
-                        del self.active_users[room_name]
-                    
-                    # Уведомляем всех клиентов об обновлении списка комнат
-                    self._broadcast_room_list()
-                    
+            room_names = [room_name for room_name in RoomService.get_active_room_names()
+                          if room_name != self.DEFAULT_ROOM]
+            self._cleanup_empty_rooms(room_names)
         except Exception as e:
             current_app.logger.error(f"Error checking empty rooms: {e}")
     
@@ -211,6 +209,60 @@ class WebSocketService:
         # Отправляем подтверждение
         emit('heartbeat_ack', {'timestamp': data.get('timestamp') if data else None})
     
+    def start_heartbeat_reaper(self, socketio, app) -> None:
+        """Запускает фоновую задачу, пакетно истекающую соединения без heartbeat"""
+        if self._reaper_started:
+            return
+        self._reaper_started = True
+        socketio.start_background_task(self._heartbeat_reaper_loop, socketio, app)
+    
+    def _heartbeat_reaper_loop(self, socketio, app) -> None:
+        """Цикл фонового reaper'а heartbeat"""
+        interval = float(app.config.get('HEARTBEAT_REAPER_INTERVAL_SECONDS', 5))
+        while True:
+            socketio.sleep(interval)
+            with app.app_context():
+                try:
+                    self.reap_expired_connections(socketio)
+                except Exception as e:
+                    app.logger.error(f"Ошибка reaper'а heartbeat: {e}")
+    
+    def reap_expired_connections(self, socketio) -> List[int]:
+        """Истекает все просроченные соединения пачками и рассылает события offline"""
+        batch_size = int(current_app.config.get('HEARTBEAT_REAPER_BATCH_SIZE', 500))
+        expired_total: List[int] = []
+        while True:
+            expired = conn_mgr.reap_expired(batch_size=batch_size)
+            for user_id in expired:
+                self._expire_user(socketio, user_id)
+            expired_total.extend(expired)
+            if len(expired) < batch_size:
+                break
+        if expired_total:
+            current_app.logger.info(f"Истекли соединения без heartbeat: {expired_total}")
+        return expired_total
+    
+    def _expire_user(self, socketio, user_id: int) -> None:
+        """Убирает пользователя с истекшим heartbeat из комнат и оповещает клиентов"""
+        rooms = sorted(user_state.get_user_rooms(user_id))
+        username = user_state.get_member_name(user_id, rooms)
+        
+        versions = user_state.remove_user_from_rooms(user_id, rooms)
+        for room_name in rooms:
+            socketio.emit('user_left', {
+                'user_id': user_id,
+                'username': username,
+                'room': room_name
+            }, room=room_name)
+            if room_name in versions:
+                socketio.emit('members_delta', self._members_delta(room_name, versions[room_name], removed=[user_id]),
+                              room=room_name)
+        
+        UserService.mark_seen(user_id)
+        presence_broadcaster.record(user_id, False, rooms)
+        
+        self._cleanup_empty_rooms(rooms, socketio=socketio)
+    
     def handle_create_room(self, data: Dict) -> None:
         """Обрабатывает создание комнаты"""
         if not current_user.is_authenticated:
@@ -255,35 +307,8 @@ class WebSocketService:
         user_id = current_user.id
         username = current_user.username
         
-        # Выходим из предыдущих комнат (кроме DM комнат и комнаты по умолчанию)
-        for existing_room_name, users in list(self.active_users.items()):
-            if not existing_room_name.startswith('dm_') and user_id in users and existing_room_name != room_name:
-                leave_room(existing_room_name)
-                del self.active_users[existing_room_name][user_id]
-                
-                # Синхронизируем удаление пользователя из менеджера состояния (Redis/in-memory)
-                try:
-                    user_state.remove_user_from_room(user_id, existing_room_name)
-                except Exception as e:
-                    current_app.logger.warning(f"Redis remove_user_from_room failed: {e}")
-                
-                emit('user_left', {
-                    'user_id': user_id,
-                    'username': username,
-                    'room': existing_room_name,
-                }, room=existing_room_name)
-                
-                # Отправляем обновленный список пользователей
-                emit('current_users', {
-                    'users': dict(self.active_users[existing_room_name]),
-                    'room': existing_room_name
-                }, room=existing_room_name)
-                
-                # ПРОВЕРЯЕМ И УДАЛЯЕМ ПУСТЫЕ КОМНАТЫ
-                self._check_and_cleanup_empty_room(existing_room_name)
-        
-        # Получаем комнату или создаем если не существует
-        room = RoomService.get_room_by_name(room_name)
+        # Получаем комнату или создаем если не существует (кэш сверяется с БД: комнату могли удалить)
+        room = RoomService.get_room_ref(room_name, strict=True)
         if not room:
             room = RoomService.create_room(
                 name=room_name,
@@ -293,20 +318,23 @@ class WebSocketService:
                 emit('room_join_error', {'error': 'Не удалось создать комнату'})
                 return
         
+        # Предыдущие комнаты (кроме DM комнат), из которых выходим при переключении
+        left_rooms = self._switchable_user_rooms(user_id, exclude=room_name)
+        for existing_room_name in left_rooms:
+            leave_room(existing_room_name)
+        
         # Присоединяемся к комнате
         join_room(room_name)
         
-        # Добавляем в локальный кеш
-        if room_name not in self.active_users:
-            self.active_users[room_name] = {}
-        self.active_users[room_name][user_id] = username
-        
-        # Добавляем в Redis
+        # Выход из старых комнат и вход в новую — одна атомарная операция в менеджере состояния
         try:
             user_state.ensure_room_exists(room_name)
-            user_state.add_user_to_room(user_id, username, room_name)
+            versions = user_state.move_user_to_room(user_id, username, room_name, left_rooms)
         except Exception as e:
-            current_app.logger.warning(f"Redis add_user_to_room failed: {e}")
+            current_app.logger.warning(f"Redis move_user_to_room failed: {e}")
+            versions = {}
+        
+        self._notify_rooms_left(user_id, username, left_rooms, versions)
         
         # Уведомляем других пользователей
         emit('user_joined', {
@@ -314,17 +342,46 @@ class WebSocketService:
             'username': username,
             'room': room_name
         }, room=room_name, include_self=False)
+        if room_name in versions:
+            emit('members_delta', self._members_delta(room_name, versions[room_name], added={user_id: username}),
+                 room=room_name, include_self=False)
         
-        # Отправляем список пользователей в комнате
+        # Вошедшему — полный снимок состава с версией
         self._send_room_users(room_name)
         
         # Обновляем список комнат
         self._broadcast_room_list()
         
-        # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА: проверяем все комнаты на пустоту после переключения
-        for check_room_name, check_users in list(self.active_users.items()):
-            if not check_room_name.startswith('dm_') and check_room_name != self.DEFAULT_ROOM and len(check_users) == 0:
-                self._check_and_cleanup_empty_room(check_room_name)
+        # ПРОВЕРЯЕМ И УДАЛЯЕМ ПУСТЫЕ КОМНАТЫ: опустеть могли только покинутые комнаты
+        self._cleanup_empty_rooms(left_rooms)
+    
+    def _switchable_user_rooms(self, user_id: int, exclude: Optional[str] = None) -> List[str]:
+        """Обычные (не DM) комнаты пользователя по обратному индексу user -> rooms"""
+        try:
+            rooms = user_state.get_user_rooms(user_id)
+        except Exception as e:
+            current_app.logger.warning(f"Redis get_user_rooms failed: {e}")
+            return []
+        return sorted(room for room in rooms if not room.startswith('dm_') and room != exclude)
+    
+    @staticmethod
+    def _members_delta(room_name: str, version: int, added: Optional[Dict[int, str]] = None,
+                       removed: Optional[List[int]] = None) -> Dict[str, Any]:
+        """Изменение состава комнаты; клиент применяет его, только если version — следующая за известной"""
+        return {'room': room_name, 'version': version, 'added': added or {}, 'removed': removed or []}
+    
+    def _notify_rooms_left(self, user_id: int, username: str, room_names: List[str],
+                           versions: Dict[str, int]) -> None:
+        """Рассылает user_left/members_delta по покинутым комнатам"""
+        for room_name in room_names:
+            emit('user_left', {
+                'user_id': user_id,
+                'username': username,
+                'room': room_name,
+            }, room=room_name)
+            if room_name in versions:
+                emit('members_delta', self._members_delta(room_name, versions[room_name], removed=[user_id]),
+                     room=room_name)
     
     def handle_leave_room(self, data: Dict) -> None:
         """Обрабатывает выход из комнаты"""
@@ -339,18 +396,22 @@ class WebSocketService:
         username = current_user.username
         
         # Проверяем, что пользователь находится в этой комнате
-        if room_name not in self.active_users or user_id not in self.active_users[room_name]:
+        try:
+            if room_name not in user_state.get_user_rooms(user_id):
+                return
+        except Exception as e:
+            current_app.logger.warning(f"Redis get_user_rooms failed: {e}")
             return
         
         # Выходим из комнаты
         leave_room(room_name)
-        del self.active_users[room_name][user_id]
         
-        # Удаляем из Redis
+        # Удаляем из менеджера состояния
         try:
-            user_state.remove_user_from_room(user_id, room_name)
+            version = user_state.remove_user_from_room(user_id, room_name)
         except Exception as e:
             current_app.logger.warning(f"Redis remove_user_from_room failed: {e}")
+            version = None
         
         # Уведомляем остальных пользователей
         emit('user_left', {
@@ -359,14 +420,13 @@ class WebSocketService:
             'room': room_name
         }, room=room_name, include_self=False)
         
-        # Отправляем обновленный список пользователей
-        emit('current_users', {
-            'users': dict(self.active_users[room_name]),
-            'room': room_name
-        }, room=room_name)
+        # Остальным — только изменение состава
+        if version is not None:
+            emit('members_delta', self._members_delta(room_name, version, removed=[user_id]),
+                 room=room_name, include_self=False)
         
         # ПРОВЕРЯЕМ И УДАЛЯЕМ ПУСТЫЕ КОМНАТЫ
-        self._check_and_cleanup_empty_room(room_name)
+        self._cleanup_empty_rooms([room_name])
     
     def handle_send_message(self, data: Dict) -> None:
         """Обрабатывает отправку сообщения"""
@@ -381,7 +441,7 @@ class WebSocketService:
             return
         
         # Получаем комнату или создаем если не существует
-        room = RoomService.get_room_by_name(room_name)
+        room = RoomService.get_room_ref(room_name)
         if not room:
             # Создаем комнату если не существует (как в sockets_old.py)
             room = RoomService.create_room(
@@ -401,15 +461,12 @@ class WebSocketService:
         
         if message:
             # ИСПРАВЛЕНО: используем формат как в sockets_old.py и ИСКЛЮЧАЕМ отправителя
+            # Канонический словарь уже построен при создании сообщения (буфер комнаты)
+            payload = message_serializer.payload(message, current_user.username)
             emit('new_message', {
-                'sender_id': message.sender_id,
-                'sender_username': current_user.username,
-                'content': message.content,
+                **payload,
                 'room': room_name,
-                'room_id': room.id,
-                'timestamp': message.timestamp.isoformat(),
-                'created_at': message.timestamp.isoformat(),
-                'is_dm': False,
+                'created_at': payload['timestamp'],
             }, room=room_name, include_self=False)  # ИСКЛЮЧАЕМ отправителя
         else:
             emit('message_error', {'error': 'Не удалось отправить сообщение'})
@@ -469,14 +526,7 @@ class WebSocketService:
         
         if message:
             # Формируем данные сообщения как в sockets_old.py
-            message_data = {
-                'sender_id': current_user.id,
-                'sender_username': current_user.username,
-                'recipient_id': recipient_id,
-                'content': message.content,
-                'timestamp': message.timestamp.isoformat(),
-                'is_dm': True
-            }
+            message_data = message_serializer.payload(message, current_user.username)
             
             current_app.logger.info(f"🔵 [DM DEBUG] Данные сообщения сформированы: {message_data}")
             
@@ -484,16 +534,9 @@ class WebSocketService:
             try:
                 current_app.logger.info(f"🔵 [DM DEBUG] Ищем SID для получателя {recipient_id}")
                 
-                # Упрощенная логика - сначала локальный кеш, потом Redis (как в sockets_old.py)
-                recipient_sid = self.connected_users.get(int(recipient_id))
-                current_app.logger.info(f"🔵 [DM DEBUG] Локальный SID: {recipient_sid}")
-                
-                if not recipient_sid:
-                    # Fallback на Redis
-                    recipient_sid = conn_mgr.get_user_socket(int(recipient_id))
-                    current_app.logger.info(f"🔵 [DM DEBUG] Redis SID: {recipient_sid}")
-                
-                current_app.logger.info(f"🔵 [DM DEBUG] Все подключенные пользователи: {self.connected_users}")
+                # SID получателя из общего менеджера соединений (видит все воркеры)
+                recipient_sid = conn_mgr.get_user_socket(int(recipient_id))
+                current_app.logger.info(f"🔵 [DM DEBUG] SID получателя: {recipient_sid}")
                 
                 if recipient_sid:
                     current_app.logger.info(f"🔵 [DM DEBUG] Отправляем new_dm в room={recipient_sid}")
@@ -548,23 +591,30 @@ class WebSocketService:
         # Присоединяемся к комнате
         join_room(self.DEFAULT_ROOM)
         
-        # Добавляем в локальный кеш
-        self.active_users[self.DEFAULT_ROOM][user_id] = username
-        
-        # Добавляем в Redis
+        # Комнаты, оставшиеся от вытесненного соединения: новый сокет в них не входит
+        stale_rooms = self._switchable_user_rooms(user_id, exclude=self.DEFAULT_ROOM)
         try:
             user_state.ensure_room_exists(self.DEFAULT_ROOM)
-            user_state.add_user_to_room(user_id, username, self.DEFAULT_ROOM)
+            versions = user_state.move_user_to_room(user_id, username, self.DEFAULT_ROOM, stale_rooms)
         except Exception as e:
-            current_app.logger.warning(f"Redis add_user_to_room failed: {e}")
+            current_app.logger.warning(f"Redis move_user_to_room failed: {e}")
+            versions = {}
+        
+        if self.DEFAULT_ROOM in versions:
+            emit('members_delta', self._members_delta(self.DEFAULT_ROOM, versions[self.DEFAULT_ROOM],
+                                                      added={user_id: username}),
+                 room=self.DEFAULT_ROOM, include_self=False)
+        if stale_rooms:
+            self._notify_rooms_left(user_id, username, stale_rooms, versions)
+            self._cleanup_empty_rooms(stale_rooms)
     
     def _send_initial_data(self, user_id: int) -> None:
         """Отправляет начальные данные пользователю"""
         # Отправляем список пользователей в комнате по умолчанию
         self._send_room_users(self.DEFAULT_ROOM)
         
-        # Отправляем список комнат
-        self._broadcast_room_list()
+        # Отправляем список комнат только подключившемуся клиенту; остальные получают diff
+        self._send_room_list()
         
         # Отправляем историю сообщений для комнаты по умолчанию
         self.handle_get_message_history({
@@ -573,40 +623,39 @@ class WebSocketService:
         })
     
     def _send_room_users(self, room_name: str) -> None:
-        """Отправляет список пользователей в комнате"""
+        """Отправляет текущему клиенту полный состав комнаты с версией (дальше — members_delta)"""
         try:
-            users = user_state.get_room_users(room_name)
-        except Exception:
-            users = dict(self.active_users.get(room_name, {}))
+            version, users = user_state.get_room_snapshot(room_name)
+        except Exception as e:
+            current_app.logger.warning(f"Redis get_room_snapshot failed: {e}")
+            version, users = 0, {}
         
-        emit('current_users', {'users': users, 'room': room_name})
+        emit('current_users', {'users': users, 'room': room_name, 'version': version})
     
-    def _broadcast_room_list(self) -> None:
-        """Отправляет обновленный список комнат всем клиентам"""
-        # ИСПРАВЛЕНО: извлекаем только названия комнат как в sockets_old.py
-        rooms_data = RoomService.get_all_rooms()
-        rooms_list = [room['name'] for room in rooms_data]
-        emit('room_list', {'rooms': rooms_list}, broadcast=True)
+    def _broadcast_room_list(self, socketio=None) -> None:
+        """Планирует рассылку изменений списка комнат (room_list_delta в конце окна debounce)"""
+        room_list_broadcaster.mark_dirty()
+    
+    def _send_room_list(self) -> None:
+        """Отправляет текущему клиенту полный список комнат с номером версии"""
+        version, rooms_list = room_list_broadcaster.snapshot()
+        emit('room_list', {'rooms': rooms_list, 'version': version})
+    
+    def handle_get_room_list(self, data: Optional[Dict] = None) -> None:
+        """Запрос полного списка комнат (клиент пропустил версию diff'а)"""
+        if not current_user.is_authenticated:
+            return
+        self._send_room_list()
     
     def handle_get_current_users(self, data: Dict) -> None:
         """Запрос списка пользователей в текущей комнате"""
         if not current_user.is_authenticated:
             return
         
-        room_name = data.get('room', self.DEFAULT_ROOM)
-        
-        # Получаем пользователей из локального кеша
-        users = dict(self.active_users.get(room_name, {}))
+        room_name = (data or {}).get('room', self.DEFAULT_ROOM)
         
-        # Убеждаемся, что текущий пользователь включен в список
-        if current_user.id not in users:
-            users[current_user.id] = current_user.username
-            
-        current_app.logger.info(f"Запрос списка пользователей для комнаты {room_name}: {users}")
-        emit('current_users', {
-            'users': users,
-            'room': room_name
-        })
+        # Полный снимок: первичная загрузка и ресинхронизация после пропуска версии members_delta
+        self._send_room_users(room_name)
     
     def handle_load_more_messages(self, data: Dict) -> None:
         """Загрузка дополнительных сообщений с пагинацией"""
@@ -617,23 +666,27 @@ class WebSocketService:
         room_name = data.get('room')
         offset = data.get('offset', 0)
         limit = data.get('limit', 10)
+        before_id = data.get('before_id')
+        before_ts = data.get('before_ts')
         
         
         try:
             # Проверяем, что комната существует
-            room = RoomService.get_room_by_name(room_name)
+            room = RoomService.get_room_ref(room_name)
             if not room:
                 current_app.logger.warning(f"LOAD MORE: Комната '{room_name}' не найдена")
                 emit('load_more_error', {'error': 'Комната не найдена'})
                 return
             
             # Загружаем сообщения через сервис
-            messages_data = MessageService.get_room_messages(room.id, limit, offset)
+            messages_data = MessageService.get_room_messages(room.id, limit, offset,
+                                                             before_id=before_id, before_ts=before_ts)
             
             emit('more_messages_loaded', {
                 'messages': messages_data,
                 'has_more': len(messages_data) == limit,
                 'offset': offset + len(messages_data),
+                'cursor': MessageService.history_cursor(messages_data),
                 'room': room_name
             })
             
@@ -654,7 +707,7 @@ class WebSocketService:
         
         try:
             # Находим комнату
-            room = RoomService.get_room_by_name(room_name)
+            room = RoomService.get_room_ref(room_name)
             if not room:
                 return
             
@@ -665,6 +718,7 @@ class WebSocketService:
             emit('message_history', {
                 'room': room_name,
                 'messages': messages_data,
+                'cursor': MessageService.history_cursor(messages_data),
                 'has_more': len(messages_data) == limit
             })
             
@@ -790,6 +844,6 @@ class WebSocketService:
         # Сервер просто пересылает сигнал получателю
         recipient_id = data.get('recipient_id')
         if recipient_id:
-            recipient_sid = self.connected_users.get(int(recipient_id))
+            recipient_sid = conn_mgr.get_user_socket(int(recipient_id))
             if recipient_sid:
                 emit('update_unread_indicator', data, room=recipient_sid)
@@ -1,11 +1,32 @@
 """
 Менеджеры состояния для WebSocket соединений и комнат
 """
-from typing import Dict, Set, Optional, Any
+from typing import Dict, Set, Optional, Any, Iterable, List, Tuple
+import heapq
 import logging
+import threading
 import time
 from flask import current_app
 from app import extensions
+from app.circuit_breaker import redis_breaker
+
+
+def _redis():
+    """Возвращает Redis клиент, если он настроен и circuit breaker пропускает запросы"""
+    client = extensions.redis_client
+    if client is None:
+        return None
+    redis_breaker.bind(client)
+    return client if redis_breaker.allow_request() else None
+
+
+# Сверка повторяется, пока во время нее в память пишут новые изменения (выключатель еще полуоткрыт)
+_RECONCILE_PASSES = 5
+
+
+def _degraded() -> bool:
+    """Redis настроен, но сейчас работаем в памяти — изменения нужно будет сверить"""
+    return extensions.redis_client is not None
 
 
 class UserStateManager:
@@ -16,137 +37,406 @@ class UserStateManager:
         # В продакшене должно быть Redis
         self._room_users: Dict[str, Dict[int, str]] = {}
         self._user_rooms: Dict[int, Set[str]] = {}
+        self._room_versions: Dict[str, int] = {}
+        # Выходы из комнат, сделанные в памяти во время недоступности Redis
+        self._pending_removals: Set[Tuple[int, str]] = set()
+        # Изменения памяти и подмена структур при сверке с Redis
+        self._memory_lock = threading.RLock()
         # Redis keyspace
         self._room_users_key_tpl = "room:{room}:users"
         self._user_rooms_key_tpl = "user:{user_id}:rooms"
+        # Версия состава комнаты: увеличивается в той же транзакции, что и изменение состава
+        self._room_version_key_tpl = "room:{room}:version"
     
     def ensure_room_exists(self, room_name: str) -> None:
         """Убеждается, что комната существует"""
-        if extensions.redis_client is not None:
+        if _redis() is not None:
             # В Redis комната появится при первом добавлении пользователя.
             # Здесь no-op, чтобы не плодить пустые ключи.
             return
-        if room_name not in self._room_users:
-            self._room_users[room_name] = {}
-            current_app.logger.debug(f"Создана комната (in-memory): {room_name}")
+        with self._memory_lock:
+            if room_name not in self._room_users:
+                self._room_users[room_name] = {}
+                current_app.logger.debug(f"Создана комната (in-memory): {room_name}")
     
-    def add_user_to_room(self, user_id: int, username: str, room_name: str) -> None:
-        """Добавляет пользователя в комнату"""
-        if extensions.redis_client is not None:
+    def add_user_to_room(self, user_id: int, username: str, room_name: str) -> Dict[str, int]:
+        """Добавляет пользователя в комнату, возвращает новую версию состава {room: version}"""
+        client = _redis()
+        if client is not None:
             try:
                 room_hash = self._room_users_key_tpl.format(room=room_name)
                 user_set = self._user_rooms_key_tpl.format(user_id=user_id)
-                extensions.redis_client.hset(room_hash, mapping={str(user_id): username})
-                extensions.redis_client.sadd(user_set, room_name)
+                # MULTI/EXEC в одном round trip: хеш комнаты и множество пользователя меняются атомарно
+                pipe = client.pipeline(transaction=True)
+                pipe.hset(room_hash, mapping={str(user_id): username})
+                pipe.sadd(user_set, room_name)
+                pipe.incr(self._room_version_key_tpl.format(room=room_name))
+                results = pipe.execute()
                 current_app.logger.debug(f"[Redis] Пользователь {username} добавлен в комнату {room_name}")
-                return
+                redis_breaker.record_success()
+                return {room_name: int(results[-1])}
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis add_user_to_room failed, fallback to memory: {e}")
 
-        self.ensure_room_exists(room_name)
-        self._room_users[room_name][user_id] = username
-        if user_id not in self._user_rooms:
-            self._user_rooms[user_id] = set()
-        self._user_rooms[user_id].add(room_name)
+        self._memory_add(user_id, username, room_name)
         current_app.logger.debug(f"[Memory] Пользователь {username} добавлен в комнату {room_name}")
+        return {room_name: self._memory_bump(room_name)}
+    
+    def remove_user_from_room(self, user_id: int, room_name: str) -> Optional[int]:
+        """Удаляет пользователя из комнаты, возвращает новую версию состава"""
+        return self.remove_user_from_rooms(user_id, [room_name]).get(room_name)
     
-    def remove_user_from_room(self, user_id: int, room_name: str) -> None:
-        """Удаляет пользователя из комнаты"""
-        if extensions.redis_client is not None:
+    def remove_user_from_rooms(self, user_id: int, room_names: Iterable[str]) -> Dict[str, int]:
+        """Удаляет пользователя из нескольких комнат одной транзакцией, возвращает {room: version}"""
+        room_names = list(room_names)
+        if not room_names:
+            return {}
+        client = _redis()
+        if client is not None:
             try:
-                room_hash = self._room_users_key_tpl.format(room=room_name)
                 user_set = self._user_rooms_key_tpl.format(user_id=user_id)
-                # Получим имя, чтобы залогировать
-                username = extensions.redis_client.hget(room_hash, str(user_id))
-                extensions.redis_client.hdel(room_hash, str(user_id))
-                extensions.redis_client.srem(user_set, room_name)
-                current_app.logger.debug(f"[Redis] Пользователь {username} удален из комнаты {room_name}")
-                return
+                pipe = client.pipeline(transaction=True)
+                for room_name in room_names:
+                    pipe.hdel(self._room_users_key_tpl.format(room=room_name), str(user_id))
+                pipe.srem(user_set, *room_names)
+                for room_name in room_names:
+                    pipe.incr(self._room_version_key_tpl.format(room=room_name))
+                results = pipe.execute()
+                current_app.logger.debug(f"[Redis] Пользователь {user_id} удален из комнат {room_names}")
+                redis_breaker.record_success()
+                return dict(zip(room_names, (int(v) for v in results[-len(room_names):])))
             except Exception as e:
-                current_app.logger.warning(f"Redis remove_user_from_room failed, fallback to memory: {e}")
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis remove_user_from_rooms failed, fallback to memory: {e}")
 
-        if room_name in self._room_users and user_id in self._room_users[room_name]:
-            username = self._room_users[room_name].pop(user_id)
-            if user_id in self._user_rooms:
+        versions = {}
+        for room_name in room_names:
+            if self._memory_remove(user_id, room_name):
+                current_app.logger.debug(f"[Memory] Пользователь {user_id} удален из комнаты {room_name}")
+            versions[room_name] = self._memory_bump(room_name)
+        return versions
+    
+    def move_user_to_room(self, user_id: int, username: str, room_name: str,
+                          leave_rooms: Iterable[str] = ()) -> Dict[str, int]:
+        """Атомарно переводит пользователя из leave_rooms в room_name (один round trip); {room: version}"""
+        leave_rooms = [r for r in leave_rooms if r != room_name]
+        changed = leave_rooms + [room_name]
+        client = _redis()
+        if client is not None:
+            try:
+                user_set = self._user_rooms_key_tpl.format(user_id=user_id)
+                pipe = client.pipeline(transaction=True)
+                for old_room in leave_rooms:
+                    pipe.hdel(self._room_users_key_tpl.format(room=old_room), str(user_id))
+                if leave_rooms:
+                    pipe.srem(user_set, *leave_rooms)
+                pipe.hset(self._room_users_key_tpl.format(room=room_name), mapping={str(user_id): username})
+                pipe.sadd(user_set, room_name)
+                for changed_room in changed:
+                    pipe.incr(self._room_version_key_tpl.format(room=changed_room))
+                results = pipe.execute()
+                current_app.logger.debug(f"[Redis] Пользователь {username} переведен в комнату {room_name} из {leave_rooms}")
+                redis_breaker.record_success()
+                return dict(zip(changed, (int(v) for v in results[-len(changed):])))
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis move_user_to_room failed, fallback to memory: {e}")
+
+        for old_room in leave_rooms:
+            self._memory_remove(user_id, old_room)
+        self._memory_add(user_id, username, room_name)
+        current_app.logger.debug(f"[Memory] Пользователь {username} переведен в комнату {room_name} из {leave_rooms}")
+        return {changed_room: self._memory_bump(changed_room) for changed_room in changed}
+    
+    def _memory_bump(self, room_name: str) -> int:
+        with self._memory_lock:
+            self._room_versions[room_name] = self._room_versions.get(room_name, 0) + 1
+            return self._room_versions[room_name]
+    
+    def _memory_add(self, user_id: int, username: str, room_name: str) -> None:
+        """Добавляет пользователя в in-memory хранилище"""
+        with self._memory_lock:
+            if room_name not in self._room_users:
+                self._room_users[room_name] = {}
+            self._room_users[room_name][user_id] = username
+            self._user_rooms.setdefault(user_id, set()).add(room_name)
+            self._pending_removals.discard((user_id, room_name))
+    
+    def _memory_remove(self, user_id: int, room_name: str) -> bool:
+        """Удаляет пользователя из in-memory хранилища, возвращает True если он там был"""
+        with self._memory_lock:
+            if _degraded():
+                self._pending_removals.add((user_id, room_name))
+            if room_name in self._user_rooms.get(user_id, ()):
                 self._user_rooms[user_id].discard(room_name)
-            current_app.logger.debug(f"[Memory] Пользователь {username} удален из комнаты {room_name}")
+            if room_name in self._room_users and user_id in self._room_users[room_name]:
+                del self._room_users[room_name][user_id]
+                return True
+            return False
     
     def get_room_users(self, room_name: str) -> Dict[int, str]:
         """Возвращает пользователей в комнате"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
                 room_hash = self._room_users_key_tpl.format(room=room_name)
-                data = extensions.redis_client.hgetall(room_hash) or {}
+                data = client.hgetall(room_hash) or {}
                 # Ключи в Redis строки, конвертируем user_id в int где возможно
+                redis_breaker.record_success()
                 return {int(uid): uname for uid, uname in data.items() if uid.isdigit()}
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis get_room_users failed, fallback to memory: {e}")
         return self._room_users.get(room_name, {}).copy()
     
+    def get_room_snapshot(self, room_name: str) -> Tuple[int, Dict[int, str]]:
+        """Состав комнаты вместе с его версией (одна транзакция: версия соответствует составу)"""
+        client = _redis()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=True)
+                pipe.hgetall(self._room_users_key_tpl.format(room=room_name))
+                pipe.get(self._room_version_key_tpl.format(room=room_name))
+                data, version = pipe.execute()
+                redis_breaker.record_success()
+                return int(version or 0), {int(uid): uname for uid, uname in (data or {}).items() if uid.isdigit()}
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis get_room_snapshot failed, fallback to memory: {e}")
+        return self._room_versions.get(room_name, 0), self._room_users.get(room_name, {}).copy()
+    
+    def get_member_name(self, user_id: int, room_names: Iterable[str]) -> Optional[str]:
+        """Имя пользователя из любой его комнаты (HGET по комнатам, без чтения всего состава)"""
+        room_names = list(room_names)
+        if not room_names:
+            return None
+        client = _redis()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                for room_name in room_names:
+                    pipe.hget(self._room_users_key_tpl.format(room=room_name), str(user_id))
+                names = pipe.execute()
+                redis_breaker.record_success()
+                return next((name for name in names if name is not None), None)
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis get_member_name failed, fallback to memory: {e}")
+        return next((self._room_users[room_name][user_id] for room_name in room_names
+                     if user_id in self._room_users.get(room_name, {})), None)
+    
+    def get_rooms_users(self, room_names: Iterable[str]) -> Dict[str, Dict[int, str]]:
+        """Возвращает пользователей нескольких комнат одним пайплайном HGETALL"""
+        room_names = list(dict.fromkeys(room_names))
+        if not room_names:
+            return {}
+        client = _redis()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                for room_name in room_names:
+                    pipe.hgetall(self._room_users_key_tpl.format(room=room_name))
+                results = pipe.execute()
+                redis_breaker.record_success()
+                return {
+                    room_name: {int(uid): uname for uid, uname in (data or {}).items() if uid.isdigit()}
+                    for room_name, data in zip(room_names, results)
+                }
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis get_rooms_users failed, fallback to memory: {e}")
+        return {room_name: self._room_users.get(room_name, {}).copy() for room_name in room_names}
+    
+    def get_room_user_counts(self, room_names: Iterable[str]) -> Dict[str, int]:
+        """Возвращает количество пользователей в комнатах одним пайплайном HLEN"""
+        room_names = list(dict.fromkeys(room_names))
+        if not room_names:
+            return {}
+        client = _redis()
+        if client is not None:
+            try:
+                pipe = client.pipeline(transaction=False)
+                for room_name in room_names:
+                    pipe.hlen(self._room_users_key_tpl.format(room=room_name))
+                counts = pipe.execute()
+                redis_breaker.record_success()
+                return dict(zip(room_names, (int(n or 0) for n in counts)))
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis get_room_user_counts failed, fallback to memory: {e}")
+        return {room_name: len(self._room_users.get(room_name, {})) for room_name in room_names}
+    
     def get_user_rooms(self, user_id: int) -> Set[str]:
         """Возвращает комнаты пользователя"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
                 user_set = self._user_rooms_key_tpl.format(user_id=user_id)
-                rooms = extensions.redis_client.smembers(user_set) or set()
+                rooms = client.smembers(user_set) or set()
+                redis_breaker.record_success()
                 return set(rooms)
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis get_user_rooms failed, fallback to memory: {e}")
         return self._user_rooms.get(user_id, set()).copy()
     
     def cleanup_empty_room(self, room_name: str) -> None:
         """Удаляет пустую комнату"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
                 room_hash = self._room_users_key_tpl.format(room=room_name)
-                if extensions.redis_client.hlen(room_hash) == 0:
-                    extensions.redis_client.delete(room_hash)
+                if client.hlen(room_hash) == 0:
+                    client.delete(room_hash, self._room_version_key_tpl.format(room=room_name))
                     current_app.logger.debug(f"[Redis] Удалена пустая комната: {room_name}")
+                    redis_breaker.record_success()
                     return
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis cleanup_empty_room failed, fallback to memory: {e}")
-        if room_name in self._room_users and not self._room_users[room_name]:
-            del self._room_users[room_name]
-            current_app.logger.debug(f"[Memory] Удалена пустая комната: {room_name}")
+        with self._memory_lock:
+            if room_name in self._room_users and not self._room_users[room_name]:
+                del self._room_users[room_name]
+                self._room_versions.pop(room_name, None)
+                current_app.logger.debug(f"[Memory] Удалена пустая комната: {room_name}")
+    
+    def reconcile_to_redis(self, client) -> None:
+        """Переносит накопленное в памяти членство в Redis и очищает память"""
+        for _ in range(_RECONCILE_PASSES):
+            snapshot = self._take_memory()
+            if snapshot is None:
+                return
+            try:
+                self._replay_to_redis(client, *snapshot)
+            except Exception:
+                self._restore_memory(*snapshot)
+                raise
+    
+    def _take_memory(self):
+        """Забирает структуры памяти, подменяя их пустыми: записи во время сверки не теряются"""
+        with self._memory_lock:
+            if not self._room_users and not self._pending_removals:
+                return None
+            snapshot = (self._room_users, self._user_rooms, self._room_versions, self._pending_removals)
+            self._room_users, self._user_rooms, self._room_versions = {}, {}, {}
+            self._pending_removals = set()
+            return snapshot
+    
+    def _restore_memory(self, room_users, user_rooms, room_versions, pending_removals) -> None:
+        """Возвращает снимок после неудачной сверки; записи, сделанные после снимка, новее и главнее"""
+        with self._memory_lock:
+            newer_removals = set(self._pending_removals)
+            for room_name, users in room_users.items():
+                current = self._room_users.setdefault(room_name, {})
+                for user_id, username in users.items():
+                    if (user_id, room_name) not in newer_removals:
+                        current.setdefault(user_id, username)
+            for user_id, rooms in user_rooms.items():
+                for room_name in rooms:
+                    if (user_id, room_name) not in newer_removals:
+                        self._user_rooms.setdefault(user_id, set()).add(room_name)
+            for user_id, room_name in pending_removals:
+                if user_id not in self._room_users.get(room_name, {}):
+                    self._pending_removals.add((user_id, room_name))
+            for room_name, version in room_versions.items():
+                self._room_versions[room_name] = max(version, self._room_versions.get(room_name, 0))
+    
+    def _replay_to_redis(self, client, room_users, user_rooms, room_versions, pending_removals) -> None:
+        pipe = client.pipeline(transaction=True)
+        for user_id, room_name in pending_removals:
+            pipe.hdel(self._room_users_key_tpl.format(room=room_name), str(user_id))
+            pipe.srem(self._user_rooms_key_tpl.format(user_id=user_id), room_name)
+        for room_name, users in room_users.items():
+            if users:
+                pipe.hset(self._room_users_key_tpl.format(room=room_name),
+                          mapping={str(uid): uname for uid, uname in users.items()})
+        for user_id, rooms in user_rooms.items():
+            if rooms:
+                pipe.sadd(self._user_rooms_key_tpl.format(user_id=user_id), *rooms)
+        # Версии из памяти в Redis не переносятся: новая версия заставит клиентов перечитать состав
+        for room_name in {room for _, room in pending_removals} | set(room_users):
+            pipe.incr(self._room_version_key_tpl.format(room=room_name))
+        pipe.execute()
 
 
 class ConnectionManager:
     """Менеджер WebSocket соединений"""
     
+    # Lua: атомарно забирает пачку просроченных heartbeat и удаляет связанные соединения.
+    # Атомарность гарантирует, что при нескольких воркерах каждое истечение обработает ровно один из них.
+    _REAP_SCRIPT = """
+    local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+    for _, uid in ipairs(ids) do
+        redis.call('ZREM', KEYS[1], uid)
+        local sid = redis.call('HGET', KEYS[2], uid)
+        if sid then
+            redis.call('HDEL', KEYS[2], uid)
+            redis.call('HDEL', KEYS[3], sid)
+        end
+        redis.call('HDEL', KEYS[4], uid)
+    end
+    return ids
+    """
+    
     def __init__(self):
         # In-memory хранилище для разработки
         self._connections: Dict[int, str] = {}  # user_id -> socket_id
         self._socket_to_user: Dict[str, int] = {}  # socket_id -> user_id
+        self._usernames: Dict[int, str] = {}  # user_id -> username (для списка онлайн без БД)
         self._heartbeat_expires: Dict[int, float] = {}
+        # Min-heap (expires_at, user_id) для пакетного истечения; устаревшие записи отбрасываются лениво
+        self._expiry_heap: List[Tuple[float, int]] = []
+        # Соединения, закрытые в памяти во время недоступности Redis: user_id -> socket_id (None если не был в памяти)
+        self._pending_removals: Dict[int, Optional[str]] = {}
+        # Изменения памяти и подмена структур при сверке с Redis
+        self._memory_lock = threading.RLock()
         # Redis keyspace
         self._user_to_socket_key = "conn:user_to_socket"
         self._socket_to_user_key = "conn:socket_to_user"
-        self._heartbeat_key_tpl = "conn:heartbeat:{user_id}"
+        # Единый индекс heartbeat: ZSET user_id -> время истечения (unix time); источник статуса онлайн
+        self._heartbeats_key = "conn:heartbeats"
+        self._usernames_key = "conn:usernames"
+    
+    @staticmethod
+    def _default_ttl() -> float:
+        try:
+            return float(current_app.config.get('HEARTBEAT_TTL_SECONDS', 120))
+        except RuntimeError:
+            return 120.0  # fallback если нет контекста приложения
     
-    def register_connection(self, user_id: int, socket_id: str) -> None:
-        """Регистрирует новое соединение"""
+    def _set_memory_heartbeat(self, user_id: int, expires_at: float) -> None:
+        with self._memory_lock:
+            self._heartbeat_expires[user_id] = expires_at
+            heapq.heappush(self._expiry_heap, (expires_at, user_id))
+    
+    def register_connection(self, user_id: int, socket_id: str, username: Optional[str] = None) -> None:
+        """Регистрирует новое соединение (username нужен списку онлайн-пользователей)"""
+        expires_at = time.time() + self._default_ttl()
         # Пробуем Redis, если доступен
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
                 # Удалим старую обратную ссылку, если была
-                old_socket_id = extensions.redis_client.hget(self._user_to_socket_key, str(user_id))
+                old_socket_id = client.hget(self._user_to_socket_key, str(user_id))
+                pipe = client.pipeline(transaction=True)
                 if old_socket_id:
-                    extensions.redis_client.hdel(self._socket_to_user_key, old_socket_id)
-                extensions.redis_client.hset(self._user_to_socket_key, str(user_id), socket_id)
-                extensions.redis_client.hset(self._socket_to_user_key, socket_id, str(user_id))
+                    pipe.hdel(self._socket_to_user_key, old_socket_id)
+                pipe.hset(self._user_to_socket_key, str(user_id), socket_id)
+                pipe.hset(self._socket_to_user_key, socket_id, str(user_id))
                 # начальный heartbeat
-                try:
-                    ttl = int(current_app.config.get('HEARTBEAT_TTL_SECONDS', 120))
-                except RuntimeError:
-                    ttl = 120  # fallback если нет контекста приложения
-                hb_key = self._heartbeat_key_tpl.format(user_id=user_id)
-                extensions.redis_client.set(hb_key, '1', ex=ttl)
+                pipe.zadd(self._heartbeats_key, {str(user_id): expires_at})
+                if username is not None:
+                    pipe.hset(self._usernames_key, str(user_id), username)
+                pipe.execute()
                 try:
                     current_app.logger.debug(f"[Redis] Зарегистрировано соединение: user_id={user_id}, socket_id={socket_id}")
                 except RuntimeError:
                     pass  # fallback если нет контекста приложения
+                redis_breaker.record_success()
                 return
             except Exception as e:
+                redis_breaker.record_failure()
                 try:
                     current_app.logger.warning(f"Redis register_connection failed, fallback to memory: {e}")
                 except RuntimeError:
@@ -155,17 +445,16 @@ class ConnectionManager:
 
         # Fallback в память (если Redis недоступен или произошла ошибка)
         # Удаляем старое соединение если есть
-        if user_id in self._connections:
-            old_socket_id = self._connections[user_id]
-            if old_socket_id in self._socket_to_user:
-                del self._socket_to_user[old_socket_id]
-        self._connections[user_id] = socket_id
-        self._socket_to_user[socket_id] = user_id
-        try:
-            ttl = int(current_app.config.get('HEARTBEAT_TTL_SECONDS', 120))
-        except RuntimeError:
-            ttl = 120  # fallback если нет контекста приложения
-        self._heartbeat_expires[user_id] = time.time() + ttl
+        with self._memory_lock:
+            if user_id in self._connections:
+                old_socket_id = self._connections[user_id]
+                if old_socket_id in self._socket_to_user:
+                    del self._socket_to_user[old_socket_id]
+            self._connections[user_id] = socket_id
+            self._socket_to_user[socket_id] = user_id
+            if username is not None:
+                self._usernames[user_id] = username
+            self._set_memory_heartbeat(user_id, expires_at)
         try:
             current_app.logger.debug(f"[Memory] Зарегистрировано соединение: user_id={user_id}, socket_id={socket_id}")
         except RuntimeError:
@@ -173,106 +462,259 @@ class ConnectionManager:
     
     def remove_connection(self, user_id: int) -> None:
         """Удаляет соединение пользователя"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
-                socket_id = extensions.redis_client.hget(self._user_to_socket_key, str(user_id))
+                socket_id = client.hget(self._user_to_socket_key, str(user_id))
+                pipe = client.pipeline(transaction=True)
                 if socket_id:
-                    extensions.redis_client.hdel(self._user_to_socket_key, str(user_id))
-                    extensions.redis_client.hdel(self._socket_to_user_key, socket_id)
-                hb_key = self._heartbeat_key_tpl.format(user_id=user_id)
-                extensions.redis_client.delete(hb_key)
+                    pipe.hdel(self._user_to_socket_key, str(user_id))
+                    pipe.hdel(self._socket_to_user_key, socket_id)
+                pipe.zrem(self._heartbeats_key, str(user_id))
+                pipe.hdel(self._usernames_key, str(user_id))
+                pipe.execute()
                 current_app.logger.debug(f"[Redis] Удалено соединение: user_id={user_id}")
+                redis_breaker.record_success()
                 return
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis remove_connection failed, fallback to memory: {e}")
 
-        if user_id in self._connections:
-            socket_id = self._connections[user_id]
-            del self._connections[user_id]
-            if socket_id in self._socket_to_user:
-                del self._socket_to_user[socket_id]
-        self._heartbeat_expires.pop(user_id, None)
+        self._remove_memory_connection(user_id)
         current_app.logger.debug(f"[Memory] Удалено соединение: user_id={user_id}")
     
+    def _remove_memory_connection(self, user_id: int) -> None:
+        with self._memory_lock:
+            if _degraded():
+                self._pending_removals[user_id] = self._connections.get(user_id)
+            if user_id in self._connections:
+                socket_id = self._connections[user_id]
+                del self._connections[user_id]
+                if socket_id in self._socket_to_user:
+                    del self._socket_to_user[socket_id]
+            # Запись в куче станет устаревшей и будет отброшена при следующем reap
+            self._heartbeat_expires.pop(user_id, None)
+            self._usernames.pop(user_id, None)
+    
     def get_user_socket(self, user_id: int) -> Optional[str]:
         """Возвращает socket_id пользователя"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
-                return extensions.redis_client.hget(self._user_to_socket_key, str(user_id))
+                socket_id = client.hget(self._user_to_socket_key, str(user_id))
+                redis_breaker.record_success()
+                return socket_id
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis get_user_socket failed, fallback to memory: {e}")
         return self._connections.get(user_id)
     
     def get_socket_user(self, socket_id: str) -> Optional[int]:
         """Возвращает user_id по socket_id"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
-                uid = extensions.redis_client.hget(self._socket_to_user_key, socket_id)
+                uid = client.hget(self._socket_to_user_key, socket_id)
+                redis_breaker.record_success()
                 return int(uid) if uid is not None and str(uid).isdigit() else None
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis get_socket_user failed, fallback to memory: {e}")
         return self._socket_to_user.get(socket_id)
     
     def is_user_connected(self, user_id: int) -> bool:
         """Проверяет, подключен ли пользователь"""
-        if extensions.redis_client is not None:
+        return user_id in self.connected_users([user_id])
+    
+    def connected_users(self, user_ids: Iterable[int]) -> Set[int]:
+        """Возвращает подмножество user_ids с живым heartbeat (один пайплайн ZSCORE)"""
+        user_ids = list(dict.fromkeys(user_ids))
+        if not user_ids:
+            return set()
+        now = time.time()
+        client = _redis()
+        if client is not None:
             try:
-                hb_key = self._heartbeat_key_tpl.format(user_id=user_id)
-                return extensions.redis_client.exists(hb_key) == 1
+                pipe = client.pipeline(transaction=False)
+                for user_id in user_ids:
+                    pipe.zscore(self._heartbeats_key, str(user_id))
+                scores = pipe.execute()
+                redis_breaker.record_success()
+                return {
+                    user_id for user_id, score in zip(user_ids, scores)
+                    if score is not None and float(score) > now
+                }
             except Exception as e:
-                current_app.logger.warning(f"Redis is_user_connected failed, fallback to memory: {e}")
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis connected_users failed, fallback to memory: {e}")
         
         # Fallback to memory logic
-        # Check if user has a connection
-        if user_id not in self._connections:
-            return False
-        
-        # Check heartbeat expiration if it exists
-        exp = self._heartbeat_expires.get(user_id)
-        if exp is not None:
+        connected = set()
+        for user_id in user_ids:
+            if user_id not in self._connections:
+                continue
+            exp = self._heartbeat_expires.get(user_id)
             # Считаем соединение активным, пока текущее время строго меньше exp
-            if time.time() >= exp:
+            if exp is not None and now >= exp:
                 # Срок действия heartbeat истёк — очищаем соединение
-                self.remove_connection(user_id)
-                return False
-            return True
+                self._remove_memory_connection(user_id)
+                continue
+            connected.add(user_id)
+        return connected
+
+    def online_users(self) -> Dict[int, str]:
+        """Пользователи с живым heartbeat {user_id: username}: O(онлайн), без обращения к БД"""
+        now = time.time()
+        client = _redis()
+        if client is not None:
+            try:
+                user_ids = client.zrangebyscore(self._heartbeats_key, f"({now}", '+inf')
+                names = client.hmget(self._usernames_key, user_ids) if user_ids else []
+                redis_breaker.record_success()
+                return {
+                    int(uid): name for uid, name in zip(user_ids, names)
+                    if name is not None and str(uid).isdigit()
+                }
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis online_users failed, fallback to memory: {e}")
         
-        # If no heartbeat exists but connection exists, consider connected
-        return True
+        return {
+            user_id: self._usernames[user_id]
+            for user_id in self.connected_users(list(self._connections))
+            if user_id in self._usernames
+        }
 
-    def refresh_heartbeat(self, user_id: int, ttl_seconds: Optional[int] = None) -> None:
+    def refresh_heartbeat(self, user_id: int, ttl_seconds: Optional[float] = None) -> None:
         """Обновляет heartbeat пользователя, продлевая TTL."""
-        if ttl_seconds is None:
-            try:
-                ttl = int(current_app.config.get('HEARTBEAT_TTL_SECONDS', 120))
-            except RuntimeError:
-                ttl = 120  # fallback если нет контекста приложения
-        else:
-            ttl = float(ttl_seconds)  # Используем float для точности
+        ttl = float(ttl_seconds) if ttl_seconds is not None else self._default_ttl()
+        if ttl <= 0:
+            ttl = self._default_ttl()  # недопустимый TTL — используем значение из конфига
+        expires_at = time.time() + ttl
         
         # Пробуем Redis, если доступен
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
-                hb_key = self._heartbeat_key_tpl.format(user_id=user_id)
-                # Redis ожидает целочисленный TTL (секунды)
-                redis_ttl = int(ttl) if ttl >= 1 else 1
-                extensions.redis_client.set(hb_key, '1', ex=redis_ttl)
+                client.zadd(self._heartbeats_key, {str(user_id): expires_at})
+                redis_breaker.record_success()
                 return
             except Exception as e:
+                redis_breaker.record_failure()
                 try:
                     current_app.logger.warning(f"Redis refresh_heartbeat failed, fallback to memory: {e}")
                 except RuntimeError:
                     pass
         
         # Fallback в память
-        if user_id not in self._connections:
-            self._connections[user_id] = f"fallback_socket_{user_id}"
-            self._socket_to_user[f"fallback_socket_{user_id}"] = user_id
+        with self._memory_lock:
+            if user_id not in self._connections:
+                self._connections[user_id] = f"fallback_socket_{user_id}"
+                self._socket_to_user[f"fallback_socket_{user_id}"] = user_id
+            self._set_memory_heartbeat(user_id, expires_at)
+
+    def reap_expired(self, now: Optional[float] = None, batch_size: int = 500) -> List[int]:
+        """Удаляет пачку соединений с истекшим heartbeat и возвращает их user_id"""
+        now = time.time() if now is None else now
+        client = _redis()
+        if client is not None:
+            try:
+                reap = client.register_script(self._REAP_SCRIPT)
+                ids = reap(
+                    keys=[self._heartbeats_key, self._user_to_socket_key, self._socket_to_user_key,
+                          self._usernames_key],
+                    args=[now, batch_size],
+                )
+                redis_breaker.record_success()
+                return [int(uid) for uid in ids or [] if str(uid).isdigit()]
+            except Exception as e:
+                redis_breaker.record_failure()
+                current_app.logger.warning(f"Redis reap_expired failed, fallback to memory: {e}")
+
+        expired: List[int] = []
+        with self._memory_lock:
+            while self._expiry_heap and self._expiry_heap[0][0] <= now and len(expired) < batch_size:
+                expires_at, user_id = heapq.heappop(self._expiry_heap)
+                # Запись актуальна, только если heartbeat с тех пор не продлевался и не удалялся
+                if self._heartbeat_expires.get(user_id) == expires_at:
+                    self._remove_memory_connection(user_id)
+                    expired.append(user_id)
+        return expired
+    
+    def reconcile_to_redis(self, client) -> None:
+        """Переносит соединения и heartbeat, накопленные в памяти, в Redis и очищает память"""
+        for _ in range(_RECONCILE_PASSES):
+            snapshot = self._take_memory()
+            if snapshot is None:
+                return
+            try:
+                self._replay_to_redis(client, *snapshot)
+            except Exception:
+                self._restore_memory(*snapshot)
+                raise
+    
+    def _take_memory(self):
+        """Забирает структуры памяти, подменяя их пустыми: записи во время сверки не теряются"""
+        with self._memory_lock:
+            if not self._connections and not self._pending_removals:
+                return None
+            snapshot = (self._connections, self._usernames, self._heartbeat_expires, self._pending_removals)
+            self._connections, self._socket_to_user, self._usernames = {}, {}, {}
+            self._heartbeat_expires, self._expiry_heap, self._pending_removals = {}, [], {}
+            return snapshot
+    
+    def _restore_memory(self, connections, usernames, heartbeat_expires, pending_removals) -> None:
+        """Возвращает снимок после неудачной сверки; записи, сделанные после снимка, новее и главнее"""
+        with self._memory_lock:
+            newer = set(self._connections) | set(self._pending_removals)
+            for user_id, socket_id in connections.items():
+                if user_id in newer:
+                    continue
+                self._connections[user_id] = socket_id
+                self._socket_to_user[socket_id] = user_id
+                if user_id in usernames:
+                    self._usernames[user_id] = usernames[user_id]
+                if user_id in heartbeat_expires:
+                    self._set_memory_heartbeat(user_id, heartbeat_expires[user_id])
+            for user_id, socket_id in pending_removals.items():
+                if user_id not in newer:
+                    self._pending_removals[user_id] = socket_id
+    
+    def _replay_to_redis(self, client, connections, usernames, heartbeat_expires, pending_removals) -> None:
+        user_ids = list(set(pending_removals) | set(connections))
+        pipe = client.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hget(self._user_to_socket_key, str(user_id))
+        redis_sockets = dict(zip(user_ids, pipe.execute()))
         
-        # Убедимся, что устанавливаем правильное время
-        expiration_time = time.time() + ttl
-        self._heartbeat_expires[user_id] = expiration_time
-        print(f"DEBUG: Set heartbeat for user {user_id}, expires at {expiration_time}, current time: {time.time()}")
+        pipe = client.pipeline(transaction=True)
+        for user_id, removed_socket_id in pending_removals.items():
+            if user_id in connections:
+                continue
+            current = redis_sockets.get(user_id)
+            # Соединение, открытое позже через другой воркер, не трогаем — его истечет reaper
+            if removed_socket_id is not None and current is not None and current != removed_socket_id:
+                continue
+            if current:
+                pipe.hdel(self._user_to_socket_key, str(user_id))
+                pipe.hdel(self._socket_to_user_key, current)
+            pipe.zrem(self._heartbeats_key, str(user_id))
+            pipe.hdel(self._usernames_key, str(user_id))
+        for user_id, socket_id in connections.items():
+            expires_at = heartbeat_expires.get(user_id)
+            if expires_at is not None:
+                pipe.zadd(self._heartbeats_key, {str(user_id): expires_at})
+            if user_id in usernames:
+                pipe.hset(self._usernames_key, str(user_id), usernames[user_id])
+            # Заглушка из refresh_heartbeat: настоящий socket_id уже лежит в Redis
+            if socket_id.startswith('fallback_socket_'):
+                continue
+            old_socket_id = redis_sockets.get(user_id)
+            if old_socket_id and old_socket_id != socket_id:
+                pipe.hdel(self._socket_to_user_key, old_socket_id)
+            pipe.hset(self._user_to_socket_key, str(user_id), socket_id)
+            pipe.hset(self._socket_to_user_key, socket_id, str(user_id))
+        pipe.execute()
 
 
 class RoomManager:
@@ -281,45 +723,57 @@ class RoomManager:
     def __init__(self):
         # In-memory хранилище для разработки
         self._rooms: Dict[str, Dict[str, Any]] = {}
+        # Комнаты, удаленные в памяти во время недоступности Redis
+        self._pending_removals: Set[str] = set()
+        # Изменения памяти и подмена структур при сверке с Redis
+        self._memory_lock = threading.RLock()
         # Redis keyspace
         self._rooms_set_key = "rooms"
         self._room_meta_key_tpl = "room:meta:{room}"
     
     def create_room_if_absent(self, room_name: str, creator_id: int) -> None:
         """Создает комнату если её нет"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
                 meta_key = self._room_meta_key_tpl.format(room=room_name)
                 # Добавим в множество комнат и установим базовые метаданные
-                extensions.redis_client.sadd(self._rooms_set_key, room_name)
-                if not extensions.redis_client.exists(meta_key):
-                    extensions.redis_client.hset(meta_key, mapping={
+                client.sadd(self._rooms_set_key, room_name)
+                if not client.exists(meta_key):
+                    client.hset(meta_key, mapping={
                         'name': room_name,
                         'created_by': str(creator_id),
                         'is_active': '1'
                     })
                 current_app.logger.debug(f"[Redis] Создана комната: {room_name}")
+                redis_breaker.record_success()
                 return
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis create_room_if_absent failed, fallback to memory: {e}")
-        if room_name not in self._rooms:
-            self._rooms[room_name] = {
-                'name': room_name,
-                'created_by': creator_id,
-                'created_at': None,  # В реальном приложении должно быть время
-                'is_active': True
-            }
-            current_app.logger.debug(f"[Memory] Создана комната: {room_name}")
+        with self._memory_lock:
+            if room_name not in self._rooms:
+                self._rooms[room_name] = {
+                    'name': room_name,
+                    'created_by': creator_id,
+                    'created_at': None,  # В реальном приложении должно быть время
+                    'is_active': True
+                }
+                self._pending_removals.discard(room_name)
+                current_app.logger.debug(f"[Memory] Создана комната: {room_name}")
     
     def get_room_info(self, room_name: str) -> Optional[Dict[str, Any]]:
         """Возвращает информацию о комнате"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
                 meta_key = self._room_meta_key_tpl.format(room=room_name)
-                data = extensions.redis_client.hgetall(meta_key) or None
+                data = client.hgetall(meta_key) or None
                 if not data:
+                    redis_breaker.record_success()
                     return None
                 # Приводим типы частично
+                redis_breaker.record_success()
                 return {
                     'name': data.get('name', room_name),
                     'created_by': int(data['created_by']) if 'created_by' in data and str(data['created_by']).isdigit() else None,
@@ -327,41 +781,89 @@ class RoomManager:
                     'is_active': data.get('is_active', '1') == '1'
                 }
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis get_room_info failed, fallback to memory: {e}")
         return self._rooms.get(room_name)
     
     def get_all_rooms(self) -> Set[str]:
         """Возвращает список всех комнат"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
-                rooms = extensions.redis_client.smembers(self._rooms_set_key) or set()
+                rooms = client.smembers(self._rooms_set_key) or set()
+                redis_breaker.record_success()
                 return set(rooms)
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis get_all_rooms failed, fallback to memory: {e}")
         return set(self._rooms.keys())
     
     def remove_room_meta(self, room_name: str) -> None:
         """Удаляет метаданные комнаты"""
-        if extensions.redis_client is not None:
+        client = _redis()
+        if client is not None:
             try:
                 meta_key = self._room_meta_key_tpl.format(room=room_name)
-                extensions.redis_client.srem(self._rooms_set_key, room_name)
-                extensions.redis_client.delete(meta_key)
+                client.srem(self._rooms_set_key, room_name)
+                client.delete(meta_key)
                 current_app.logger.debug(f"[Redis] Удалены метаданные комнаты: {room_name}")
+                redis_breaker.record_success()
                 return
             except Exception as e:
+                redis_breaker.record_failure()
                 current_app.logger.warning(f"Redis remove_room_meta failed, fallback to memory: {e}")
-        if room_name in self._rooms:
-            del self._rooms[room_name]
-            current_app.logger.debug(f"[Memory] Удалены метаданные комнаты: {room_name}")
+        with self._memory_lock:
+            if _degraded():
+                self._pending_removals.add(room_name)
+            if room_name in self._rooms:
+                del self._rooms[room_name]
+                current_app.logger.debug(f"[Memory] Удалены метаданные комнаты: {room_name}")
     
     def cleanup_empty_room(self, room_name: str) -> None:
         """Очищает пустую комнату"""
         # В Redis логика может быть сложнее; здесь переиспользуем remove_room_meta
         self.remove_room_meta(room_name)
+    
+    def reconcile_to_redis(self, client) -> None:
+        """Переносит комнаты, созданные и удаленные в памяти, в Redis и очищает память"""
+        for _ in range(_RECONCILE_PASSES):
+            with self._memory_lock:
+                if not self._rooms and not self._pending_removals:
+                    return
+                # Подмена пустыми структурами: комнаты, созданные во время сверки, уйдут следующим проходом
+                rooms, pending_removals = self._rooms, self._pending_removals
+                self._rooms, self._pending_removals = {}, set()
+            try:
+                self._replay_to_redis(client, rooms, pending_removals)
+            except Exception:
+                with self._memory_lock:
+                    for room_name, info in rooms.items():
+                        if room_name not in self._rooms and room_name not in self._pending_removals:
+                            self._rooms[room_name] = info
+                    self._pending_removals |= {name for name in pending_removals if name not in self._rooms}
+                raise
+    
+    def _replay_to_redis(self, client, rooms, pending_removals) -> None:
+        pipe = client.pipeline(transaction=True)
+        for room_name in pending_removals:
+            pipe.srem(self._rooms_set_key, room_name)
+            pipe.delete(self._room_meta_key_tpl.format(room=room_name))
+        for room_name, info in rooms.items():
+            meta_key = self._room_meta_key_tpl.format(room=room_name)
+            pipe.sadd(self._rooms_set_key, room_name)
+            # HSETNX: метаданные, уже существующие в Redis, не перезаписываем
+            pipe.hsetnx(meta_key, 'name', room_name)
+            pipe.hsetnx(meta_key, 'created_by', str(info.get('created_by')))
+            pipe.hsetnx(meta_key, 'is_active', '1' if info.get('is_active', True) else '0')
+        pipe.execute()
 
 
 # Глобальные экземпляры менеджеров
 user_state = UserStateManager()
 conn_mgr = ConnectionManager()
-room_mgr = RoomManager()
\ No newline at end of file
+room_mgr = RoomManager()
+
+# При восстановлении Redis состояние, накопленное в памяти, переносится обратно
+redis_breaker.add_recovery_listener(user_state.reconcile_to_redis)
+redis_breaker.add_recovery_listener(conn_mgr.reconcile_to_redis)
+redis_breaker.add_recovery_listener(room_mgr.reconcile_to_redis)
\ No newline at end of file
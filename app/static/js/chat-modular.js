@@ -41,10 +41,29 @@ window.socket.on('connect', () => {
     console.log('✅ [SOCKET DEBUG] Socket.IO подключен, ID:', window.socket.id);
 });
 
+// Heartbeat: сервер истекает соединения без heartbeat (HEARTBEAT_TTL_SECONDS, по умолчанию 120с)
+const HEARTBEAT_INTERVAL_MS = 30000;
+setInterval(() => {
+    if (window.socket.connected) {
+        window.socket.emit('heartbeat', { timestamp: Date.now() });
+    }
+}, HEARTBEAT_INTERVAL_MS);
+
 window.socket.on('disconnect', () => {
     console.log('🔴 [SOCKET DEBUG] Socket.IO отключен');
 });
 
+// Воркер выводится из работы: переподключаемся сами в случайный момент окна,
+// чтобы клиенты не пришли на другой воркер одновременно
+window.socket.on('server_draining', (data) => {
+    const delay = Math.random() * ((data && data.reconnect_within_ms) || 5000);
+    console.log('🔵 [SOCKET DEBUG] Сервер выводится из работы, переподключение через', Math.round(delay), 'мс');
+    setTimeout(() => {
+        window.socket.disconnect();
+        window.socket.connect();
+    }, delay);
+});
+
 window.socket.on('connect_error', (error) => {
     console.error('🔴 [SOCKET DEBUG] Ошибка подключения Socket.IO:', error);
 });
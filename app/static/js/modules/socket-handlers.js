@@ -7,6 +7,13 @@ class SocketHandlers {
         this.socket = socket;
         this.chatUI = chatUI;
         this.dmHandler = dmHandler;
+        // Последний полный список комнат и его версия (изменения приходят через room_list_delta)
+        this.roomList = [];
+        this.roomListVersion = null;
+        // Статусы собеседников и участников комнат (user_id -> online), приходят кадрами presence_delta
+        this.presence = new Map();
+        // Версии состава комнат (room -> version): current_users дает снимок, members_delta — изменения
+        this.membersVersion = {};
         this.setupHandlers();
     }
 
@@ -20,6 +27,13 @@ class SocketHandlers {
             console.log(`🔵 [SOCKET DEBUG] Current User:`, window.currentUser);
         });
         
+        // Кадр с несколькими событиями одному адресату: раздаем их обычным обработчикам по порядку
+        this.socket.on('batch', (frame) => {
+            (frame.events || []).forEach(({event, data}) => {
+                this.socket.listeners(event).forEach(listener => listener(data));
+            });
+        });
+
         // Основные события подключения
         this.socket.on('connect', () => {
             console.log('🔵 [SOCKET DEBUG] Событие connect получено');
@@ -35,10 +49,22 @@ class SocketHandlers {
             console.log('🔵 [SOCKET DEBUG] Событие room_list получено:', data);
             this.handleRoomList(data);
         });
+        this.socket.on('room_list_delta', (data) => {
+            console.log('🔵 [SOCKET DEBUG] Событие room_list_delta получено:', data);
+            this.handleRoomListDelta(data);
+        });
+        this.socket.on('presence_delta', (data) => {
+            console.log('🔵 [SOCKET DEBUG] Событие presence_delta получено:', data);
+            this.handlePresenceDelta(data);
+        });
         this.socket.on('current_users', (data) => {
             console.log('🔵 [SOCKET DEBUG] Событие current_users получено:', data);
             this.handleCurrentUsers(data);
         });
+        this.socket.on('members_delta', (data) => {
+            console.log('🔵 [SOCKET DEBUG] Событие members_delta получено:', data);
+            this.handleMembersDelta(data);
+        });
         this.socket.on('user_joined', (data) => {
             console.log('🔵 [SOCKET DEBUG] Событие user_joined получено:', data);
             this.handleUserJoined(data);
@@ -136,8 +162,35 @@ class SocketHandlers {
     }
 
     handleRoomList(data) {
+        this.roomList = data.rooms || [];
+        this.roomListVersion = typeof data.version === 'number' ? data.version : null;
+        this.renderRoomList();
+    }
+
+    handleRoomListDelta(data) {
+        if (this.roomListVersion === null || data.version > this.roomListVersion + 1) {
+            // Пропущена версия — запрашиваем полный список
+            this.socket.emit('get_room_list');
+            return;
+        }
+        if (data.version <= this.roomListVersion) {
+            return;
+        }
+        const removed = new Set(data.removed || []);
+        const rooms = this.roomList.filter(roomName => !removed.has(roomName));
+        (data.added || []).forEach(roomName => {
+            if (!rooms.includes(roomName)) {
+                rooms.push(roomName);
+            }
+        });
+        this.roomList = rooms;
+        this.roomListVersion = data.version;
+        this.renderRoomList();
+    }
+
+    renderRoomList() {
         if (this.chatUI) {
-            this.chatUI.updateRoomList(data.rooms);
+            this.chatUI.updateRoomList(this.roomList);
         } else {
             console.warn('ChatUI не инициализирован при получении списка комнат');
         }
@@ -154,11 +207,43 @@ class SocketHandlers {
 
         try {
             this.chatUI.updateUsersList(data.users, data.room);
+            if (data.version !== undefined) {
+                this.membersVersion[data.room] = data.version;
+            }
         } catch (error) {
             console.error('Ошибка обработки current_users:', error);
         }
     }
 
+    handleMembersDelta(data) {
+        if (data.room !== this.chatUI.currentRoom || (this.dmHandler && this.dmHandler.isInDMMode)) {
+            return;
+        }
+
+        const known = this.membersVersion[data.room];
+        if (known === undefined || data.version > known + 1) {
+            // Пропущено изменение (или снимка еще не было) — запрашиваем полный список
+            this.socket.emit('get_current_users', { room: data.room });
+            return;
+        }
+        if (data.version <= known) {
+            // Изменение уже учтено в снимке
+            return;
+        }
+
+        (data.removed || []).forEach(userId => {
+            const userElement = document.getElementById(`user-${userId}-${data.room}`);
+            if (userElement) {
+                userElement.remove();
+            }
+        });
+        Object.entries(data.added || {}).forEach(([userId, username]) => {
+            this.chatUI.addUserToList(Number(userId), username);
+        });
+        this.membersVersion[data.room] = data.version;
+        this.chatUI.updateOnlineCount();
+    }
+
     handleUserJoined(data) {
         if (data.room === this.chatUI.currentRoom && (!this.dmHandler || !this.dmHandler.isInDMMode)) {
             this.chatUI.addUserToList(data.user_id, data.username);
@@ -224,7 +309,7 @@ class SocketHandlers {
         if (data.room === this.chatUI.currentRoom && (!this.dmHandler || !this.dmHandler.isInDMMode)) {
             if (this.chatUI.virtualizedChat) {
                 this.chatUI.virtualizedChat.messages = data.messages;
-                this.chatUI.virtualizedChat.offset = data.messages.length;
+                this.chatUI.virtualizedChat.setCursor(data.cursor);
                 this.chatUI.virtualizedChat.hasMore = data.has_more;
                 this.chatUI.virtualizedChat.renderVisibleMessages();
                 
@@ -259,9 +344,26 @@ class SocketHandlers {
     handleDMConversations(data) {
         if (this.dmHandler) {
             this.dmHandler.renderDMConversations(data.conversations);
+            this.applyPresence();
         }
     }
 
+    handlePresenceDelta(data) {
+        (data.changes || []).forEach(change => {
+            this.presence.set(change.user_id, change.online);
+        });
+        this.applyPresence();
+    }
+
+    applyPresence() {
+        document.querySelectorAll('.dm-conversation').forEach(conv => {
+            const userId = parseInt(conv.getAttribute('data-user-id'), 10);
+            if (this.presence.has(userId)) {
+                conv.classList.toggle('online', this.presence.get(userId));
+            }
+        });
+    }
+
     handleNewDM(data) {
         console.log('🔵 [CLIENT DEBUG] handleNewDM вызван с данными:', data);
         
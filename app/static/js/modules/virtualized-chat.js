@@ -6,7 +6,8 @@ class VirtualizedChat {
     constructor(container) {
         this.container = container;
         this.messages = [];
-        this.offset = 0;
+        // Курсор keyset-пагинации: самое старое загруженное сообщение
+        this.cursor = null;
         this.hasMore = true;
         this.isLoading = false;
         this.currentRoom = window.chatUI?.currentRoom || 'general_chat';
@@ -61,13 +62,24 @@ class VirtualizedChat {
         this.loadMoreBtn.textContent = 'Загрузка...';
         this.loadMoreBtn.disabled = true;
 
+        const cursor = this.cursor || this.cursorFromMessages();
         window.socket.emit('load_more_messages', {
             room: window.chatUI?.currentRoom || this.currentRoom,
-            offset: this.offset,
+            before_id: cursor ? cursor.before_id : null,
+            before_ts: cursor ? cursor.before_ts : null,
             limit: 20
         });
     }
 
+    cursorFromMessages() {
+        const oldest = this.messages.find(message => message.id);
+        return oldest ? { before_id: oldest.id, before_ts: oldest.timestamp } : null;
+    }
+
+    setCursor(cursor) {
+        this.cursor = cursor && cursor.before_id ? cursor : null;
+    }
+
     handleNewMessages(data) {
         if (data.room !== window.chatUI?.currentRoom) {
             return;
@@ -82,7 +94,7 @@ class VirtualizedChat {
             const oldScrollTop = this.container.scrollTop;
 
             this.messages = [...data.messages, ...this.messages];
-            this.offset = data.offset;
+            this.setCursor(data.cursor);
             this.hasMore = data.has_more;
 
             this.renderVisibleMessages();
@@ -183,7 +195,7 @@ class VirtualizedChat {
 
     resetForNewRoom(roomName) {
         this.messages = [];
-        this.offset = 0;
+        this.cursor = null;
         this.hasMore = false;
         this.isLoading = false;
         this.currentRoom = roomName;
@@ -4,8 +4,8 @@ WebSocket события и их обработчики
 from typing import Dict, Optional, Any
 from flask import current_app, request
 from flask_login import current_user
-from flask_socketio import emit, join_room, leave_room
 from app.services import MessageService, RoomService, UserService, WebSocketService
+from app.services.emit_batcher import emit, join_room, leave_room
 
 
 class WebSocketEvents:
@@ -38,20 +38,13 @@ class WebSocketEvents:
         """Обработчик выхода из комнаты"""
         self.websocket_service.handle_leave_room(data)
     
+    def handle_get_room_list(self, data: Optional[Dict] = None) -> None:
+        """Обработчик запроса полного списка комнат"""
+        self.websocket_service.handle_get_room_list(data)
+    
     def handle_get_current_users(self, data: Dict) -> None:
-        """Обработчик получения списка пользователей в комнате"""
-        if not current_user.is_authenticated:
-            return
-        
-        room_name = data.get('room', self.websocket_service.DEFAULT_ROOM)
-        
-        try:
-            from app.state import user_state
-            users = user_state.get_room_users(room_name)
-        except Exception:
-            users = dict(self.websocket_service.active_users.get(room_name, {}))
-        
-        emit('current_users', {'users': users, 'room': room_name})
+        """Обработчик получения списка пользователей в комнате (снимок с версией)"""
+        self.websocket_service.handle_get_current_users(data)
     
     def handle_send_message(self, data: Dict) -> None:
         """Обработчик отправки сообщения"""
@@ -66,7 +59,9 @@ class WebSocketEvents:
         room_name = data.get('room', '').strip()
         offset = data.get('offset', 0)
         limit = data.get('limit', 20)
-        
+        # Курсор: самое старое уже загруженное сообщение (offset — устаревший режим)
+        before_id = data.get('before_id')
+        before_ts = data.get('before_ts')
         
         if not room_name:
             current_app.logger.warning("EVENTS LOAD MORE: Комната не указана")
@@ -74,19 +69,21 @@ class WebSocketEvents:
             return
         
         # Получаем комнату
-        room = RoomService.get_room_by_name(room_name)
+        room = RoomService.get_room_ref(room_name)
         if not room:
             emit('load_more_error', {'error': 'Комната не найдена'})
             return
         
         # Загружаем сообщения
-        messages = MessageService.get_room_messages(room.id, limit, offset)
+        messages = MessageService.get_room_messages(room.id, limit, offset,
+                                                    before_id=before_id, before_ts=before_ts)
         
         if messages:
             emit('more_messages_loaded', {
                 'messages': messages,
                 'room': room_name,
                 'offset': offset + len(messages),
+                'cursor': MessageService.history_cursor(messages),
                 'has_more': len(messages) == limit
             })
         else:
@@ -104,7 +101,7 @@ class WebSocketEvents:
             return
         
         # Получаем комнату
-        room = RoomService.get_room_by_name(room_name)
+        room = RoomService.get_room_ref(room_name)
         if not room:
             return
         
@@ -115,6 +112,7 @@ class WebSocketEvents:
         emit('message_history', {
             'messages': messages,
             'room': room_name,
+            'cursor': MessageService.history_cursor(messages),
             'has_more': len(messages) == limit
         })
     
@@ -174,14 +172,20 @@ class WebSocketEvents:
         if not recipient:
             return
         
-        # Загружаем историю переписки
-        messages = MessageService.get_dm_messages(current_user.id, recipient_id)
+        # Загружаем историю переписки (страница до курсора, если он передан)
+        limit = data.get('limit', 50)
+        messages = MessageService.get_dm_messages(current_user.id, recipient_id, limit,
+                                                  before_id=data.get('before_id'),
+                                                  before_ts=data.get('before_ts'))
         
         # Отправляем историю
         emit('dm_history', {
             'messages': messages,
             'recipient_id': recipient_id,
-            'recipient_username': recipient.username
+            'recipient_username': recipient.username,
+            'cursor': MessageService.history_cursor(messages),
+            'has_more': len(messages) == limit,
+            'older': data.get('before_id') is not None
         })
     
     def handle_get_dm_conversations(self) -> None:
@@ -3,77 +3,121 @@
 """
 from flask_socketio import SocketIO
 from app.services import WebSocketService
+from app.services.emit_batcher import emit_batcher
+from app.services.last_seen import last_seen_tracker
+from app.services.presence_broadcaster import presence_broadcaster
+from app.services.room_list_broadcaster import room_list_broadcaster
 from .events import WebSocketEvents
 
 
-def register_socketio_handlers(socketio: SocketIO) -> None:
+def register_socketio_handlers(socketio: SocketIO, app=None) -> None:
     """Регистрирует все обработчики SocketIO"""
     
     # Создаем сервисы
     websocket_service = WebSocketService()
     events = WebSocketEvents(websocket_service)
+    if app is not None:
+        # Нужен при выводе воркера из работы (app.cluster)
+        app.extensions['websocket_service'] = websocket_service
     
-    # Регистрируем обработчики событий
+    # Фоновое истечение соединений без heartbeat
+    if app is not None and app.config.get('HEARTBEAT_REAPER_ENABLED', True):
+        websocket_service.start_heartbeat_reaper(socketio, app)
+    
+    # Рассылка изменений списка комнат окнами debounce
+    if app is not None and app.config.get('ROOM_LIST_BROADCAST_ENABLED', True):
+        room_list_broadcaster.start(socketio, app)
+    
+    # Кадры presence_delta подписчикам пользователя
+    if app is not None and app.config.get('PRESENCE_BROADCAST_ENABLED', True):
+        presence_broadcaster.start(socketio, app)
+    
+    # Пакетная запись last_seen в БД
+    if app is not None and app.config.get('LAST_SEEN_FLUSH_ENABLED', True):
+        last_seen_tracker.start(socketio, app)
+    
+    # Регистрируем обработчики событий; emit'ы одному адресату внутри обработчика уходят одним кадром
     @socketio.on('connect')
+    @emit_batcher.batched
     def handle_connect():
         events.handle_connect(socketio)
     
     @socketio.on('disconnect')
+    @emit_batcher.batched
     def handle_disconnect():
         events.handle_disconnect()
     
     @socketio.on('heartbeat')
+    @emit_batcher.batched
     def handle_heartbeat(data=None):
         events.handle_heartbeat(data)
     
     @socketio.on('create_room')
+    @emit_batcher.batched
     def handle_create_room(data):
         events.handle_create_room(data)
     
     @socketio.on('join_room')
+    @emit_batcher.batched
     def handle_join_room(data):
         events.handle_join_room(data)
     
     @socketio.on('leave_room')
+    @emit_batcher.batched
     def handle_leave_room(data):
         events.handle_leave_room(data)
     
+    @socketio.on('get_room_list')
+    @emit_batcher.batched
+    def handle_get_room_list(data=None):
+        events.handle_get_room_list(data)
+    
     @socketio.on('get_current_users')
+    @emit_batcher.batched
     def handle_get_current_users(data):
         events.handle_get_current_users(data)
     
     @socketio.on('send_message')
+    @emit_batcher.batched
     def handle_send_message(data):
         events.handle_send_message(data)
     
     @socketio.on('load_more_messages')
+    @emit_batcher.batched
     def handle_load_more_messages(data):
         events.handle_load_more_messages(data)
     
     @socketio.on('get_message_history')
+    @emit_batcher.batched
     def handle_get_message_history(data):
         events.handle_get_message_history(data)
     
     @socketio.on('start_dm')
+    @emit_batcher.batched
     def handle_start_dm(data):
         events.handle_start_dm(data)
     
     @socketio.on('send_dm')
+    @emit_batcher.batched
     def handle_send_dm(data):
         events.handle_send_dm(data)
     
     @socketio.on('get_dm_history')
+    @emit_batcher.batched
     def handle_get_dm_history(data):
         events.handle_get_dm_history(data)
     
     @socketio.on('get_dm_conversations')
+    @emit_batcher.batched
     def handle_get_dm_conversations():
         events.handle_get_dm_conversations()
     
     @socketio.on('mark_messages_as_read')
+    @emit_batcher.batched
     def handle_mark_messages_as_read(data):
         events.handle_mark_messages_as_read(data)
     
     @socketio.on('update_unread_indicator')
+    @emit_batcher.batched
     def handle_update_unread_indicator(data):
         events.handle_update_unread_indicator(data)
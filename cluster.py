@@ -0,0 +1,395 @@
+"""
+Многопроцессный запуск: pre-fork мастер и eventlet-воркеры с общим состоянием в Redis.
+
+Балансировка:
+- sticky (по умолчанию): мастер принимает соединения и передает сокет воркеру по хешу IP
+  клиента (SCM_RIGHTS), поэтому long-polling запросы одного клиента попадают в один воркер;
+- reuseport: каждый воркер слушает порт с SO_REUSEPORT, ядро распределяет соединения
+  без привязки к клиенту (подходит только клиентам с транспортом websocket).
+
+SIGTERM/SIGINT мастеру — плавная остановка воркеров, SIGHUP — замена воркеров без остановки приема.
+"""
+import errno
+import importlib
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+import traceback
+import zlib
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+BALANCER_STICKY = 'sticky'
+BALANCER_REUSEPORT = 'reuseport'
+
+
+class _Worker:
+    """Процесс воркера и канал передачи ему соединений"""
+
+    def __init__(self, index: int, pid: int, channel: Optional[socket.socket]):
+        self.index = index
+        self.pid = pid
+        self.channel = channel
+        self.started_at = time.monotonic()
+
+
+class PreforkMaster:
+    """Мастер: запускает воркеры, раздает соединения и перезапускает упавшие воркеры"""
+
+    def __init__(self, app_path: str, workers: int, host: str, port: int,
+                 balancer: str = BALANCER_STICKY, drain_seconds: float = 30.0, backlog: int = 1024):
+        if balancer not in (BALANCER_STICKY, BALANCER_REUSEPORT):
+            raise ValueError(f"Неизвестный режим балансировки: {balancer}")
+        # 'модуль:атрибут' — приложение импортируется в воркере после monkey_patch, не в мастере
+        self.app_path = app_path
+        self.workers = max(1, int(workers))
+        self.host = host
+        self.port = int(port)
+        self.balancer = balancer
+        self.drain_seconds = float(drain_seconds)
+        self.backlog = backlog
+        self._listener: Optional[socket.socket] = None
+        self._workers: Dict[int, _Worker] = {}
+        self._retiring: Set[int] = set()
+        # Соединения, закрытые мастером без передачи воркеру (нет ни одного живого воркера)
+        self._dropped = 0
+        self._stopping = False
+        self._reloading = False
+
+    def run(self) -> int:
+        """Основной цикл мастера; возвращает код завершения"""
+        if not hasattr(os, 'fork'):
+            raise RuntimeError("Многопроцессный режим требует os.fork (недоступен на этой платформе)")
+
+        if self.balancer == BALANCER_STICKY:
+            self._listener = socket.create_server((self.host, self.port), backlog=self.backlog)
+            self._listener.setblocking(False)
+
+        for index in range(self.workers):
+            self._spawn(index)
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        logger.info(f"Мастер {os.getpid()}: {self.workers} воркеров на {self.host}:{self.port} ({self.balancer})")
+
+        selector = selectors.DefaultSelector()
+        if self._listener is not None:
+            selector.register(self._listener, selectors.EVENT_READ)
+        try:
+            while not self._stopping:
+                if self._listener is not None:
+                    for _ in selector.select(timeout=0.5):
+                        self._accept()
+                else:
+                    time.sleep(0.5)
+                self._reap()
+                if self._reloading:
+                    self._reloading = False
+                    self._reload()
+        finally:
+            selector.close()
+            self._shutdown()
+        return 0
+
+    def _on_stop(self, signum, frame) -> None:
+        self._stopping = True
+
+    def _on_reload(self, signum, frame) -> None:
+        self._reloading = True
+
+    def _spawn(self, index: int) -> None:
+        parent_end = child_end = None
+        if self.balancer == BALANCER_STICKY:
+            # SOCK_SEQPACKET: одно сообщение — одно соединение, границы сохраняются
+            parent_end, child_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                    signal.signal(sig, signal.SIG_DFL)
+                if self._listener is not None:
+                    self._listener.close()
+                for worker in self._workers.values():
+                    if worker.channel is not None:
+                        worker.channel.close()
+                if parent_end is not None:
+                    parent_end.close()
+                code = run_worker(self.app_path, self.host, self.port, channel=child_end,
+                                  drain_seconds=self.drain_seconds)
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        if child_end is not None:
+            child_end.close()
+            # Завис воркер — соединение сбрасывается, а не блокирует мастер
+            parent_end.settimeout(1.0)
+        self._workers[index] = _Worker(index, pid, parent_end)
+        logger.info(f"Воркер {index} запущен (pid {pid})")
+
+    def _accept(self) -> None:
+        try:
+            conn, address = self._listener.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        try:
+            index = zlib.crc32(address[0].encode('utf-8')) % self.workers
+            payload = json.dumps(list(address[:2])).encode('utf-8')
+            # Пока воркер перезапускается, соединение получает следующий живой воркер:
+            # websocket-клиенту это незаметно, polling-сессия упавшего воркера все равно потеряна
+            for offset in range(self.workers):
+                worker = self._workers.get((index + offset) % self.workers)
+                if worker is None or worker.channel is None:
+                    continue
+                try:
+                    socket.send_fds(worker.channel, [payload], [conn.fileno()])
+                    return
+                except OSError as e:
+                    logger.warning(f"Не удалось передать соединение воркеру {worker.index}: {e}")
+            self._dropped += 1
+            logger.error(f"Нет живых воркеров, соединение {address[0]} закрыто (всего закрыто: {self._dropped})")
+        finally:
+            # У воркера своя копия дескриптора
+            conn.close()
+
+    def _reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self._retiring:
+                self._retiring.discard(pid)
+                continue
+            worker = next((w for w in self._workers.values() if w.pid == pid), None)
+            if worker is None:
+                continue
+            if worker.channel is not None:
+                worker.channel.close()
+            del self._workers[worker.index]
+            if self._stopping:
+                continue
+            logger.error(f"Воркер {worker.index} (pid {pid}) завершился со статусом {status}, перезапуск")
+            if time.monotonic() - worker.started_at < 1.0:
+                # Падение сразу после старта: не перезапускаем в горячем цикле
+                time.sleep(1.0)
+            self._spawn(worker.index)
+
+    def _reload(self) -> None:
+        """Заменяет воркеры: новый принимает соединения сразу, старый выводится из работы"""
+        for index in range(self.workers):
+            old = self._workers.get(index)
+            self._spawn(index)
+            if old is None:
+                continue
+            if old.channel is not None:
+                old.channel.close()
+            self._retiring.add(old.pid)
+            self._signal(old.pid, signal.SIGTERM)
+
+    def _shutdown(self) -> None:
+        if self._listener is not None:
+            self._listener.close()
+        pids = {worker.pid for worker in self._workers.values()} | self._retiring
+        for pid in pids:
+            self._signal(pid, signal.SIGTERM)
+        # Воркеру дается окно вывода и немного на сброс буферов
+        deadline = time.monotonic() + self.drain_seconds + 10
+        while pids and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(0.1)
+                continue
+            pids.discard(pid)
+        for pid in pids:
+            logger.warning(f"Воркер pid {pid} не завершился за {self.drain_seconds}с, SIGKILL")
+            self._signal(pid, signal.SIGKILL)
+        for worker in self._workers.values():
+            if worker.channel is not None:
+                worker.channel.close()
+
+    @staticmethod
+    def _signal(pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+
+class _WorkerListener:
+    """Слушающий сокет воркера для eventlet.wsgi: свой (reuseport) или канал от мастера (sticky)"""
+
+    def __init__(self, host: str, port: int, channel: Optional[socket.socket] = None):
+        import eventlet
+        from eventlet import greenio, patcher
+        self._greenio = greenio
+        # Переданный дескриптор оборачивается в обычный сокет, а затем в GreenSocket
+        self._socket_class = patcher.original('socket').socket
+        self._channel = channel
+        self._address = (host, port)
+        self._closed = False
+        if channel is None:
+            self._sock = eventlet.listen((host, port), reuse_port=True)
+        else:
+            channel.setblocking(False)
+            self._sock = None
+
+    @property
+    def family(self) -> int:
+        return self._sock.family if self._sock is not None else socket.AF_INET
+
+    def getsockname(self):
+        return self._sock.getsockname() if self._sock is not None else self._address
+
+    def accept(self):
+        from eventlet.hubs import trampoline
+        while not self._closed:
+            try:
+                if self._sock is not None:
+                    # Таймаут — чтобы заметить close(): закрывать дескриптор под ожидающим accept нельзя
+                    trampoline(self._sock.fileno(), read=True, timeout=1.0, timeout_exc=socket.timeout)
+                    if self._closed:
+                        break
+                    return self._sock.accept()
+                trampoline(self._channel.fileno(), read=True)
+                payload, fds, _, _ = socket.recv_fds(self._channel, 256, 1)
+            except (BlockingIOError, socket.timeout):
+                continue
+            except OSError:
+                if self._closed:
+                    break
+                raise
+            if not fds:
+                # Канал закрыт (мастером или close())
+                break
+            raw = self._socket_class(fileno=fds[0])
+            host, port = json.loads(payload.decode('utf-8'))
+            return self._greenio.GreenSocket(raw), (host, port)
+        if self._sock is not None:
+            self._sock.close()
+        if self._channel is not None:
+            self._channel.close()
+        # Закрытый слушатель: eventlet.wsgi.server завершает цикл accept на ESHUTDOWN
+        raise OSError(errno.ESHUTDOWN, 'listener closed')
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._channel is not None:
+            # shutdown будит ожидающий accept; дескриптор закрывается в нем же
+            try:
+                self._channel.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class WorkerDrain:
+    """Плавный вывод воркера: перестает принимать соединения, переводит клиентов и сбрасывает буферы"""
+
+    # Клиент переподключается сам в случайный момент окна (см. chat-modular.js)
+    DRAIN_EVENT = 'server_draining'
+
+    def __init__(self, app, socketio, listener: _WorkerListener, drain_seconds: float):
+        self.app = app
+        self.socketio = socketio
+        self.listener = listener
+        self.drain_seconds = drain_seconds
+        self._requested = False
+        self._thread = None
+
+    def start(self) -> None:
+        """Запускает ожидание запроса на вывод"""
+        if self._thread is None:
+            self._thread = self.socketio.start_background_task(self._watch)
+
+    def request(self) -> None:
+        """Вызывается из обработчика сигнала: только выставляет флаг"""
+        self._requested = True
+
+    def wait(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+
+    def _watch(self) -> None:
+        # Обработчик сигнала не будит хаб eventlet, поэтому флаг проверяется периодически
+        while not self._requested:
+            self.socketio.sleep(0.5)
+        self._run()
+
+    def _local_sids(self):
+        manager = self.socketio.server.manager
+        return [sid for sid, _ in manager.get_participants('/', None)] if '/' in manager.rooms else []
+
+    def _run(self) -> None:
+        self.listener.close()
+        with self.app.app_context():
+            service = self.app.extensions.get('websocket_service')
+            if service is not None:
+                service.begin_drain()
+            # Только локальным сокетам: ignore_queue не пускает событие в message queue
+            self.socketio.server.manager.emit(self.DRAIN_EVENT, {
+                'reconnect_within_ms': int(self.drain_seconds * 1000),
+            }, namespace='/', room=None, ignore_queue=True)
+            self.app.logger.info(f"Вывод воркера {os.getpid()}: {len(self._local_sids())} соединений")
+
+            deadline = time.monotonic() + self.drain_seconds
+            while self._local_sids() and time.monotonic() < deadline:
+                self.socketio.sleep(0.5)
+            for sid in self._local_sids():
+                self.socketio.server.disconnect(sid, namespace='/', ignore_queue=True)
+            self._flush_buffers()
+
+    def _flush_buffers(self) -> None:
+        from app.services.last_seen import last_seen_tracker
+        from app.services.message_writer import message_writer
+        from app.services.presence_broadcaster import presence_broadcaster
+        for name, flush in (('message_writer', message_writer.shutdown),
+                            ('last_seen', last_seen_tracker.flush),
+                            ('presence', lambda: presence_broadcaster.flush(self.socketio))):
+            try:
+                flush()
+            except Exception as e:
+                self.app.logger.error(f"Ошибка сброса {name} при выводе воркера: {e}")
+
+
+def load_app(app_path: str):
+    """Импортирует приложение по пути 'модуль:атрибут' (атрибут — приложение или фабрика)"""
+    module_name, _, attr = app_path.partition(':')
+    app = getattr(importlib.import_module(module_name), attr or 'app')
+    return app if hasattr(app, 'wsgi_app') else app()
+
+
+def run_worker(app_path: str, host: str, port: int, channel: Optional[socket.socket] = None,
+               drain_seconds: float = 30.0) -> int:
+    """Процесс воркера: eventlet-сервер приложения до SIGTERM/SIGINT и плавного вывода"""
+    import eventlet
+    eventlet.monkey_patch()
+    import eventlet.wsgi
+
+    # Приложение, соединения с Redis и БД создаются уже в процессе воркера, после fork
+    app = load_app(app_path)
+    socketio = app.extensions['socketio']
+    listener = _WorkerListener(host, port, channel=channel)
+    drain = WorkerDrain(app, socketio, listener, drain_seconds)
+    drain.start()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda signum, frame: drain.request())
+
+    eventlet.wsgi.server(listener, app, log_output=app.debug)
+    drain.wait()
+    sys.stdout.flush()
+    return 0
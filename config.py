@@ -43,6 +43,91 @@ class Config:
 
     # Redis URL (используется для SocketIO message_queue и state managers)
     REDIS_URL = os.environ.get('REDIS_URL')
+    
+    # Многопроцессный запуск run.py (cluster.py): число воркеров, балансировка sticky|reuseport
+    # и окно плавного вывода воркера по SIGTERM
+    WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+    CLUSTER_BALANCER = os.environ.get('CLUSTER_BALANCER', 'sticky')
+    CLUSTER_DRAIN_SECONDS = float(os.environ.get('CLUSTER_DRAIN_SECONDS', 30))
+    
+    # Socket.IO через Redis: канал на комнату (False — один общий канал, каждый воркер получает все emit'ы)
+    SOCKETIO_SHARDED_ROOMS = os.environ.get('SOCKETIO_SHARDED_ROOMS', 'true').lower() == 'true'
+    SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL', 'flask-socketio')
+    
+    # Исходящая очередь сокета (пакеты engine.io): выше SOFT — второстепенные события отбрасываются
+    # или сливаются, выше HARD — все; дольше GRACE выше SOFT — клиент отключается
+    SOCKET_BACKPRESSURE_ENABLED = os.environ.get('SOCKET_BACKPRESSURE_ENABLED', 'true').lower() == 'true'
+    SOCKET_OUTBOUND_SOFT_LIMIT = int(os.environ.get('SOCKET_OUTBOUND_SOFT_LIMIT', 200))
+    SOCKET_OUTBOUND_HARD_LIMIT = int(os.environ.get('SOCKET_OUTBOUND_HARD_LIMIT', 1000))
+    SOCKET_SLOW_CONSUMER_GRACE_SECONDS = float(os.environ.get('SOCKET_SLOW_CONSUMER_GRACE_SECONDS', 30))
+    SOCKET_BACKPRESSURE_SWEEP_SECONDS = float(os.environ.get('SOCKET_BACKPRESSURE_SWEEP_SECONDS', 1.0))
+    
+    # Пул соединений Redis (BlockingConnectionPool): при исчерпании ждем REDIS_POOL_TIMEOUT секунд
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS', 50))
+    REDIS_POOL_TIMEOUT = float(os.environ.get('REDIS_POOL_TIMEOUT', 5))
+    REDIS_SOCKET_TIMEOUT = float(os.environ.get('REDIS_SOCKET_TIMEOUT', 5))
+    REDIS_SOCKET_CONNECT_TIMEOUT = float(os.environ.get('REDIS_SOCKET_CONNECT_TIMEOUT', 2))
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.environ.get('REDIS_HEALTH_CHECK_INTERVAL', 30))
+    REDIS_SOCKET_KEEPALIVE = os.environ.get('REDIS_SOCKET_KEEPALIVE', 'true').lower() == 'true'
+    
+    # Circuit breaker: после N ошибок подряд Redis пропускается, проба — раз в RECOVERY секунд
+    REDIS_BREAKER_FAILURE_THRESHOLD = int(os.environ.get('REDIS_BREAKER_FAILURE_THRESHOLD', 5))
+    REDIS_BREAKER_RECOVERY_SECONDS = float(os.environ.get('REDIS_BREAKER_RECOVERY_SECONDS', 10))
+    
+    # Счетчики непрочитанных в Redis перечитываются из БД по истечении TTL
+    UNREAD_COUNTER_TTL_SECONDS = int(os.environ.get('UNREAD_COUNTER_TTL_SECONDS', 300))
+    # При write-behind снимок не видит очереди других воркеров: он живет, пока они не сбросятся в БД
+    UNREAD_COUNTER_PROVISIONAL_TTL_SECONDS = int(os.environ.get('UNREAD_COUNTER_PROVISIONAL_TTL_SECONDS', 2))
+
+    # Буфер последних сообщений комнаты (Redis list + локальный LRU на RECENT_MESSAGES_LOCAL_TTL_SECONDS)
+    RECENT_MESSAGES_SIZE = int(os.environ.get('RECENT_MESSAGES_SIZE', 50))
+    RECENT_MESSAGES_TTL_SECONDS = int(os.environ.get('RECENT_MESSAGES_TTL_SECONDS', 3600))
+    RECENT_MESSAGES_LOCAL_TTL_SECONDS = float(os.environ.get('RECENT_MESSAGES_LOCAL_TTL_SECONDS', 1.0))
+    RECENT_MESSAGES_LOCAL_MAX_ROOMS = int(os.environ.get('RECENT_MESSAGES_LOCAL_MAX_ROOMS', 256))
+
+    # Кэш готовых JSON-представлений сообщений (по id)
+    MESSAGE_PAYLOAD_CACHE_SIZE = int(os.environ.get('MESSAGE_PAYLOAD_CACHE_SIZE', 5000))
+
+    # Кодировщик JSON для Flask и Socket.IO: 'orjson' (без установленного пакета — stdlib) или 'stdlib'
+    JSON_BACKEND = os.environ.get('JSON_BACKEND', 'orjson')
+
+    # Изменения списка комнат рассылаются diff'ами не чаще раза в окно
+    ROOM_LIST_BROADCAST_ENABLED = True
+    ROOM_LIST_DEBOUNCE_SECONDS = float(os.environ.get('ROOM_LIST_DEBOUNCE_SECONDS', 0.25))
+
+    # Справочник комнат (name -> id): локальный кэш живет ROOM_DIRECTORY_LOCAL_TTL_SECONDS,
+    # общий — в Redis ROOM_DIRECTORY_TTL_SECONDS
+    ROOM_DIRECTORY_LOCAL_TTL_SECONDS = float(os.environ.get('ROOM_DIRECTORY_LOCAL_TTL_SECONDS', 5))
+    ROOM_DIRECTORY_TTL_SECONDS = int(os.environ.get('ROOM_DIRECTORY_TTL_SECONDS', 300))
+
+    # Кэш личности для load_user: локальный LRU на IDENTITY_CACHE_LOCAL_TTL_SECONDS, общий — в Redis
+    IDENTITY_CACHE_TTL_SECONDS = int(os.environ.get('IDENTITY_CACHE_TTL_SECONDS', 60))
+    IDENTITY_CACHE_LOCAL_TTL_SECONDS = float(os.environ.get('IDENTITY_CACHE_LOCAL_TTL_SECONDS', 5))
+    IDENTITY_CACHE_LOCAL_MAX_USERS = int(os.environ.get('IDENTITY_CACHE_LOCAL_MAX_USERS', 10000))
+
+    # emit'ы одному адресату внутри обработчика Socket.IO уходят одним кадром 'batch'
+    EMIT_BATCHING_ENABLED = os.environ.get('EMIT_BATCHING_ENABLED', 'true').lower() == 'true'
+
+    # Смены статуса рассылаются кадрами presence_delta комнатам пользователя и собеседникам по ЛС
+    PRESENCE_BROADCAST_ENABLED = True
+    PRESENCE_FLUSH_INTERVAL_SECONDS = float(os.environ.get('PRESENCE_FLUSH_INTERVAL_SECONDS', 1.0))
+
+    # Статус онлайн берется из heartbeat; last_seen копится в Redis и пишется в БД раз в интервал
+    LAST_SEEN_FLUSH_ENABLED = True
+    LAST_SEEN_FLUSH_INTERVAL_SECONDS = float(os.environ.get('LAST_SEEN_FLUSH_INTERVAL_SECONDS', 30))
+
+    # Heartbeat соединений: TTL и фоновое истечение пачками
+    HEARTBEAT_TTL_SECONDS = int(os.environ.get('HEARTBEAT_TTL_SECONDS', 120))
+    HEARTBEAT_REAPER_ENABLED = True
+    HEARTBEAT_REAPER_INTERVAL_SECONDS = float(os.environ.get('HEARTBEAT_REAPER_INTERVAL_SECONDS', 5))
+    HEARTBEAT_REAPER_BATCH_SIZE = int(os.environ.get('HEARTBEAT_REAPER_BATCH_SIZE', 500))
+    
+    # Write-behind запись сообщений: рассылка сразу, INSERT в БД пачками из фоновой задачи
+    MESSAGE_WRITE_BEHIND = os.environ.get('MESSAGE_WRITE_BEHIND', 'false').lower() == 'true'
+    MESSAGE_WRITE_BEHIND_MAX_QUEUE = int(os.environ.get('MESSAGE_WRITE_BEHIND_MAX_QUEUE', 10000))
+    MESSAGE_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('MESSAGE_WRITE_BEHIND_BATCH_SIZE', 500))
+    MESSAGE_WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('MESSAGE_WRITE_BEHIND_FLUSH_INTERVAL', 0.05))
+    MESSAGE_WRITE_BEHIND_ID_BLOCK = int(os.environ.get('MESSAGE_WRITE_BEHIND_ID_BLOCK', 100))
 
 
 class DevelopmentConfig(Config):
@@ -63,6 +148,12 @@ class TestingConfig(Config):
     # Redis для тестов (если доступен)
     REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/1')
     
+    # Фоновые задачи в тестах не запускаем
+    HEARTBEAT_REAPER_ENABLED = False
+    ROOM_LIST_BROADCAST_ENABLED = False
+    LAST_SEEN_FLUSH_ENABLED = False
+    PRESENCE_BROADCAST_ENABLED = False
+    
 
 
 class ProductionConfig(Config):
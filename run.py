@@ -1,11 +1,6 @@
 import os
+import sys
 import logging
-from flask_migrate import Migrate
-from app.extensions import db
-from gevent import pywsgi
-from geventwebsocket.handler import WebSocketHandler
-from app.__init__ import socketio, create_app
-from app.middleware.security import SecurityMiddleware, RateLimitMiddleware
 
 # Загружаем переменные окружения из .env файла если он существует
 try:
@@ -17,6 +12,27 @@ except ImportError:
 # Определяем окружение
 environment = os.environ.get('FLASK_ENV', 'development')
 
+# Продакшен с WEB_CONCURRENCY > 1: pre-fork мастер. Он не импортирует приложение —
+# каждый воркер после fork делает monkey_patch и импортирует run:app_flask сам
+if __name__ == "__main__" and environment == 'production':
+    from config import ProductionConfig
+    if ProductionConfig.WEB_CONCURRENCY > 1:
+        from cluster import PreforkMaster
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s: %(message)s')
+        sys.exit(PreforkMaster(
+            'run:app_flask',
+            workers=ProductionConfig.WEB_CONCURRENCY,
+            host='0.0.0.0',
+            port=int(os.environ.get('PORT', 5000)),
+            balancer=ProductionConfig.CLUSTER_BALANCER,
+            drain_seconds=ProductionConfig.CLUSTER_DRAIN_SECONDS,
+        ).run())
+
+from flask_migrate import Migrate
+from app.extensions import db
+from app.__init__ import socketio, create_app
+from app.middleware.security import SecurityMiddleware, RateLimitMiddleware
+
 # Создаем приложение с правильной конфигурацией
 if environment == 'production':
     from config import ProductionConfig
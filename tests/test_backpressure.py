@@ -0,0 +1,102 @@
+"""
+Тесты ограничения исходящей очереди сокетов (app.backpressure)
+"""
+import queue
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+import pytest
+import socketio
+from app.backpressure import with_backpressure
+from app.metrics import metrics
+
+
+@pytest.fixture
+def manager():
+    """Менеджер с лимитами 2/4 пакета и одним сокетом, очередь которого никто не разгружает"""
+    mgr = with_backpressure(socketio.BaseManager)()
+    mgr.configure_backpressure(soft_limit=2, hard_limit=4, grace_seconds=0, sweep_seconds=1)
+    eio_socket = SimpleNamespace(queue=queue.Queue(), closed=False, close=MagicMock())
+    server = MagicMock()
+    server.eio.sockets = {'eio_slow': eio_socket}
+    server._emit_internal.side_effect = lambda eio_sid, event, data, namespace, id: \
+        server.eio.sockets[eio_sid].queue.put((event, data))
+    mgr.set_server(server)
+    mgr.enter_room('slow', '/', None, eio_sid='eio_slow')
+    mgr.enter_room('slow', '/', 'general_chat')
+    metrics.reset()
+    return mgr, eio_socket
+
+
+def _sent(eio_socket):
+    events = []
+    while not eio_socket.queue.empty():
+        events.append(eio_socket.queue.get())
+    return events
+
+
+def test_low_priority_events_dropped_or_coalesced_over_soft_limit(manager):
+    mgr, eio_socket = manager
+    mgr.emit('new_message', {'id': 1}, namespace='/', room='general_chat')
+    mgr.emit('new_message', {'id': 2}, namespace='/', room='general_chat')
+
+    # Очередь на soft-лимите: дельты отбрасываются, статусы сливаются по пользователю
+    mgr.emit('members_delta', {'version': 3}, namespace='/', room='general_chat')
+    mgr.emit('presence_delta', {'changes': [{'user_id': 7, 'online': True}]}, namespace='/', room='general_chat')
+    mgr.emit('presence_delta', {'changes': [{'user_id': 7, 'online': False},
+                                            {'user_id': 8, 'online': True}]}, namespace='/', room='general_chat')
+    # Сообщения проходят до hard-лимита
+    mgr.emit('new_message', {'id': 3}, namespace='/', room='general_chat')
+    mgr.emit('new_message', {'id': 4}, namespace='/', room='general_chat')
+    mgr.emit('new_message', {'id': 5}, namespace='/', room='general_chat')
+
+    assert [data['id'] for _, data in _sent(eio_socket)] == [1, 2, 3, 4]
+    counters = metrics.snapshot()['counters']
+    assert counters['backpressure.dropped.members_delta'] == 1
+    assert counters['backpressure.dropped.new_message'] == 1
+    assert counters['backpressure.coalesced'] == 2
+    assert mgr.backpressure_stats()['deferred_events'] == 1
+
+    # Очередь разгрузилась: отложенный статус уходит одним кадром с последними значениями
+    mgr.sweep_backpressure()
+    assert _sent(eio_socket) == [('presence_delta', {'changes': [{'user_id': 7, 'online': False},
+                                                                 {'user_id': 8, 'online': True}]})]
+    assert mgr.backpressure_stats()['slow_sockets'] == 0
+
+
+def test_batch_frame_filtered_per_inner_event(manager):
+    mgr, eio_socket = manager
+    # Очередь уже на soft-лимите
+    for i in range(2):
+        eio_socket.queue.put(('backlog', i))
+
+    # Кадр emit_batcher: второстепенные события внутри него отбрасываются и сливаются
+    frame = {'events': [
+        {'event': 'members_delta', 'data': {'version': 4}},
+        {'event': 'presence_delta', 'data': {'changes': [{'user_id': 7, 'online': True}]}},
+        {'event': 'new_message', 'data': {'id': 3}},
+    ]}
+    mgr.emit('batch', frame, namespace='/', room='general_chat')
+    # Кадр только из второстепенных событий не отправляется вовсе
+    mgr.emit('batch', {'events': [{'event': 'user_left', 'data': {}},
+                                  {'event': 'room_list', 'data': {'rooms': []}}]},
+             namespace='/', room='general_chat')
+
+    assert _sent(eio_socket)[2:] == [('batch', {'events': [{'event': 'new_message', 'data': {'id': 3}}]})]
+    assert len(frame['events']) == 3
+    counters = metrics.snapshot()['counters']
+    assert counters['backpressure.dropped.members_delta'] == 1
+    assert counters['backpressure.dropped.user_left'] == 1
+    assert counters['backpressure.coalesced'] == 2
+    assert mgr.backpressure_stats()['deferred_events'] == 2
+
+
+def test_slow_consumer_evicted_after_grace(manager):
+    mgr, eio_socket = manager
+    for i in range(3):
+        mgr.emit('new_message', {'id': i}, namespace='/', room='general_chat')
+    assert mgr.backpressure_stats()['slow_sockets'] == 1
+
+    assert mgr.sweep_backpressure() == 1
+    eio_socket.close.assert_called_once_with(wait=False, abort=True)
+    assert metrics.snapshot()['counters']['backpressure.evicted'] == 1
+    assert mgr.backpressure_stats()['slow_sockets'] == 0
@@ -0,0 +1,29 @@
+"""
+Тесты JSON-провайдера Flask/Socket.IO
+"""
+from datetime import datetime
+import pytest
+from flask import jsonify
+from app.json_provider import JSONCodec, FastJSONProvider
+
+
+def test_jsonify_encodes_datetimes_as_iso(app):
+    stamp = datetime(2024, 3, 1, 12, 30, 5, 123456)
+    with app.test_request_context():
+        response = jsonify({'at': stamp, 'users': {7: 'alice'}})
+    assert isinstance(app.json, FastJSONProvider)
+    assert response.get_json() == {'at': stamp.isoformat(), 'users': {'7': 'alice'}}
+
+
+@pytest.mark.parametrize('backend', ['orjson', 'stdlib'])
+def test_codec_backends_are_interchangeable(backend):
+    codec = JSONCodec(backend)
+    data = {'room': 'general_chat', 'users': {1: 'Пётр'}, 'at': datetime(2024, 3, 1, 8, 0)}
+    encoded = codec.dumps(data, separators=(',', ':'))
+    assert codec.loads(encoded) == {'room': 'general_chat', 'users': {'1': 'Пётр'}, 'at': '2024-03-01T08:00:00'}
+
+
+def test_socketio_packets_use_configured_codec(app):
+    from socketio import packet
+    assert isinstance(packet.Packet.json, JSONCodec)
+    assert packet.Packet.json.backend == JSONCodec(app.config['JSON_BACKEND']).backend
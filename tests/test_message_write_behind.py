@@ -0,0 +1,179 @@
+"""
+Тесты отложенной (write-behind) записи сообщений
+"""
+import pytest
+from app.metrics import metrics
+from app.models import Message, Room, User
+from app.services.message_service import MessageService
+from app.services.message_writer import MessageWriteBehind
+
+
+@pytest.fixture
+def writer(app, db):
+    """Отдельный write-behind без фоновой задачи: сброс вызывается тестом"""
+    from app.services import message_service
+    prev_config = {key: app.config.get(key) for key in ('MESSAGE_WRITE_BEHIND', 'MESSAGE_WRITE_BEHIND_MAX_QUEUE')}
+    app.config['MESSAGE_WRITE_BEHIND'] = True
+    app.config['MESSAGE_WRITE_BEHIND_MAX_QUEUE'] = 3
+    writer = MessageWriteBehind()
+    writer.init_app(app, start_worker=False)
+    prev_writer = message_service.message_writer
+    message_service.message_writer = writer
+    try:
+        yield writer
+    finally:
+        writer.flush()
+        message_service.message_writer = prev_writer
+        app.config.update(prev_config)
+
+
+@pytest.fixture
+def chat_room(app, db):
+    # БД общая на сессию тестов: создаем пользователя и комнату один раз
+    user = User.query.filter_by(username='wb_user').first()
+    if user is None:
+        user = User(username='wb_user', email='wb_user@example.com', password_hash='test_hash')
+        db.session.add(user)
+        db.session.commit()
+    room = Room.query.filter_by(name='wb_room').first()
+    if room is None:
+        room = Room(name='wb_room', created_by=user.id, is_active=True)
+        db.session.add(room)
+        db.session.commit()
+    return user, room
+
+
+def test_messages_get_ids_up_front_and_flush_in_batch(app, writer, chat_room):
+    user, room = chat_room
+    with app.app_context():
+        messages = [MessageService.create_message(f'hello {i}', user.id, room_id=room.id) for i in range(3)]
+        
+        # id и время назначены до записи в БД, id монотонны
+        ids = [message.id for message in messages]
+        assert ids == sorted(ids) and len(set(ids)) == 3
+        assert all(message.timestamp is not None for message in messages)
+        assert writer.pending() == 3
+        assert Message.query.filter(Message.id.in_(ids)).count() == 0
+        
+        assert writer.flush() == 3
+        assert writer.pending() == 0
+        stored = {m.id: m.content for m in Message.query.filter(Message.id.in_(ids)).all()}
+        assert stored == {ids[i]: f'hello {i}' for i in range(3)}
+
+
+def test_full_queue_applies_backpressure(app, writer, chat_room):
+    user, room = chat_room
+    with app.app_context():
+        before = metrics.snapshot()['counters'].get('message_write_behind.backpressure', 0)
+        for i in range(4):
+            assert MessageService.create_message(f'bp {i}', user.id, room_id=room.id) is not None
+        
+        # Четвертое сообщение не влезло: производитель сам записал пачку
+        assert metrics.snapshot()['counters']['message_write_behind.backpressure'] == before + 1
+        assert writer.pending() == 1
+
+
+def test_history_read_overlays_pending_messages(app, writer, chat_room):
+    user, room = chat_room
+    with app.app_context():
+        message = MessageService.create_message('read your writes', user.id, room_id=room.id)
+        history = MessageService._query_room_messages(room.id, 50)
+        assert history[-1]['id'] == message.id
+        assert history[-1]['sender_username'] == user.username
+        # Чтение не сбрасывает очередь в БД
+        assert writer.pending() == 1
+
+
+def test_pending_dm_marked_read_before_flush(app, db, writer, chat_room):
+    user, _ = chat_room
+    with app.app_context():
+        partner = User.query.filter_by(username='wb_partner').first()
+        if partner is None:
+            partner = User(username='wb_partner', email='wb_partner@example.com', password_hash='test_hash')
+            db.session.add(partner)
+            db.session.commit()
+        message = MessageService.create_message('dm', partner.id, recipient_id=user.id, is_dm=True)
+        assert MessageService.get_dm_messages(user.id, partner.id)[-1]['id'] == message.id
+        assert MessageService.mark_messages_as_read(user.id, partner.id)
+        writer.flush()
+        assert db.session.get(Message, message.id).is_read is True
+
+
+def test_room_delete_discards_pending_messages(app, db, writer, chat_room):
+    user, room = chat_room
+    with app.app_context():
+        message = MessageService.create_message('doomed', user.id, room_id=room.id)
+        assert MessageService.delete_room_messages(room.id)
+        assert writer.pending() == 0
+        writer.flush()
+        assert db.session.get(Message, message.id) is None
+
+
+def test_id_conflict_rekeys_row_and_requeues_failed_one(app, db, writer, chat_room, monkeypatch):
+    from sqlalchemy.exc import OperationalError
+    from app.services.message_serializer import message_serializer
+    user, room = chat_room
+    with app.app_context():
+        taken, failing = [MessageService.create_message(f'conflict {i}', user.id, room_id=room.id) for i in range(2)]
+        # id из блока write-behind уже занят строкой, записанной в обход очереди
+        db.session.add(Message(id=taken.id, content='written directly', sender_id=user.id, room_id=room.id))
+        db.session.commit()
+        assert message_serializer._cached_bytes(taken.id) is not None
+
+        insert_row = writer._insert_row_with_fallback_id
+
+        def flaky_insert(row):
+            if row['id'] == failing.id:
+                raise OperationalError('INSERT', {}, Exception('database is gone'))
+            insert_row(row)
+
+        monkeypatch.setattr(writer, '_insert_row_with_fallback_id', flaky_insert)
+        before = metrics.snapshot()['counters'].get('message_write_behind.id_conflicts', 0)
+        writer.flush(max_batches=1)
+
+        # Конфликтная строка записана под новым id, кэш по старому id ее больше не отдает
+        assert metrics.snapshot()['counters']['message_write_behind.id_conflicts'] == before + 1
+        assert db.session.get(Message, taken.id).content == 'written directly'
+        assert Message.query.filter_by(content='conflict 0').one().id != taken.id
+        assert message_serializer._cached_bytes(taken.id) is None
+        # Упавшая строка не потеряна, а возвращена в очередь
+        assert [row['id'] for row in writer.pending_rows()] == [failing.id]
+
+
+def test_ids_reserved_locally_while_redis_is_down(app, writer, chat_room):
+    from unittest.mock import MagicMock
+    import app.extensions as ext
+    from app.circuit_breaker import redis_breaker, CircuitBreaker
+    user, room = chat_room
+    broken_redis = MagicMock()
+    broken_redis.register_script.side_effect = ConnectionError('redis down')
+    prev_redis, prev_settings = ext.redis_client, (redis_breaker.failure_threshold, redis_breaker.recovery_timeout)
+    ext.redis_client = broken_redis
+    redis_breaker.configure(failure_threshold=1, recovery_timeout=60)
+    writer._id_block_size = 2
+    try:
+        with app.app_context():
+            counters = metrics.snapshot()['counters']
+            failed_before = counters.get('message_write_behind.id_allocation_failed', 0)
+            local_before = counters.get('message_write_behind.local_id_block', 0)
+            # Первый блок: Redis падает, выключатель размыкается; второй — без обращения к Redis
+            messages = [MessageService.create_message(f'redis down {i}', user.id, room_id=room.id) for i in range(3)]
+            assert redis_breaker.state == CircuitBreaker.OPEN
+            assert broken_redis.register_script.call_count == 1
+
+            # Сообщения не ушли в синхронную запись с id от БД, которые пересеклись бы с id очереди
+            ids = [message.id for message in messages]
+            assert [row['id'] for row in writer.pending_rows()] == ids
+            counters = metrics.snapshot()['counters']
+            assert counters.get('message_write_behind.id_allocation_failed', 0) == failed_before
+            assert counters['message_write_behind.local_id_block'] == local_before + 2
+
+            conflicts_before = counters.get('message_write_behind.id_conflicts', 0)
+            assert writer.flush() == 3
+            assert metrics.snapshot()['counters'].get('message_write_behind.id_conflicts', 0) == conflicts_before
+            stored = {m.id: m.content for m in Message.query.filter(Message.id.in_(ids)).all()}
+            assert stored == {ids[i]: f'redis down {i}' for i in range(3)}
+    finally:
+        ext.redis_client = prev_redis
+        redis_breaker.configure(*prev_settings)
+        redis_breaker.reset()
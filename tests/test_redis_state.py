@@ -82,6 +82,22 @@ def test_redis_ping(redis_client):
     assert redis_client.ping() is True
 
 
+def test_redis_pool_client_and_stats(redis_client):
+    """Клиент из create_redis_client работает через BlockingConnectionPool и отдает утилизацию"""
+    from app.redis_pool import create_redis_client, get_pool_stats
+    from app.metrics import metrics
+    from config import TestingConfig
+
+    client = create_redis_client({'REDIS_URL': TestingConfig.REDIS_URL, 'REDIS_MAX_CONNECTIONS': 3})
+    assert client.ping() is True
+
+    stats = get_pool_stats(client)
+    assert stats['max_connections'] == 3
+    assert stats['created'] == 1
+    assert stats['in_use'] == 0
+    assert metrics.snapshot()['gauges']['redis_pool']['max_connections'] == 3
+
+
 def test_user_state_manager_basic(flask_app_appctx, clean_redis, unique_room_name, unique_user_id):
     from app.state import UserStateManager
 
@@ -107,6 +123,72 @@ def test_user_state_manager_basic(flask_app_appctx, clean_redis, unique_room_nam
     mgr.cleanup_empty_room(room)
 
 
+def test_user_state_manager_move_user_to_room(flask_app_appctx, clean_redis, redis_client, unique_user_id):
+    """Переключение комнаты: хеши комнат и множество пользователя меняются согласованно"""
+    from app.state import UserStateManager
+
+    mgr = UserStateManager()
+    user_id = unique_user_id
+    old_rooms = [f"old_room_{uuid.uuid4().hex[:6]}" for _ in range(2)]
+    new_room = f"new_room_{uuid.uuid4().hex[:6]}"
+
+    for room in old_rooms:
+        mgr.add_user_to_room(user_id, "mover", room)
+
+    mgr.move_user_to_room(user_id, "mover", new_room, old_rooms)
+
+    assert mgr.get_user_rooms(user_id) == {new_room}
+    assert mgr.get_room_users(new_room) == {user_id: "mover"}
+    for room in old_rooms:
+        assert user_id not in mgr.get_room_users(room)
+        assert redis_client.hexists(f"room:{room}:users", str(user_id)) is False
+
+
+def test_user_state_manager_bulk_reads(flask_app_appctx, clean_redis, unique_user_id):
+    """Пакетное чтение состава и размера нескольких комнат"""
+    from app.state import UserStateManager
+
+    mgr = UserStateManager()
+    rooms = [f"bulk_room_{uuid.uuid4().hex[:6]}" for _ in range(3)]
+    mgr.add_user_to_room(unique_user_id, "first", rooms[0])
+    mgr.add_user_to_room(unique_user_id + 1, "second", rooms[0])
+    mgr.add_user_to_room(unique_user_id, "first", rooms[1])
+
+    assert mgr.get_room_user_counts(rooms) == {rooms[0]: 2, rooms[1]: 1, rooms[2]: 0}
+
+    users = mgr.get_rooms_users(rooms)
+    assert users[rooms[0]] == {unique_user_id: "first", unique_user_id + 1: "second"}
+    assert users[rooms[1]] == {unique_user_id: "first"}
+    assert users[rooms[2]] == {}
+
+    mgr.remove_user_from_rooms(unique_user_id, rooms[:2])
+    assert mgr.get_user_rooms(unique_user_id) == set()
+    assert mgr.get_room_user_counts(rooms[:2]) == {rooms[0]: 1, rooms[1]: 0}
+
+
+def test_user_state_manager_room_versions(flask_app_appctx, clean_redis, unique_user_id):
+    """Версия состава растет на каждое изменение и читается вместе со снимком"""
+    from app.state import UserStateManager
+
+    mgr = UserStateManager()
+    room = f"version_room_{uuid.uuid4().hex[:6]}"
+    other = f"version_other_{uuid.uuid4().hex[:6]}"
+
+    assert mgr.add_user_to_room(unique_user_id, "first", room) == {room: 1}
+    assert mgr.add_user_to_room(unique_user_id + 1, "second", room) == {room: 2}
+    assert mgr.get_room_snapshot(room) == (2, {unique_user_id: "first", unique_user_id + 1: "second"})
+    assert mgr.get_member_name(unique_user_id + 1, [other, room]) == "second"
+
+    assert mgr.move_user_to_room(unique_user_id, "first", other, [room]) == {room: 3, other: 1}
+    assert mgr.remove_user_from_room(unique_user_id + 1, room) == 4
+    assert mgr.get_room_snapshot(room) == (4, {})
+
+    mgr.cleanup_empty_room(room)
+    assert mgr.get_room_snapshot(room) == (0, {})
+    mgr.remove_user_from_rooms(unique_user_id, [other])
+    mgr.cleanup_empty_room(other)
+
+
 def test_connection_manager_basic(flask_app_appctx, clean_redis, unique_user_id, unique_socket_id):
     from app.state import ConnectionManager
 
@@ -124,6 +206,55 @@ def test_connection_manager_basic(flask_app_appctx, clean_redis, unique_user_id,
     assert mgr.get_user_socket(user_id) is None
 
 
+def test_connection_manager_bulk_presence_and_reap(flask_app_appctx, clean_redis, unique_user_id):
+    """Пакетная проверка присутствия и истечение heartbeat через единый ZSET"""
+    from app.state import ConnectionManager
+    import time
+
+    mgr = ConnectionManager()
+    alive, stale = unique_user_id, unique_user_id + 1
+    mgr.register_connection(alive, f"socket_{alive}")
+    mgr.register_connection(stale, f"socket_{stale}")
+    mgr.refresh_heartbeat(stale, ttl_seconds=0.2)
+
+    assert mgr.connected_users([alive, stale, unique_user_id + 2]) == {alive, stale}
+
+    expired = mgr.reap_expired(now=time.time() + 1)
+    assert expired == [stale]
+    assert mgr.connected_users([alive, stale]) == {alive}
+    assert mgr.get_user_socket(stale) is None
+    assert mgr.get_socket_user(f"socket_{stale}") is None
+
+    # Повторный reap ничего не возвращает: каждое истечение обрабатывается один раз
+    assert mgr.reap_expired(now=time.time() + 1) == []
+
+
+def test_connection_manager_reap_expired_memory(flask_app_appctx, unique_user_id):
+    """Reaper в памяти очищает соединения без обращения к ним"""
+    from app.state import ConnectionManager
+    import app.extensions as ext
+    import time
+
+    prev_redis = ext.redis_client
+    ext.redis_client = None
+    try:
+        mgr = ConnectionManager()
+        for offset in range(3):
+            mgr.register_connection(unique_user_id + offset, f"socket_{offset}")
+        mgr.refresh_heartbeat(unique_user_id, ttl_seconds=0.1)
+        # Продленный heartbeat: старая запись в куче должна быть проигнорирована
+        mgr.refresh_heartbeat(unique_user_id + 1, ttl_seconds=0.1)
+        mgr.refresh_heartbeat(unique_user_id + 1, ttl_seconds=60)
+
+        expired = mgr.reap_expired(now=time.time() + 1)
+        assert expired == [unique_user_id]
+        assert unique_user_id not in mgr._connections
+        assert unique_user_id not in mgr._heartbeat_expires
+        assert mgr.connected_users([unique_user_id + 1, unique_user_id + 2]) == {unique_user_id + 1, unique_user_id + 2}
+    finally:
+        ext.redis_client = prev_redis
+
+
 def test_room_manager_basic(flask_app_appctx, clean_redis, unique_room_name, unique_user_id):
     from app.state import RoomManager
 
@@ -312,6 +443,8 @@ def test_redis_failure_fallback(flask_app_appctx, unique_user_id, unique_socket_
     mock_redis.exists.side_effect = Exception("Redis connection lost")
     mock_redis.delete.side_effect = Exception("Redis connection lost")
     mock_redis.set.side_effect = Exception("Redis connection lost")
+    mock_redis.pipeline.side_effect = Exception("Redis connection lost")
+    mock_redis.zadd.side_effect = Exception("Redis connection lost")
 
     # Подменяем Redis клиент
     prev_redis = ext.redis_client
@@ -340,6 +473,156 @@ def test_redis_failure_fallback(flask_app_appctx, unique_user_id, unique_socket_
         ext.redis_client = prev_redis
 
 
+def test_circuit_breaker_short_circuits_failing_redis(flask_app_appctx, unique_user_id, unique_socket_id):
+    """После серии ошибок менеджеры не обращаются к Redis до истечения таймаута"""
+    from app.state import ConnectionManager
+    from app.circuit_breaker import redis_breaker, CircuitBreaker
+    import app.extensions as ext
+    from unittest.mock import Mock
+
+    mock_redis = Mock()
+    mock_redis.hget.side_effect = Exception("Redis connection lost")
+    mock_redis.pipeline.side_effect = Exception("Redis connection lost")
+
+    prev_redis = ext.redis_client
+    prev_settings = (redis_breaker.failure_threshold, redis_breaker.recovery_timeout)
+    ext.redis_client = mock_redis
+    redis_breaker.configure(failure_threshold=2, recovery_timeout=60)
+    try:
+        mgr = ConnectionManager()
+        mgr.register_connection(unique_user_id, unique_socket_id)
+        mgr.get_user_socket(unique_user_id)
+        assert redis_breaker.state == CircuitBreaker.OPEN
+
+        calls = mock_redis.hget.call_count
+        # Разомкнутый выключатель: работа только с памятью, без обращений к Redis
+        assert mgr.get_user_socket(unique_user_id) == unique_socket_id
+        mgr.remove_connection(unique_user_id)
+        assert mgr.is_user_connected(unique_user_id) is False
+        assert mock_redis.hget.call_count == calls
+    finally:
+        ext.redis_client = prev_redis
+        redis_breaker.configure(*prev_settings)
+        redis_breaker.reset()
+
+
+def test_circuit_breaker_reconciles_memory_state_on_recovery(flask_app_appctx, clean_redis, redis_client,
+                                                             unique_user_id, unique_socket_id, unique_room_name):
+    """После восстановления Redis состояние из памяти переносится обратно"""
+    from app.state import user_state, conn_mgr, room_mgr
+    from app.circuit_breaker import redis_breaker, CircuitBreaker
+
+    prev_settings = (redis_breaker.failure_threshold, redis_breaker.recovery_timeout)
+    redis_breaker.bind(redis_client)
+    redis_breaker.configure(failure_threshold=1, recovery_timeout=60)
+    try:
+        # Пользователь был в комнате до сбоя
+        user_state.add_user_to_room(unique_user_id, "alice", "stale_room")
+        redis_breaker.record_failure()
+        assert redis_breaker.state == CircuitBreaker.OPEN
+
+        # Изменения во время сбоя попадают только в память
+        user_state.move_user_to_room(unique_user_id, "alice", unique_room_name, ["stale_room"])
+        conn_mgr.register_connection(unique_user_id, unique_socket_id)
+        room_mgr.create_room_if_absent(unique_room_name, unique_user_id)
+        assert redis_client.hgetall(f"room:{unique_room_name}:users") == {}
+
+        # Проба проходит: память сверяется с Redis и очищается
+        redis_breaker.configure(recovery_timeout=0)
+        assert user_state.get_room_users(unique_room_name) == {unique_user_id: "alice"}
+        assert redis_breaker.state == CircuitBreaker.CLOSED
+        assert user_state.get_room_users("stale_room") == {}
+        assert user_state.get_user_rooms(unique_user_id) == {unique_room_name}
+        assert conn_mgr.get_user_socket(unique_user_id) == unique_socket_id
+        assert conn_mgr.is_user_connected(unique_user_id) is True
+        assert unique_room_name in room_mgr.get_all_rooms()
+        assert user_state._room_users == {} and conn_mgr._connections == {}
+    finally:
+        redis_breaker.configure(*prev_settings)
+        redis_breaker.reset()
+
+
+class _ExecuteHookClient:
+    """Клиент Redis, который вызывает hook перед каждым pipe.execute() (имитация переключения гринлета)"""
+
+    def __init__(self, client, hook):
+        self._client = client
+        self._hook = hook
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self._client.pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def hooked_execute(*a, **kw):
+            self._hook()
+            return execute(*a, **kw)
+
+        pipe.execute = hooked_execute
+        return pipe
+
+
+def _once(func):
+    """Вызывает func только при первом обращении"""
+    calls = []
+
+    def wrapper():
+        if not calls:
+            calls.append(True)
+            func()
+    return wrapper
+
+
+def test_reconcile_keeps_memory_writes_made_during_execute(flask_app_appctx, clean_redis, redis_client,
+                                                           unique_user_id, unique_room_name):
+    """Записи в память, сделанные пока сверка ждет Redis, не теряются"""
+    from app.state import UserStateManager, ConnectionManager, RoomManager
+
+    user_mgr, conn_mgr, room_mgr = UserStateManager(), ConnectionManager(), RoomManager()
+    late_user = unique_user_id + 1
+    user_mgr._memory_add(unique_user_id, "alice", unique_room_name)
+    conn_mgr._connections[unique_user_id] = "sock_alice"
+    room_mgr._rooms[unique_room_name] = {'name': unique_room_name, 'created_by': unique_user_id, 'is_active': True}
+
+    late_writes = {
+        user_mgr: lambda: user_mgr._memory_add(late_user, "bob", unique_room_name),
+        conn_mgr: lambda: conn_mgr._connections.__setitem__(late_user, "sock_bob"),
+        room_mgr: lambda: room_mgr._rooms.__setitem__(f"{unique_room_name}_late", {
+            'name': f"{unique_room_name}_late", 'created_by': late_user, 'is_active': True}),
+    }
+    for mgr, write in late_writes.items():
+        mgr.reconcile_to_redis(_ExecuteHookClient(redis_client, _once(write)))
+
+    assert redis_client.hgetall(f"room:{unique_room_name}:users") == {str(unique_user_id): "alice",
+                                                                      str(late_user): "bob"}
+    assert redis_client.hget("conn:user_to_socket", str(late_user)) == "sock_bob"
+    assert redis_client.sismember("rooms", f"{unique_room_name}_late")
+    assert user_mgr._room_users == {} and conn_mgr._connections == {} and room_mgr._rooms == {}
+
+
+def test_reconcile_failure_merges_snapshot_back(flask_app_appctx, clean_redis, redis_client,
+                                                unique_user_id, unique_room_name):
+    """Неудачный execute() возвращает снимок в память, не затирая более новые записи"""
+    from app.state import UserStateManager
+
+    mgr = UserStateManager()
+    mgr._memory_add(unique_user_id, "alice", unique_room_name)
+    mgr._memory_add(unique_user_id + 1, "bob", unique_room_name)
+
+    def fail():
+        # Пока сверка ждала Redis, bob вышел из комнаты
+        mgr._room_users.setdefault(unique_room_name, {})
+        mgr._pending_removals.add((unique_user_id + 1, unique_room_name))
+        raise ConnectionError("redis down")
+
+    with pytest.raises(ConnectionError):
+        mgr.reconcile_to_redis(_ExecuteHookClient(redis_client, fail))
+
+    assert mgr._room_users[unique_room_name] == {unique_user_id: "alice"}
+    assert mgr._user_rooms == {unique_user_id: {unique_room_name}}
+    assert mgr._pending_removals == {(unique_user_id + 1, unique_room_name)}
+    assert redis_client.hgetall(f"room:{unique_room_name}:users") == {}
+
+
 @pytest.mark.parametrize("ttl, sleep_time, should_be_connected", [
     (1.0, 0.9, True),    # чуть меньше TTL (увеличил запас)
     (1.0, 1.1, False),   # чуть больше TTL
@@ -586,3 +869,54 @@ def test_heartbeat_config_fallback(flask_app_appctx, unique_user_id, unique_sock
         ext.redis_client = prev_redis
 
 
+
+
+def test_sharded_manager_subscribes_only_local_rooms(clean_redis, redis_client):
+    """Канал комнаты: подписка при первом локальном сокете, отписка после последнего"""
+    import pickle
+    from unittest.mock import MagicMock
+    from app.room_pubsub import ShardedRedisManager
+    from config import TestingConfig
+
+    mgr = ShardedRedisManager(TestingConfig.REDIS_URL, channel="test-socketio")
+    mgr.set_server(MagicMock())
+    room = f"shard_room_{uuid.uuid4().hex[:6]}"
+    channel = mgr.room_channel('/', room)
+
+    sids = ("sid_a_0123456789abcd", "sid_b_0123456789abcd")
+    for sid, eio_sid in zip(sids, ("eio_a", "eio_b")):
+        mgr.enter_room(sid, '/', None, eio_sid=eio_sid)
+        # Комната самого сокета не получает своего канала
+        mgr.enter_room(sid, '/', sid, eio_sid=eio_sid)
+        mgr.enter_room(sid, '/', room)
+    assert mgr.subscribed_rooms() == {channel}
+    # SUBSCRIBE отправляет слушатель между чтениями, а не обработчик
+    assert redis_client.pubsub_numsub(channel) == [(channel, 0)]
+    mgr._apply_subscriptions()
+    assert redis_client.pubsub_numsub(channel) == [(channel, 1)]
+
+    # emit в комнату уходит только в ее канал, а не в общий
+    listener = mgr.redis.pubsub(ignore_subscribe_messages=True)
+    listener.subscribe(channel, "test-socketio")
+    for _ in range(2):
+        # Подтверждения подписки отфильтровываются (get_message возвращает None)
+        listener.get_message(timeout=0.1)
+    mgr.emit('new_message', {'text': 'hi'}, namespace='/', room=room)
+    message = listener.get_message(timeout=1)
+    assert message['channel'] == channel.encode()
+    assert pickle.loads(message['data'])['event'] == 'new_message'
+    assert listener.get_message(timeout=0.1) is None
+
+    # emit одному сокету — через общий канал
+    mgr.emit('new_dm', {'text': 'hi'}, namespace='/', room=sids[0])
+    message = listener.get_message(timeout=1)
+    assert message['channel'] == b"test-socketio"
+
+    mgr.leave_room(sids[0], '/', room)
+    assert channel in mgr.subscribed_rooms()
+    mgr.disconnect(sids[1], "/", ignore_queue=True)
+    assert channel not in mgr.subscribed_rooms()
+    listener.close()
+    mgr._apply_subscriptions()
+    assert redis_client.pubsub_numsub(channel) == [(channel, 0)]
+    mgr.pubsub.close()
@@ -8,6 +8,7 @@ from app.services.websocket_service import WebSocketService
 from app.services.message_service import MessageService
 from app.models import Room, User, Message
 from app.extensions import db
+from app.state import user_state
 
 
 class TestRoomCreation:
@@ -173,7 +174,67 @@ class TestRoomRetrieval:
         with app.app_context():
             room = RoomService.get_room_by_name('nonexistent_room')
             assert room is None
-    
+
+    def test_room_ref_cached_until_invalidated(self, app, db):
+        """Тест справочника комнат: повторный поиск по имени без SQL, сброс при удалении"""
+        from sqlalchemy import event
+        with app.app_context():
+            user = User(username='directory_user', email='directory_user@example.com', password_hash='test_hash')
+            db.session.add(user)
+            db.session.commit()
+            room = RoomService.create_room('directory_room', user.id)
+
+            ref = RoomService.get_room_ref('directory_room')
+            assert (ref.id, ref.name, ref.is_active) == (room.id, 'directory_room', True)
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                assert RoomService.get_room_ref('directory_room') == ref
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            assert statements == []
+
+            # Мягкое удаление сбрасывает запись — неактивная комната больше не находится
+            assert RoomService.delete_room(room.id, user.id)
+            assert RoomService.get_room_ref('directory_room') is None
+
+    def test_get_all_rooms_single_query_with_paging(self, app, db):
+        """Тест списка комнат: один SQL-запрос без N+1, страницы по курсору и фильтр по префиксу"""
+        from sqlalchemy import event
+        with app.app_context():
+            users = [User(username=f'lister_{i}', email=f'lister_{i}@example.com', password_hash='test_hash')
+                     for i in range(3)]
+            db.session.add_all(users)
+            db.session.commit()
+            for i in range(6):
+                db.session.add(Room(name=f'page_{i}', created_by=users[i % 3].id))
+            db.session.add(Room(name='page%other', created_by=users[0].id))
+            db.session.commit()
+            db.session.expire_all()
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                rooms = RoomService.get_all_rooms(prefix='page_')
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            assert len(statements) == 1
+            assert [r['name'] for r in rooms] == [f'page_{i}' for i in range(6)]
+            assert [r['creator_username'] for r in rooms[:3]] == ['lister_0', 'lister_1', 'lister_2']
+
+            first = RoomService.get_all_rooms(limit=4, prefix='page_')
+            second = RoomService.get_all_rooms(limit=4, after=first[-1]['name'], prefix='page_')
+            assert [r['name'] for r in first + second] == [f'page_{i}' for i in range(6)]
+
     def test_get_all_rooms(self, app, db):
         """Тест получения всех комнат"""
         with app.app_context():
@@ -670,11 +731,11 @@ class TestRoomEdgeCases:
             db.session.commit()
             
             # Симулируем активных пользователей в комнате через WebSocket сервис
-            ws_service = WebSocketService()
-            ws_service.active_users['active_room'] = {user.id: user.username}
+            user_state.add_user_to_room(user.id, user.username, 'active_room')
             
             # Пытаемся удалить комнату
             result = RoomService.cleanup_empty_room('active_room')
+            user_state.remove_user_from_room(user.id, 'active_room')
             
             # Комната должна быть удалена (логика проверки пользователей в WebSocket сервисе)
             assert result is True
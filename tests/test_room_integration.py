@@ -8,6 +8,7 @@ from app.services.websocket_service import WebSocketService
 from app.services.message_service import MessageService
 from app.models import Room, User, Message
 from app.extensions import db
+from app.state import user_state
 
 
 class TestRoomUserInteraction:
@@ -31,34 +32,32 @@ class TestRoomUserInteraction:
             db.session.add(room)
             db.session.commit()
             
-            # Создаем WebSocket сервис
-            ws_service = WebSocketService()
-            
             # Пользователь 1 присоединяется к комнате
-            ws_service.active_users['test_room'] = {user1.id: user1.username}
+            user_state.add_user_to_room(user1.id, user1.username, 'test_room')
             
-            # Проверяем, что пользователь в комнате
-            assert user1.id in ws_service.active_users['test_room']
-            assert ws_service.active_users['test_room'][user1.id] == user1.username
+            # Проверяем, что пользователь в комнате (и в обратном индексе)
+            assert user_state.get_room_users('test_room')[user1.id] == user1.username
+            assert 'test_room' in user_state.get_user_rooms(user1.id)
             
             # Пользователь 2 присоединяется к комнате
-            ws_service.active_users['test_room'][user2.id] = user2.username
+            user_state.add_user_to_room(user2.id, user2.username, 'test_room')
             
             # Проверяем, что оба пользователя в комнате
-            assert len(ws_service.active_users['test_room']) == 2
+            assert len(user_state.get_room_users('test_room')) == 2
             
             # Пользователь 1 выходит из комнаты
-            del ws_service.active_users['test_room'][user1.id]
+            user_state.remove_user_from_room(user1.id, 'test_room')
             
             # Проверяем, что пользователь 1 вышел
-            assert user1.id not in ws_service.active_users['test_room']
-            assert user2.id in ws_service.active_users['test_room']
+            assert user1.id not in user_state.get_room_users('test_room')
+            assert 'test_room' not in user_state.get_user_rooms(user1.id)
+            assert user2.id in user_state.get_room_users('test_room')
             
             # Пользователь 2 выходит из комнаты
-            del ws_service.active_users['test_room'][user2.id]
+            user_state.remove_user_from_room(user2.id, 'test_room')
             
             # Комната становится пустой
-            assert len(ws_service.active_users['test_room']) == 0
+            assert user_state.get_room_user_counts(['test_room']) == {'test_room': 0}
     
     def test_room_cleanup_after_last_user_leaves(self, app, db):
         """Тест автоматической очистки комнаты после выхода последнего пользователя"""
@@ -80,13 +79,14 @@ class TestRoomUserInteraction:
             ws_service = WebSocketService()
             
             # Пользователь присоединяется к комнате
-            ws_service.active_users['temp_room'] = {user.id: user.username}
+            user_state.add_user_to_room(user.id, user.username, 'temp_room')
             
-            # Проверяем, что комната существует
+            # Пока в комнате есть пользователь, она не удаляется
+            ws_service._check_and_cleanup_empty_room('temp_room')
             assert Room.query.filter_by(name='temp_room').first() is not None
             
             # Пользователь выходит из комнаты
-            del ws_service.active_users['temp_room'][user.id]
+            user_state.remove_user_from_room(user.id, 'temp_room')
             
             # Проверяем и очищаем пустую комнату
             ws_service._check_and_cleanup_empty_room('temp_room')
@@ -114,28 +114,95 @@ class TestRoomUserInteraction:
             db.session.add(room)
             db.session.commit()
             
-            # Создаем WebSocket сервис
-            ws_service = WebSocketService()
-            
             # Все пользователи присоединяются к комнате
-            ws_service.active_users['multi_user_room'] = {}
             for user in users:
-                ws_service.active_users['multi_user_room'][user.id] = user.username
+                user_state.add_user_to_room(user.id, user.username, 'multi_user_room')
             
             # Проверяем, что все пользователи в комнате
-            assert len(ws_service.active_users['multi_user_room']) == 5
+            assert len(user_state.get_room_users('multi_user_room')) == 5
             
             # Пользователи по очереди выходят
             for i, user in enumerate(users[:-1]):  # Все кроме последнего
-                del ws_service.active_users['multi_user_room'][user.id]
-                assert len(ws_service.active_users['multi_user_room']) == 4 - i
+                user_state.remove_user_from_room(user.id, 'multi_user_room')
+                assert len(user_state.get_room_users('multi_user_room')) == 4 - i
             
             # Последний пользователь выходит
             last_user = users[-1]
-            del ws_service.active_users['multi_user_room'][last_user.id]
+            user_state.remove_user_from_room(last_user.id, 'multi_user_room')
             
             # Комната становится пустой
-            assert len(ws_service.active_users['multi_user_room']) == 0
+            assert len(user_state.get_room_users('multi_user_room')) == 0
+
+
+    def test_load_user_served_from_identity_cache(self, app, db):
+        """Тест load_user: повторная аутентификация без SQL, сброс при изменении профиля"""
+        from sqlalchemy import event
+        from app.models import load_user
+        from app.services.identity_cache import identity_cache
+        with app.app_context():
+            user = User(username='identity_user', email='identity_user@example.com', password_hash='test_hash')
+            db.session.add(user)
+            db.session.commit()
+
+            identity = load_user(str(user.id))
+            assert (identity.id, identity.username) == (user.id, 'identity_user')
+            assert identity.is_authenticated
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                assert load_user(str(user.id)) is identity
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            assert statements == []
+
+            user.username = 'identity_user2'
+            db.session.commit()
+            identity_cache.invalidate(user.id)
+            assert load_user(str(user.id)).username == 'identity_user2'
+            assert load_user('999999') is None
+
+    def test_online_status_from_heartbeat_index(self, app, db):
+        """Тест статуса онлайн: список из индекса heartbeat без SQL, last_seen пишется пачкой"""
+        from datetime import datetime
+        from sqlalchemy import event
+        from app.services.user_service import UserService
+        from app.services.last_seen import last_seen_tracker
+        from app.state import conn_mgr
+        with app.app_context():
+            user = User(username='presence_user', email='presence_user@example.com', password_hash='test_hash',
+                        last_seen=datetime(2000, 1, 1))
+            db.session.add(user)
+            db.session.commit()
+            user_id = user.id
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                conn_mgr.register_connection(user_id, 'presence_sid', 'presence_user')
+                UserService.mark_seen(user_id)
+                online = UserService.get_online_users()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+            assert statements == []
+            assert online[user_id] == 'presence_user'
+            assert UserService.get_presence(user)['last_seen'] > datetime(2000, 1, 1)
+
+            assert last_seen_tracker.flush() >= 1
+            db.session.refresh(user)
+            assert user.last_seen > datetime(2000, 1, 1)
+
+            conn_mgr.remove_connection(user.id)
+            assert user.id not in UserService.get_online_users()
+            assert UserService.get_presence(user)['online'] is False
 
 
 class TestRoomMessageIntegration:
@@ -189,7 +256,103 @@ class TestRoomMessageIntegration:
                 assert 'sender_id' in message_data
                 assert 'timestamp' in message_data
                 assert 'sender_username' in message_data
-    
+
+    def test_room_history_keyset_pagination(self, app, db):
+        """Тест постраничной загрузки истории по курсору before_id/before_ts"""
+        from datetime import datetime, timedelta
+        with app.app_context():
+            user = User(username='cursor_user', email='cursor_user@example.com', password_hash='test_hash')
+            db.session.add(user)
+            db.session.commit()
+            room = Room(name='cursor_room', created_by=user.id, is_active=True)
+            db.session.add(room)
+            db.session.commit()
+
+            # Часть сообщений с одинаковым временем: порядок держится на тай-брейкере id
+            base = datetime(2024, 1, 1, 12, 0, 0)
+            for i in range(25):
+                db.session.add(Message(content=f'msg {i}', sender_id=user.id, room_id=room.id,
+                                       timestamp=base + timedelta(seconds=i // 3)))
+            db.session.commit()
+
+            first_page = MessageService.get_room_messages(room.id, limit=10)
+            assert [m['content'] for m in first_page] == [f'msg {i}' for i in range(15, 25)]
+
+            # Новое сообщение между запросами страниц не сдвигает курсор
+            db.session.add(Message(content='late', sender_id=user.id, room_id=room.id,
+                                   timestamp=base + timedelta(minutes=5)))
+            db.session.commit()
+
+            seen = [m['content'] for m in first_page]
+            cursor = MessageService.history_cursor(first_page)
+            while cursor['before_id'] is not None:
+                page = MessageService.get_room_messages(room.id, limit=10, **cursor)
+                seen = [m['content'] for m in page] + seen
+                cursor = MessageService.history_cursor(page)
+            assert seen == [f'msg {i}' for i in range(25)]
+
+            # Курсор только по before_id: время берется из самого сообщения
+            page = MessageService.get_room_messages(room.id, limit=3, before_id=first_page[0]['id'])
+            assert [m['content'] for m in page] == ['msg 12', 'msg 13', 'msg 14']
+
+    def test_room_history_served_from_recent_buffer(self, app, db):
+        """Тест: история, помещающаяся в буфер последних сообщений, не обращается к SQL"""
+        from sqlalchemy import event
+        with app.app_context():
+            user = User(username='buffer_user', email='buffer_user@example.com', password_hash='test_hash')
+            db.session.add(user)
+            db.session.commit()
+            room = Room(name='buffer_room', created_by=user.id, is_active=True)
+            db.session.add(room)
+            db.session.commit()
+            room_id = room.id
+
+            for i in range(5):
+                MessageService.create_message(f'warm {i}', user.id, room_id=room_id)
+            # Первый запрос прогревает буфер из БД, дальнейшие сообщения дописываются в него
+            assert len(MessageService.get_room_messages(room_id, limit=20)) == 5
+            for i in range(3):
+                MessageService.create_message(f'hot {i}', user.id, room_id=room_id)
+
+            statements = []
+
+            def count(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                page = MessageService.get_room_messages(room_id, limit=20)
+                older = MessageService.get_room_messages(room_id, limit=3, before_id=page[3]['id'])
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+
+            assert statements == []
+            assert [m['content'] for m in page] == [f'warm {i}' for i in range(5)] + [f'hot {i}' for i in range(3)]
+            assert [m['content'] for m in older] == ['warm 0', 'warm 1', 'warm 2']
+
+            # После удаления комнаты буфер сбрасывается
+            assert RoomService.cleanup_empty_room('buffer_room')
+            assert MessageService.get_room_messages(room_id, limit=20) == []
+
+    def test_message_payload_serialized_once(self, app, db):
+        """Тест: канонический словарь и JSON сообщения строятся один раз и переиспользуются"""
+        import json
+        from app.services.message_serializer import message_serializer
+        with app.app_context():
+            user = User(username='payload_user', email='payload_user@example.com', password_hash='test_hash')
+            db.session.add(user)
+            db.session.commit()
+            message = MessageService.create_message('payload', user.id, recipient_id=None, room_id=None)
+
+            payload = message_serializer.payload(message)
+            assert message_serializer.payload(message) is payload
+            assert payload['timestamp'] == message.timestamp.isoformat()
+            assert message.to_dict()['content'] == 'payload'
+
+            response = message_serializer.json_response([payload], has_more=False)
+            assert json.loads(response.get_data()) == {'messages': [payload], 'has_more': False}
+            assert message_serializer.encoded(message) in response.get_data()
+
     def test_room_deletion_with_messages(self, app, db):
         """Тест удаления комнаты с сообщениями"""
         with app.app_context():
@@ -274,15 +437,131 @@ class TestRoomMessageIntegration:
             assert page3[0]['content'] == 'Message 00'  # Самое старое сообщение
 
 
+@pytest.fixture
+def redis_buffer(app):
+    """Подключает Redis к буферу последних сообщений (пропуск, если Redis недоступен)"""
+    import redis
+    import app.extensions as ext
+    from config import TestingConfig
+
+    client = redis.from_url(TestingConfig.REDIS_URL, decode_responses=True)
+    try:
+        client.ping()
+    except Exception as exc:
+        pytest.skip(f"Redis недоступен: {exc}")
+    prev = ext.redis_client
+    ext.redis_client = client
+    try:
+        yield client
+    finally:
+        ext.redis_client = prev
+
+
+def test_recent_buffer_warmup_keeps_concurrent_pushes(app, redis_buffer):
+    """Тест: сообщение, добавленное до или во время прогрева буфера, не теряется"""
+    from app.services.recent_messages import recent_messages
+
+    def message(n):
+        # id вне диапазона настоящих сообщений: кэш сериализатора общий
+        return {'id': 910000 + n, 'sender_id': 1, 'sender_username': 'u', 'recipient_id': None,
+                'room_id': 9100, 'content': f'm{n}',
+                'timestamp': f'2026-01-01T00:00:{n:02d}', 'is_dm': False}
+
+    with app.test_request_context():
+        recent_messages.invalidate(9100)
+        # Сообщение другого воркера, еще не записанное в БД: в снимке его нет
+        recent_messages.push(9100, message(3))
+        assert recent_messages._warm(9100, lambda size: [message(1), message(2)]) == [message(3), message(2), message(1)]
+        assert redis_buffer.exists('room:9100:recent:loaded')
+
+        recent_messages.invalidate(9100)
+
+        def racing_loader(size):
+            recent_messages.push(9100, message(4))
+            return [message(1), message(2)]
+
+        recent_messages._warm(9100, racing_loader)
+        # Снимок без сообщения 4 не сохранен; следующий прогрев его подхватит
+        assert not redis_buffer.exists('room:9100:recent:loaded')
+        assert recent_messages._warm(9100, lambda size: [message(1), message(2)])[0] == message(4)
+        recent_messages.invalidate(9100)
+
+
+def test_room_directory_late_put_does_not_resurrect_deleted_room(app, redis_buffer):
+    """Тест: запись, прочитанная из БД до удаления комнаты, не попадает в кэш после сброса"""
+    import json
+    from types import SimpleNamespace
+    from app.services.room_directory import room_directory
+
+    with app.test_request_context():
+        room = SimpleNamespace(id=987001, name='directory_race_room', is_active=True, is_private=False)
+        generation = room_directory.generation(room.name)
+        # Комнату удалили, пока промах читал строку из БД
+        room_directory.invalidate(room.name)
+        room_directory.put(room, generation)
+        assert room_directory.get(room.name) is None
+        assert not redis_buffer.exists('rooms:directory:directory_race_room')
+
+        # Чтение из кэша не ходит в БД; вход в комнату (strict) сверяет запись и отбрасывает устаревшую
+        redis_buffer.set('rooms:directory:directory_race_room', json.dumps([room.id, True, False]))
+        assert RoomService.get_room_ref(room.name) == (room.id, room.name, True, False)
+        assert RoomService.get_room_ref(room.name, strict=True) is None
+        assert not redis_buffer.exists('rooms:directory:directory_race_room')
+
+
+def test_sender_name_loaded_from_db_on_identity_miss(app, db):
+    """Тест: при промахе кэша личности имя отправителя берется из БД, а не заглушка"""
+    from app.services.message_serializer import message_serializer
+    with app.app_context():
+        user = User.query.filter_by(username='identity_miss_user').first()
+        if user is None:
+            user = User(username='identity_miss_user', email='identity_miss_user@example.com',
+                        password_hash='test_hash')
+            db.session.add(user)
+            db.session.commit()
+            room = Room(name='identity_miss_room', created_by=user.id, is_active=True)
+            db.session.add(room)
+            db.session.commit()
+        room = Room.query.filter_by(name='identity_miss_room').first()
+        with patch('app.services.message_service.identity_cache.get', return_value=None):
+            message = MessageService.create_message('who am i', user.id, room_id=room.id)
+        assert message_serializer.payload(message)['sender_username'] == 'identity_miss_user'
+
+
+def test_renamed_sender_not_served_from_message_caches(app, db):
+    """Тест: после смены имени кэш сообщений и буфер последних сообщений отдают новое имя"""
+    with app.app_context():
+        user = User(username='rename_before', email='rename_sender@example.com', password_hash='test_hash')
+        db.session.add(user)
+        db.session.commit()
+        room = Room(name='rename_sender_room', created_by=user.id, is_active=True)
+        db.session.add(room)
+        db.session.commit()
+        MessageService.create_message('named message', user.id, room_id=room.id)
+        assert MessageService.get_room_messages(room.id, 10)[-1]['sender_username'] == 'rename_before'
+
+        user.username = 'rename_after'
+        db.session.commit()
+        # Запрос к БД (как на воркере, где кэш не сбрасывали) пересобирает запись с прежним именем
+        assert MessageService._query_room_messages(room.id, 10)[-1]['sender_username'] == 'rename_after'
+        # Буфер последних сообщений хранит готовые словари — его сбрасывает смена имени
+        MessageService.forget_sender(user.id)
+        assert MessageService.get_room_messages(room.id, 10)[-1]['sender_username'] == 'rename_after'
+
+
 class TestRoomWebSocketIntegration:
     """Тесты интеграции комнат с WebSocket"""
     
     def test_room_list_broadcast(self, app, db):
-        """Тест рассылки списка комнат"""
+        """Тест рассылки списка комнат: полный список подключившемуся, остальным — diff с версией"""
+        from app.services.room_list_broadcaster import room_list_broadcaster
         with app.app_context():
-            # Очищаем все комнаты перед тестом
+            # Очищаем все комнаты перед тестом и синхронизируем последний разосланный список
             Room.query.delete()
             db.session.commit()
+            room_list_broadcaster.mark_dirty()
+            room_list_broadcaster.flush(MagicMock())
+            version_before, _ = room_list_broadcaster.snapshot()
             
             # Создаем пользователя
             user = User(username='broadcast_testuser', email='broadcast_test@example.com', password_hash='test_hash')
@@ -309,26 +588,104 @@ class TestRoomWebSocketIntegration:
             # Создаем WebSocket сервис
             ws_service = WebSocketService()
             
-            # Мокаем emit для проверки рассылки
+            # Несколько изменений за окно схлопываются в один diff
             with patch('app.services.websocket_service.emit') as mock_emit:
-                # Рассылаем список комнат
                 ws_service._broadcast_room_list()
+                ws_service._broadcast_room_list()
+                mock_emit.assert_not_called()
+            
+            mock_socketio = MagicMock()
+            payload = room_list_broadcaster.flush(mock_socketio)
+            mock_socketio.emit.assert_called_once_with('room_list_delta', payload)
+            assert payload['version'] == version_before + 1
+            assert payload['added'] == ['room1', 'room2']  # Только активные комнаты
+            assert payload['removed'] == []
+            
+            # Без новых изменений повторной рассылки нет
+            assert room_list_broadcaster.flush(mock_socketio) is None
+            
+            # Подключившийся клиент получает полный список с текущей версией
+            with patch('app.services.websocket_service.emit') as mock_emit:
+                ws_service._send_room_list()
                 
-                # Проверяем, что emit был вызван
-                mock_emit.assert_called_once()
-                
-                # Проверяем данные рассылки
                 call_args = mock_emit.call_args
                 assert call_args[0][0] == 'room_list'
                 
                 rooms_list = call_args[0][1]['rooms']
-                assert len(rooms_list) == 2  # Только активные комнаты
-                
-                # rooms_list - это уже список названий комнат (строк)
+                assert len(rooms_list) == 2
                 assert 'room1' in rooms_list
                 assert 'room2' in rooms_list
                 assert 'room3' not in rooms_list  # Неактивная комната не включена
+                assert call_args[0][1]['version'] == payload['version']
     
+    def test_presence_delta_targets_rooms_and_dm_partners(self, app, db):
+        """Тест presence_delta: изменения за окно одним кадром — комнатам и подключенным собеседникам"""
+        from app.models import Conversation
+        from app.services.presence_broadcaster import presence_broadcaster
+        from app.state import conn_mgr
+        with app.app_context():
+            users = [User(username=f'presence_{name}', email=f'presence_{name}@example.com', password_hash='test_hash')
+                     for name in ('alice', 'bob', 'carol')]
+            db.session.add_all(users)
+            db.session.commit()
+            alice, bob, carol = (u.id for u in users)
+            for partner in (bob, carol):
+                user_a, user_b = Conversation.pair(alice, partner)
+                db.session.add(Conversation(user_a_id=user_a, user_b_id=user_b))
+            db.session.commit()
+            conn_mgr.register_connection(bob, 'presence_bob_sid', 'presence_bob')
+            presence_broadcaster.flush(MagicMock())
+
+            # Переподключение за окно схлопывается в одно изменение с последним статусом
+            presence_broadcaster.record(alice, False, ['presence_room'])
+            presence_broadcaster.record(alice, True, [WebSocketService.DEFAULT_ROOM])
+            socketio = MagicMock()
+            frames = presence_broadcaster.flush(socketio)
+
+            change = [{'user_id': alice, 'online': True}]
+            assert frames == {
+                'presence_room': change,
+                WebSocketService.DEFAULT_ROOM: change,
+                presence_broadcaster.personal_room(bob): change,
+            }
+            assert socketio.emit.call_count == 3
+            assert presence_broadcaster.flush(socketio) == {}
+            conn_mgr.remove_connection(bob)
+
+    def test_emits_to_same_target_sent_as_one_batch_frame(self, app, db):
+        """Тест пакетирования: несколько emit'ов одному адресату — один кадр batch, одиночный — как есть"""
+        from flask import request
+        from app.services.emit_batcher import emit_batcher, emit, join_room
+        with app.test_request_context('/'):
+            request.sid = 'batch_sid'
+            request.namespace = '/'
+            with patch('flask_socketio.emit') as mock_emit, patch('flask_socketio.join_room'):
+                with emit_batcher.batch():
+                    emit('user_left', {'user_id': 1}, room='batch_room', include_self=False)
+                    emit('current_users', {'users': {}}, room='batch_room')
+                    emit('current_users', {'users': {2: 'b'}}, room='batch_room')
+                    emit('room_list', {'rooms': []})
+                    assert mock_emit.call_count == 0
+                    # Смена состава комнаты отправляет накопленное до нее
+                    join_room('batch_other')
+                    assert mock_emit.call_count == 3
+                    emit('message_history', {'messages': []})
+                    emit('dm_conversations', {'conversations': []})
+
+            calls = [(c.args[0], c.args[1], c.kwargs['to'], c.kwargs['skip_sid']) for c in mock_emit.call_args_list]
+            assert calls == [
+                ('user_left', {'user_id': 1}, 'batch_room', 'batch_sid'),
+                ('batch', {'events': [
+                    {'event': 'current_users', 'data': {'users': {}}},
+                    {'event': 'current_users', 'data': {'users': {2: 'b'}}},
+                ]}, 'batch_room', None),
+                ('room_list', {'rooms': []}, 'batch_sid', None),
+                ('batch', {'events': [
+                    {'event': 'message_history', 'data': {'messages': []}},
+                    {'event': 'dm_conversations', 'data': {'conversations': []}},
+                ]}, 'batch_sid', None),
+            ]
+
     def test_room_users_broadcast(self, app, db):
         """Тест рассылки списка пользователей комнаты"""
         with app.app_context():
@@ -353,16 +710,11 @@ class TestRoomWebSocketIntegration:
             ws_service = WebSocketService()
             
             # Пользователи присоединяются к комнате
-            ws_service.active_users['broadcast_test_room'] = {}
             for user in users:
-                ws_service.active_users['broadcast_test_room'][user.id] = user.username
+                user_state.add_user_to_room(user.id, user.username, 'broadcast_test_room')
             
             # Мокаем emit для проверки рассылки
-            with patch('app.services.websocket_service.emit') as mock_emit, \
-                 patch('app.state.user_state.get_room_users') as mock_get_room_users:
-                
-                # Мокаем Redis, чтобы он возвращал пользователей из локального кеша
-                mock_get_room_users.return_value = ws_service.active_users['broadcast_test_room']
+            with patch('app.services.websocket_service.emit') as mock_emit:
                 
                 # Рассылаем список пользователей комнаты
                 ws_service._send_room_users('broadcast_test_room')
@@ -420,15 +772,89 @@ class TestRoomWebSocketIntegration:
                 # Пользователь присоединяется к комнате
                 ws_service.handle_join_room({'room': 'event_room'})
                 
-                # Проверяем, что пользователь добавлен в локальный кеш
-                assert 'event_room' in ws_service.active_users
-                assert user.id in ws_service.active_users['event_room']
+                # Проверяем, что пользователь добавлен в менеджер состояния
+                assert user.id in user_state.get_room_users('event_room')
+                assert 'event_room' in user_state.get_user_rooms(user.id)
                 
                 # Пользователь выходит из комнаты
                 ws_service.handle_leave_room({'room': 'event_room'})
                 
-                # Проверяем, что пользователь удален из локального кеша
-                assert user.id not in ws_service.active_users['event_room']
+                # Проверяем, что пользователь удален из менеджера состояния
+                assert user.id not in user_state.get_room_users('event_room')
+                assert 'event_room' not in user_state.get_user_rooms(user.id)
+
+    
+    def test_members_delta_on_join_and_leave(self, app, db):
+        """Тест members_delta: вошедшему — снимок с версией, остальным — изменения со следующей версией"""
+        with app.test_request_context('/'):
+            users = [User(username=f'delta_{name}', email=f'delta_{name}@example.com', password_hash='test_hash')
+                     for name in ('alice', 'bob')]
+            db.session.add_all(users)
+            db.session.commit()
+            alice, bob = users
+            db.session.add(Room(name='delta_room', created_by=alice.id, is_active=True))
+            db.session.commit()
+            user_state.add_user_to_room(alice.id, alice.username, 'delta_room')
+            version, _ = user_state.get_room_snapshot('delta_room')
+            
+            ws_service = WebSocketService()
+            with patch('app.services.websocket_service.current_user') as mock_user, \
+                 patch('app.services.websocket_service.request') as mock_request, \
+                 patch('app.services.websocket_service.join_room'), \
+                 patch('app.services.websocket_service.leave_room'), \
+                 patch('app.services.websocket_service.emit') as mock_emit:
+                mock_user.is_authenticated = True
+                mock_user.id = bob.id
+                mock_user.username = bob.username
+                mock_request.sid = 'delta_bob_sid'
+                
+                ws_service.handle_join_room({'room': 'delta_room'})
+                ws_service.handle_leave_room({'room': 'delta_room'})
+            
+            sent = [(c.args[0], c.args[1]) for c in mock_emit.call_args_list
+                    if c.args[0] in ('members_delta', 'current_users')]
+            assert sent == [
+                ('members_delta', {'room': 'delta_room', 'version': version + 1,
+                                   'added': {bob.id: bob.username}, 'removed': []}),
+                ('current_users', {'room': 'delta_room', 'version': version + 1,
+                                   'users': {alice.id: alice.username, bob.id: bob.username}}),
+                ('members_delta', {'room': 'delta_room', 'version': version + 2,
+                                   'added': {}, 'removed': [bob.id]}),
+            ]
+            user_state.remove_user_from_room(alice.id, 'delta_room')
+
+    
+    def test_disconnect_while_draining_hands_user_off(self, app, db):
+        """Тест вывода воркера: отключение не убирает пользователя из комнат и не меняет статус"""
+        from app.services.presence_broadcaster import presence_broadcaster
+        from app.state import conn_mgr
+        with app.test_request_context('/'):
+            user = User(username='drain_user', email='drain_user@example.com', password_hash='test_hash')
+            db.session.add(user)
+            db.session.commit()
+            conn_mgr.register_connection(user.id, 'drain_sid', user.username)
+            user_state.add_user_to_room(user.id, user.username, 'drain_room')
+            presence_broadcaster.flush(MagicMock())
+            
+            ws_service = WebSocketService()
+            ws_service.begin_drain()
+            with patch('app.services.websocket_service.current_user') as mock_user, \
+                 patch('app.services.websocket_service.request') as mock_request, \
+                 patch('app.services.websocket_service.emit') as mock_emit:
+                mock_user.is_authenticated = True
+                mock_user.id = user.id
+                mock_user.username = user.username
+                mock_request.sid = 'drain_sid'
+                ws_service.handle_disconnect()
+            
+            # Пользователь остается в комнатах и онлайн до переподключения к другому воркеру
+            mock_emit.assert_not_called()
+            assert user_state.get_room_users('drain_room') == {user.id: user.username}
+            assert conn_mgr.get_user_socket(user.id) == 'drain_sid'
+            assert presence_broadcaster.flush(MagicMock()) == {}
+            
+            user_state.remove_user_from_room(user.id, 'drain_room')
+            conn_mgr.remove_connection(user.id)
 
 
 class TestRoomErrorHandling:
@@ -10,6 +10,7 @@ from app.services.websocket_service import WebSocketService
 from app.services.message_service import MessageService
 from app.models import Room, User, Message
 from app.extensions import db
+from app.state import user_state
 
 
 class TestRoomPerformance:
@@ -424,26 +425,26 @@ class TestRoomMemoryUsage:
                 db.session.add(user)
             db.session.commit()
             
-            # Создаем WebSocket сервис
-            ws_service = WebSocketService()
-            
             # Симулируем присоединение пользователей к разным комнатам
-            for i in range(50):  # 50 комнат
-                room_name = f'memory_room_{i:02d}'
-                ws_service.active_users[room_name] = {}
-                
+            room_names = [f'memory_room_{i:02d}' for i in range(50)]  # 50 комнат
+            for i, room_name in enumerate(room_names):
                 # Каждая комната содержит 2 пользователя
                 for j in range(2):
                     user_idx = i * 2 + j
                     if user_idx < len(users):
-                        ws_service.active_users[room_name][users[user_idx].id] = users[user_idx].username
+                        user_state.add_user_to_room(users[user_idx].id, users[user_idx].username, room_name)
+            
+            # Проверяем, что все пользователи распределены по комнатам (одна пачка HLEN)
+            counts = user_state.get_room_user_counts(room_names)
+            assert sum(counts.values()) == 100
+            assert len(counts) == 50
             
-            # Проверяем, что все пользователи распределены по комнатам
-            total_users = sum(len(room_users) for room_users in ws_service.active_users.values())
-            assert total_users == 100
+            # Обратный индекс: у каждого пользователя ровно одна комната
+            assert all(len(user_state.get_user_rooms(user.id)) == 1 for user in users)
             
-            # Проверяем количество комнат
-            assert len(ws_service.active_users) == 51  # 50 комнат + default room
+            for i, room_name in enumerate(room_names):
+                for user in users[i * 2:i * 2 + 2]:
+                    user_state.remove_user_from_room(user.id, room_name)
 
 
 class TestRoomStressTest:
@@ -484,9 +485,6 @@ class TestRoomStressTest:
             db.session.add(user)
             db.session.commit()
             
-            # Создаем WebSocket сервис
-            ws_service = WebSocketService()
-            
             # Симулируем нагрузку
             start_time = time.time()
             
@@ -506,7 +504,7 @@ class TestRoomStressTest:
                 operations_count += 1
                 
                 # Добавление пользователя в комнату (WebSocket)
-                ws_service.active_users[f'load_room_{i:03d}'] = {user.id: user.username}
+                user_state.add_user_to_room(user.id, user.username, f'load_room_{i:03d}')
                 operations_count += 1
                 
                 # Получение списка комнат
@@ -523,3 +521,7 @@ class TestRoomStressTest:
             # Проверяем, что все комнаты созданы
             rooms_in_db = Room.query.filter(Room.name.like('load_room_%')).count()
             assert rooms_in_db == 100
+            
+            # Выход из всех комнат — одна транзакция по обратному индексу пользователя
+            user_state.remove_user_from_rooms(user.id, user_state.get_user_rooms(user.id))
+            assert user_state.get_user_rooms(user.id) == set()